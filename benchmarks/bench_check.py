@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+静态检查基准：统计 --check 分析变量和计算关键路径的耗时，不包含解析CSV文件
+
+    python3 benchmarks/bench_check.py --rows 1000 10000 100000
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+from bench_suite import build_csv  # noqa: E402
+from happy_python.happy_log import HappyLogLevel  # noqa: E402
+
+
+def timed(fn, repeat: int) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='静态检查基准')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rss.log.set_level(HappyLogLevel.WARNING.value)
+    session = rss.Session()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for rows in args.rows:
+            csv_file = Path(tmp_dir) / ('check_%d.csv' % rows)
+            csv_file.write_text(build_csv(rows, 'balanced', str(csv_file), str(Path(tmp_dir) / 'dst.txt')),
+                                encoding='UTF-8')
+            plan = rss.compile_plan(str(csv_file), use_cache=False)
+            durations = {row.line_number: 0.01 for row in plan.rows}
+
+            check = timed(lambda: rss.PlanChecker(session).check(plan), args.repeat)
+            graph = timed(lambda: rss.build_plan_graph(plan, durations), args.repeat)
+            print('%7d行  变量检查 %7.1fms  关键路径 %7.1fms' % (len(plan.rows), check * 1000, graph * 1000),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
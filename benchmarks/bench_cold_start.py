@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+冷启动基准：统计 --version、--help、-c 的启动耗时和 -X importtime 导入耗时，
+超出预算时返回非零退出代码
+
+    python3 benchmarks/bench_cold_start.py --runs 20 --budget-ms 150
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SCENARIOS = (
+    ('--version', ['-v']),
+    ('--help', ['-h']),
+    ('-c', ['-c', '-f', str(ROOT / 'examples' / 'hello.csv')]),
+)
+
+
+def build_env(cache_dir: str) -> dict:
+    env = dict(os.environ)
+    # 与安装后的命令一致，使用编译好的字节码，排除编译源文件的耗时
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPYCACHEPREFIX'] = os.path.join(cache_dir, 'pycache')
+    env['RAIN_SHELL_SCRIPTER_CACHE_DIR'] = os.path.join(cache_dir, 'rain')
+    env['PYTHONPATH'] = str(ROOT)
+    return env
+
+
+def measure(cmd: list, env: dict, runs: int) -> list:
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, cwd=str(ROOT), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return times
+
+
+def import_breakdown(env: dict, top_n: int) -> list:
+    """
+    解析 -X importtime 的输出，返回 rain_shell_scripter 及其直接导入的模块的累计耗时（毫秒）
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import rain_shell_scripter'],
+                          env=env, cwd=str(ROOT), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                          text=True)
+    modules = []
+
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        _, cumulative_us, name = line.split('|')
+
+        if not cumulative_us.strip().isdigit():
+            continue
+
+        # 每一层缩进两个空格
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        if depth <= 1:
+            modules.append((name.strip(), int(cumulative_us) / 1000))
+
+    return sorted(modules, key=lambda item: item[1], reverse=True)[:top_n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='冷启动基准')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--budget-ms', type=float, default=150.0,
+                        help='--version 启动耗时中位数减去空解释器启动耗时的预算（毫秒）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = build_env(cache_dir)
+        cmd = [sys.executable, '-m', 'rain_shell_scripter']
+        # 预热：生成字节码和编译缓存
+        for _, scenario_args in SCENARIOS:
+            measure(cmd + scenario_args, env, 1)
+
+        baseline = statistics.median(measure([sys.executable, '-c', 'pass'], env, args.runs))
+        print('空解释器：%.1fms' % baseline)
+
+        results = dict()
+
+        for name, scenario_args in SCENARIOS:
+            times = measure(cmd + scenario_args, env, args.runs)
+            results[name] = statistics.median(times)
+            print('%-10s 中位数 %.1fms，最小 %.1fms，最大 %.1fms（%d次）'
+                  % (name, results[name], min(times), max(times), args.runs))
+
+        print('\n导入耗时（累计，毫秒）：')
+
+        for name, elapsed in import_breakdown(env, args.top):
+            print('  %8.1f  %s' % (elapsed, name))
+
+    overhead = results['--version'] - baseline
+    print('\n--version 启动开销：%.1fms，预算：%.1fms' % (overhead, args.budget_ms))
+
+    if overhead > args.budget_ms:
+        print('超出预算', file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
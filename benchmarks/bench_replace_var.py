@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+变量替换微基准：对比旧版 _replace_var（每次合并字典并逐个查找替换）与模板引擎
+
+    python3 benchmarks/bench_replace_var.py --rows 5000 --env-size 150
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+from happy_python import HappyPyException  # noqa: E402
+
+
+def legacy_replace_var(session: rss.Session, s: str) -> str:
+    tmp = s
+    var_dict = {**session.vars, **os.environ}
+
+    for var_name, var_value in var_dict.items():
+        var_expr = '${%s}' % var_name
+        index = tmp.find(var_expr)
+
+        if index != -1:
+            if var_value == '' or var_value is None:
+                raise HappyPyException(tmp)
+
+            tmp = tmp.replace(var_expr, str(var_value))
+
+    while True:
+        m = re.match(r'.*(\${!?[a-zA-Z\d_]+}).*', tmp)
+
+        if m and m.group(1)[:3] == '${!':
+            tmp = tmp.replace(m.group(1), '')
+        else:
+            break
+
+    m = re.match(r'.*(\${[a-zA-Z\d_]+}).*', tmp)
+
+    if m:
+        raise HappyPyException(tmp)
+
+    return tmp
+
+
+def build_cells(rows: int) -> list:
+    cells = []
+
+    for i in range(rows):
+        # 每行约 4 个单元格需要替换：提示消息、表达式、过滤器、默认值
+        cells.append('构建模块 ${PROJECT}-%d，版本 ${VERSION}' % (i % 50))
+        cells.append('md5sum target/${target_file} ${BENCH_ENV_%d}' % (i % 150))
+        cells.append('NULL')
+        cells.append('${WORK_DIR}/module_%d${!optional_suffix}' % (i % 50))
+
+    return cells
+
+
+def bench(fn, cells: list, repeat: int) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for cell in cells:
+            fn(cell)
+
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='变量替换微基准')
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--env-size', type=int, default=150)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for i in range(args.env_size):
+        os.environ['BENCH_ENV_%d' % i] = 'value_%d' % i
+
+    os.environ['WORK_DIR'] = '/tmp/work'
+    session = rss.Session()
+    session.vars.update({
+        'PROJECT': 'hello',
+        'VERSION': '1.0.0',
+        'target_file': 'hello-1.0.0.jar',
+    })
+
+    cells = build_cells(args.rows)
+
+    # 两种实现的结果必须一致
+    for cell in cells:
+        assert legacy_replace_var(session, cell) == session.replace_var(cell), cell
+
+    legacy = bench(lambda cell: legacy_replace_var(session, cell), cells, args.repeat)
+    template = bench(session.replace_var, cells, args.repeat)
+
+    print('单元格数量：%d，环境变量数量：%d' % (len(cells), len(os.environ)))
+    print('旧版实现：%.4fs（%.0f 单元格/秒）' % (legacy, len(cells) / legacy))
+    print('模板引擎：%.4fs（%.0f 单元格/秒）' % (template, len(cells) / template))
+    print('加速比：%.1fx' % (legacy / template))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+命令执行后端基准：对比逐条命令启动shell（spawn）与常驻bash会话（session）
+
+    python3 benchmarks/bench_shell_backend.py --rows 1000
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+from happy_python.happy_log import HappyLogLevel  # noqa: E402
+
+HEADER = '模式,表达式,返回代码,返回类型,返回值,过滤器,变量名,提示信息\n'
+TRIVIAL_COMMANDS = (
+    'true',
+    'echo hello',
+    'basename /tmp/target/hello-1.0.0.jar',
+    'test -d /tmp',
+)
+
+
+def build_csv(rows: int) -> str:
+    lines = [HEADER]
+
+    for i in range(rows):
+        cmd = TRIVIAL_COMMANDS[i % len(TRIVIAL_COMMANDS)]
+        lines.append('RUN,%s,0,STR,NULL,NULL,v%d,命令%d\n' % (cmd, i % 10, i))
+
+    return ''.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='命令执行后端基准')
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    rss.log.set_level(HappyLogLevel.WARNING.value)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = Path(tmp_dir) / 'bench.csv'
+        csv_file.write_text(build_csv(args.rows), encoding='UTF-8')
+        # 先编译一次，排除解析和校验的耗时
+        rss.compile_plan(str(csv_file), use_cache=False)
+
+        results = dict()
+
+        for backend in rss.SHELL_BACKENDS:
+            start = time.perf_counter()
+            rss.raining(str(csv_file), use_plan_cache=False, shell_backend=backend)
+            results[backend] = time.perf_counter() - start
+
+    for backend, elapsed in results.items():
+        print('%-8s %d 行，%.3fs，%.2fms/行' % (backend, args.rows, elapsed, elapsed * 1000 / args.rows))
+
+    print('加速比：%.1fx' % (results[rss.SHELL_BACKEND_SPAWN] / results[rss.SHELL_BACKEND_SESSION]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+启动命令的延迟基准：对比通过 /bin/sh 执行与直接执行（不启动shell）
+同一条简单命令的耗时
+
+    python3 benchmarks/bench_spawn.py --count 300
+
+每条命令的耗时包括启动进程、读取输出和等待进程退出。
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+from happy_python.happy_log import HappyLogLevel  # noqa: E402
+
+
+def bench(session: rss.Session, expr_line: str, exec_mode: str, count: int, repeat: int) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for _ in range(count):
+            capture = rss.OutputCapture(session)
+            return_code = session.execute_cmd(expr_line, capture, exec_mode=exec_mode)
+            assert return_code == 0, expr_line
+
+        best = min(best, (time.perf_counter() - start) / count)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='启动命令的延迟基准')
+    parser.add_argument('--count', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rss.log.set_level(HappyLogLevel.WARNING.value)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_file = Path(tmp_dir) / 'hello-1.0.0.jar'
+        data_file.write_bytes(os.urandom(64 * 1024))
+        commands = (
+            'basename %s' % data_file,
+            'md5sum %s' % data_file,
+            'uname -r',
+            'ls %s' % tmp_dir,
+        )
+        session = rss.Engine(use_plan_cache=False, use_result_cache=False).session()
+
+        print('/bin/sh -> %s' % os.path.realpath('/bin/sh'), file=sys.stderr)
+        print('%-40s %12s %12s %8s' % ('命令', 'shell（微秒）', '直接（微秒）', '加速比'),
+              file=sys.stderr)
+
+        for expr_line in commands:
+            assert rss.split_direct_command(expr_line) is not None, expr_line
+            shell = bench(session, expr_line, rss.EXEC_MODE_SHELL, args.count, args.repeat)
+            direct = bench(session, expr_line, rss.EXEC_MODE_DIRECT, args.count, args.repeat)
+            name = expr_line.replace(tmp_dir, '$TMP')
+            print('%-40s %12.0f %12.0f %7.2fx' % (name, shell * 1e6, direct * 1e6, shell / direct), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
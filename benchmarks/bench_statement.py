@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+STATEMENT 基准：对比旧版（替换文本后 exec）与编译缓存后 eval
+
+    python3 benchmarks/bench_statement.py --rows 10000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+
+STATEMENTS = (
+    ("'${local_hash}' == '${expected_hash}'", True),
+    ('${count} + 1', True),
+    ("'a' if ${count} > 10 else 'b'", False),
+)
+
+
+session = rss.Session()
+
+
+def legacy_statement(expr_line: str, is_int: bool):
+    expr_line = session.replace_var(expr_line)
+
+    if is_int:
+        statement = 'tmp = int(%s)' % expr_line
+    else:
+        statement = 'tmp = %s' % expr_line
+
+    scope = dict()
+    exec(statement, scope)
+    return scope.get('tmp')
+
+
+def compiled_statement(expr_line: str, is_int: bool):
+    return session.evaluate_statement(expr_line, is_int)
+
+
+def bench(fn, rows: int, repeat: int) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for i in range(rows):
+            expr_line, is_int = STATEMENTS[i % len(STATEMENTS)]
+            fn(expr_line, is_int)
+
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='STATEMENT 基准')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    session.vars.update({
+        'local_hash': 'e0aa021e21dddbd6d8cecec71e9cf564',
+        'expected_hash': 'e0aa021e21dddbd6d8cecec71e9cf564',
+        'count': 42,
+    })
+
+    for expr_line, is_int in STATEMENTS:
+        assert legacy_statement(expr_line, is_int) == compiled_statement(expr_line, is_int), expr_line
+
+    legacy = bench(legacy_statement, args.rows, args.repeat)
+    compiled = bench(compiled_statement, args.rows, args.repeat)
+
+    print('语句数量：%d' % args.rows)
+    print('替换文本后exec：%.4fs（%.0f 行/秒）' % (legacy, args.rows / legacy))
+    print('编译缓存后eval：%.4fs（%.0f 行/秒）' % (compiled, args.rows / compiled))
+    print('加速比：%.1fx' % (legacy / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+基准测试套件：生成不同规模、不同模式组合和环境变量数量的CSV文件，
+统计每秒处理的行数
+
+    python3 benchmarks/bench_suite.py --rows 1000 10000 100000 --output result.json
+    python3 benchmarks/bench_suite.py --compare result.json
+
+测量项目：
+    to_csv_row_obj     解析和校验每一行
+    replace_var        替换每一行提示信息和表达式中的变量
+    statement_handler  执行STATEMENT行
+    raining            编译并执行整个CSV文件，RUN行使用不启动子进程的模拟执行器
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+from happy_python.happy_log import HappyLogLevel  # noqa: E402
+
+HEADER = '模式,表达式,返回代码,返回类型,返回值,过滤器,变量名,提示信息,选项\n'
+
+# 各模式所占的比例：CONST、MESSAGE、RUN、STATEMENT、COPY
+MIXES = {
+    'balanced': (30, 20, 30, 15, 5),
+    'run': (10, 10, 70, 5, 5),
+    'statement': (20, 10, 10, 60, 0),
+}
+
+STR_VARS = 50
+INT_VARS = 10
+
+
+class FakeExecutorSession(rss.Session):
+    """
+    RUN行不启动子进程，把命令本身作为输出，返回代码为0
+    """
+
+    def execute_cmd(self, expr_line: str, capture: rss.OutputCapture, timeout: float = None,
+                    exec_mode: str = rss.EXEC_MODE_AUTO) -> int:
+        capture.feed_stdout(expr_line.encode(capture.encoding) + b'\n')
+        capture.close()
+        return 0
+
+
+def build_csv(rows: int, mix: str, copy_src: str, copy_dst: str) -> str:
+    lines = [HEADER]
+
+    # 先定义后面引用的变量
+    for i in range(STR_VARS):
+        lines.append('CONST,NULL,NULL,STR,value_%d,NULL,c%d,字符串常量%d,NULL\n' % (i, i, i))
+
+    for i in range(INT_VARS):
+        lines.append('CONST,NULL,NULL,INT,%d,NULL,n%d,整数常量%d,NULL\n' % (i, i, i))
+
+    weights = MIXES[mix]
+    pattern = [mode for mode, weight in enumerate(weights) for _ in range(weight)]
+
+    for i in range(max(0, rows - STR_VARS - INT_VARS)):
+        mode = pattern[(i * 37) % len(pattern)]
+        c = i % STR_VARS
+        n = i % INT_VARS
+
+        if mode == 0:
+            lines.append('CONST,NULL,NULL,STR,item_%d,NULL,c%d,常量%d ${c%d},NULL\n' % (i, c, i, (c + 1) % STR_VARS))
+        elif mode == 1:
+            lines.append('MESSAGE,NULL,NULL,NULL,NULL,NULL,NULL,消息%d ${c%d} ${!BENCH_ENV_%d},NULL\n'
+                         % (i, c, i % 1000))
+        elif mode == 2:
+            if i % 3:
+                lines.append('RUN,echo ${c%d} %d,0,STR,NULL,NULL,r%d,命令%d,NULL\n' % (c, i, i % 20, i))
+            else:
+                lines.append('RUN,echo ${c%d} %d,0,STR,NULL,^echo (\\w+) .*$,f%d,过滤%d,NULL\n' % (c, i, i % 20, i))
+        elif mode == 3:
+            if i % 2:
+                lines.append('STATEMENT,${n%d} + %d > 0,NULL,INT,1,NULL,NULL,判断%d,NULL\n' % (n, i, i))
+            else:
+                lines.append("STATEMENT,'${c%d}' + '_x',NULL,NULL,NULL,NULL,s%d,赋值%d,NULL\n" % (c, i % 20, i))
+        else:
+            lines.append('COPY,%s %s,NULL,NULL,NULL,NULL,NULL,复制%d,copy=incremental\n' % (copy_src, copy_dst, i))
+
+    return ''.join(lines)
+
+
+def timed(fn, count: int, repeat: int) -> dict:
+    best = float('inf')
+
+    for _ in range(repeat):
+        # 每次测量都从空的模板和语句编译缓存开始
+        rss._compile_var_template.cache_clear()
+        rss._compile_statement.cache_clear()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return {'count': count, 'seconds': best, 'rows_per_sec': count / best if best > 0 else 0.0}
+
+
+def bench_case(rows: int, mix: str, env_size: int, repeat: int, work_dir: Path) -> list:
+    copy_src = work_dir / 'src.txt'
+    copy_src.write_text('bench\n', encoding='UTF-8')
+    csv_file = work_dir / ('%s_%d.csv' % (mix, rows))
+    content = build_csv(rows, mix, str(copy_src), str(work_dir / 'dst.txt'))
+    csv_file.write_text(content, encoding='UTF-8')
+
+    for i in range(env_size):
+        os.environ['BENCH_ENV_%d' % i] = 'env_value_%d' % i
+
+    engine = rss.Engine(use_plan_cache=False, use_result_cache=False)
+    session = FakeExecutorSession(engine)
+    csv_rows = list(csv.reader(io.StringIO(content, newline='')))[1:]
+    plan = session.compile(str(csv_file))
+
+    def parse_rows():
+        for line_number, row in enumerate(csv_rows, 2):
+            session.line_number = line_number
+            rss.to_csv_row_obj(session, row)
+
+    # 执行一次，变量暂存区中有全部变量
+    session.run(plan=plan)
+    cells = [cell for row in plan.rows for cell in (row.message, row.expr_line)]
+    statement_rows = [row for row in plan.rows if row.mode_type == rss.ModeType.STATEMENT]
+
+    def replace_cells():
+        for cell in cells:
+            session.replace_var(cell)
+
+    def run_statements():
+        for row in statement_rows:
+            rss.RowHandler.statement_handler(session, row)
+
+    def run_file():
+        FakeExecutorSession(engine).run(str(csv_file))
+
+    benches = [
+        ('to_csv_row_obj', parse_rows, len(csv_rows)),
+        ('replace_var', replace_cells, len(plan.rows)),
+        ('statement_handler', run_statements, len(statement_rows)),
+        ('raining', run_file, len(plan.rows)),
+    ]
+    results = []
+
+    for name, fn, count in benches:
+        if not count:
+            continue
+
+        result = {'benchmark': name, 'mix': mix, 'rows': rows, 'env_size': env_size, **timed(fn, count, repeat)}
+        results.append(result)
+        print('%-18s %-10s %7d行 环境变量%5d  %9.0f 行/秒' % (name, mix, rows, env_size, result['rows_per_sec']),
+              file=sys.stderr)
+
+    for i in range(env_size):
+        del os.environ['BENCH_ENV_%d' % i]
+
+    return results
+
+
+def result_key(result: dict) -> tuple:
+    return result['benchmark'], result['mix'], result['rows'], result['env_size']
+
+
+def compare(results: list, baseline_file: str, threshold: float) -> bool:
+    """
+    与之前保存的结果对比，每秒行数下降超过 threshold 时视为性能退化，返回是否存在退化
+    """
+    with open(baseline_file, encoding='UTF-8') as f:
+        baseline = {result_key(result): result for result in json.load(f)['results']}
+
+    regressed = False
+    print('\n与 %s 对比：' % baseline_file, file=sys.stderr)
+
+    for result in results:
+        old = baseline.get(result_key(result))
+
+        if old is None or not old['rows_per_sec']:
+            continue
+
+        ratio = result['rows_per_sec'] / old['rows_per_sec']
+        mark = ''
+
+        if ratio < 1 - threshold:
+            regressed = True
+            mark = '  <-- 退化'
+
+        print('%-18s %-10s %7d行 环境变量%5d  %.2fx%s' % (*result_key(result), ratio, mark), file=sys.stderr)
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='基准测试套件')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--mix', nargs='+', choices=sorted(MIXES), default=sorted(MIXES))
+    parser.add_argument('--env-size', type=int, nargs='+', default=[0, 500], dest='env_sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='结果以JSON格式写入指定文件，默认输出到标准输出')
+    parser.add_argument('--compare', help='与之前保存的JSON结果对比')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='每秒行数下降超过该比例时视为性能退化，默认0.2')
+    args = parser.parse_args()
+
+    rss.log.set_level(HappyLogLevel.WARNING.value)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['RAIN_SHELL_SCRIPTER_CACHE_DIR'] = tmp_dir
+
+        for rows in args.rows:
+            for mix in args.mix:
+                for env_size in args.env_sizes:
+                    results.extend(bench_case(rows, mix, env_size, args.repeat, Path(tmp_dir)))
+
+    report = {
+        'version': rss.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
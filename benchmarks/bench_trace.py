@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+"""
+日志和跟踪开销基准：在每个日志级别下执行同一个CSV文件，统计每行的平均耗时，
+日志输出到 /dev/null
+
+    python3 benchmarks/bench_trace.py --rows 2000
+
+RUN行使用不启动子进程的模拟执行器，测量结果只包含解释器本身的开销。
+最后一行为INFO级别下同时开启 --trace 结构化跟踪的耗时；
+作为参考，另外打印一次 inspect.stack() 的耗时。
+"""
+
+import argparse
+import inspect
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rain_shell_scripter as rss  # noqa: E402
+from happy_python.happy_log import HappyLogLevel  # noqa: E402
+
+HEADER = '模式,表达式,返回代码,返回类型,返回值,过滤器,变量名,提示信息,选项\n'
+
+
+class FakeExecutorSession(rss.Session):
+    """
+    RUN行不启动子进程，把命令本身作为输出，返回代码为0
+    """
+
+    def execute_cmd(self, expr_line: str, capture: rss.OutputCapture, timeout: float = None,
+                    exec_mode: str = rss.EXEC_MODE_AUTO) -> int:
+        if self.debugging:
+            self.log.debug('cmd=%s' % expr_line)
+
+        capture.feed_stdout(expr_line.encode(capture.encoding) + b'\n')
+        capture.close()
+        return 0
+
+
+def build_csv(rows: int) -> str:
+    lines = [HEADER,
+             'CONST,NULL,NULL,STR,hello,NULL,name,设置名称,NULL\n',
+             'CONST,NULL,NULL,INT,1,NULL,n,设置数字,NULL\n']
+
+    for i in range(rows - 2):
+        mode = i % 4
+
+        if mode == 0:
+            lines.append('CONST,NULL,NULL,STR,v%d,NULL,c%d,常量${name},NULL\n' % (i, i % 10))
+        elif mode == 1:
+            lines.append('MESSAGE,NULL,NULL,NULL,NULL,NULL,NULL,消息${name} %d,NULL\n' % i)
+        elif mode == 2:
+            lines.append('RUN,echo ${name} %d,0,STR,NULL,^echo (\\w+) .*$,r,命令%d,NULL\n' % (i, i))
+        else:
+            lines.append('STATEMENT,${n} + %d > 0,NULL,INT,1,NULL,NULL,判断%d,NULL\n' % (i, i))
+
+    return ''.join(lines)
+
+
+def bench(plan, repeat: int, trace_file: str = None) -> float:
+    engine = rss.Engine(use_plan_cache=False, use_result_cache=False)
+    best = float('inf')
+
+    for _ in range(repeat):
+        session = FakeExecutorSession(engine)
+        start = time.perf_counter()
+        session.run(plan=plan, trace_file=trace_file)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def inspect_stack_cost(calls: int = 1000) -> float:
+    def nested(depth: int):
+        if depth:
+            return nested(depth - 1)
+
+        start = time.perf_counter()
+
+        for _ in range(calls):
+            inspect.stack()
+
+        return (time.perf_counter() - start) / calls
+
+    # 与执行一行时的调用深度相近
+    return nested(10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='日志和跟踪开销基准')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+
+    for handler in rss.log.logger.handlers:
+        handler.setStream(devnull)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = Path(tmp_dir) / 'trace.csv'
+        csv_file.write_text(build_csv(args.rows), encoding='UTF-8')
+        plan = rss.compile_plan(str(csv_file), use_cache=False)
+        results = []
+
+        for level in HappyLogLevel:
+            rss.log.set_level(level.value)
+            results.append((level.name, bench(plan, args.repeat)))
+
+        rss.log.set_level(HappyLogLevel.INFO.value)
+        results.append(('INFO + --trace', bench(plan, args.repeat, str(Path(tmp_dir) / 'trace.jsonl'))))
+
+    baseline = results[0][1]
+    print('行数：%d' % len(plan.rows), file=sys.stderr)
+
+    for name, seconds in results:
+        per_row = seconds / len(plan.rows) * 1e6
+        extra = (seconds - baseline) / len(plan.rows) * 1e6
+        print('%-16s %8.1f 微秒/行（比CRITICAL多 %6.1f 微秒/行）' % (name, per_row, extra), file=sys.stderr)
+
+    print('参考：inspect.stack() 每次调用 %.1f 微秒' % (inspect_stack_cost() * 1e6), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
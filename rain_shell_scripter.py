@@ -2,85 +2,797 @@
 # -*- coding:utf-8 -*-
 
 import argparse
-import csv
-import inspect
+import errno
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import logging
 import os
 import re
+import shlex
 import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
 from enum import Enum
+from functools import lru_cache, wraps
+from heapq import heappush, heappop
+from itertools import count
 from pathlib import Path
-from shutil import copytree, SameFileError, copy
 
 from happy_python import HappyLog
 from happy_python import HappyPyException
 from happy_python import dict_to_pretty_json
-from happy_python import execute_cmd
-from happy_python.happy_log import HappyLogLevel
+from happy_python.happy_log import HappyLogLevel, TRACE_LEVEL_NUM
+
+# csv、shutil、tempfile、uuid、concurrent.futures 只在部分功能中使用，在函数中按需导入，
+# 减少启动耗时
 
 log = HappyLog.get_instance()
 __version__ = '1.4.1'
 NULL_VALUE = 'NULL'
-line_number = 0
+# 编译缓存格式版本
+PLAN_FORMAT_VERSION = 2
 
-# 变量暂存区
-_var_tmp_storage_area = dict()
 
+def traced(func):
+    """
+    开启TRACE日志时，记录进入和退出函数。函数名在定义时确定，
+    被装饰的函数第一个参数为会话
+    """
+    func_name = func.__name__
 
-def _output_message_builder(message: str, status: bool):
-    return '行号：%s -> %s...[ %s ]' % (line_number, message, ('OK' if status else 'FAILED'))
+    @wraps(func)
+    def wrapper(session: 'Session', *args, **kwargs):
+        if not session.tracing:
+            return func(session, *args, **kwargs)
 
+        session.log.enter_func(func_name)
+        result = func(session, *args, **kwargs)
+        session.log.exit_func(func_name)
+        return result
 
-def _output_message_builder_no_status(message: str):
-    return '行号：%s -> %s' % (line_number, message)
+    return wrapper
 
 
 def _is_alpha_num_underline_str(value: str):
     return bool(re.match(r'^\w+$', value))
 
 
-def _make_error_message(row_desc: str, col_name: str, value_desc: str):
-    msg = '第%d行->%s模式的行，"%s"列应为"%s"' % (line_number, row_desc, col_name, value_desc)
+def _is_positive_number(value: str) -> bool:
+    try:
+        return float(value) > 0
+    except ValueError:
+        return False
+
+
+def _make_error_message(session: 'Session', row_desc: str, col_name: str, value_desc: str):
+    msg = '第%d行->%s模式的行，"%s"列应为"%s"' % (session.line_number, row_desc, col_name, value_desc)
     raise HappyPyException(msg)
 
 
-def _make_error_message_required(row_desc: str, col_name: str):
-    msg = '第%d行->%s模式的行，"%s"列需要指定值' % (line_number, row_desc, col_name)
+def _make_error_message_required(session: 'Session', row_desc: str, col_name: str):
+    msg = '第%d行->%s模式的行，"%s"列需要指定值' % (session.line_number, row_desc, col_name)
     raise HappyPyException(msg)
 
 
-def _replace_var(s: str) -> (bool, str):
-    tmp = s
-    var_dict = {**_var_tmp_storage_area, **os.environ}
+# ${name} 或 ${!name}
+_VAR_EXPR_PATTERN = re.compile(r'\$\{(!?)([a-zA-Z\d_]+)\}')
+_MISSING = object()
+
+
+class VarTemplate:
+    """
+    单元格模板，解析一次后缓存，按字面量和变量分段渲染
+    """
+    __slots__ = ('source', 'segments', 'var_names')
+
+    def __init__(self, source: str):
+        self.source = source
+        # 字面量为 str，变量为 (变量名, 是否可选) 元组
+        segments = []
+        pos = 0
+
+        for m in _VAR_EXPR_PATTERN.finditer(source):
+            if m.start() > pos:
+                segments.append(source[pos:m.start()])
+
+            segments.append((m.group(2), m.group(1) == '!'))
+            pos = m.end()
+
+        if pos < len(source):
+            segments.append(source[pos:])
+
+        self.segments = tuple(segments)
+        self.var_names = tuple(seg[0] for seg in segments if seg.__class__ is tuple)
+
+    def render(self, session: 'Session') -> str:
+        if not self.var_names:
+            return self.source
+
+        parts = []
+
+        for seg in self.segments:
+            if seg.__class__ is str:
+                parts.append(seg)
+                continue
+
+            var_name, is_optional = seg
+
+            # 感叹号开头的变量，替换为空
+            if is_optional:
+                continue
 
-    # 从暂存区读取变量值 & 从环境变量中读取变量值
-    for var_name, var_value in var_dict.items():
-        var_expr = '${%s}' % var_name
-        index = tmp.find(var_expr)
+            var_value = session.lookup_var(var_name)
+
+            if var_value is _MISSING:
+                session.log.error('存在未替换的变量：${%s}' % var_name)
+                raise HappyPyException(session.build_message(self.source, False))
 
-        if index != -1:
-            # 非感叹号开头的变量，从变量树中查找
             if var_value == '' or var_value is None:
-                log.error('替换变量时出现空值：%s -> %s，type=%s' % (var_name, var_value, type(var_value)))
-                raise HappyPyException(_output_message_builder(tmp, False))
+                session.log.error('替换变量时出现空值：%s -> %s，type=%s'
+                                  % (var_name, var_value, type(var_value)))
+                raise HappyPyException(session.build_message(self.source, False))
+
+            parts.append(var_value if var_value.__class__ is str else str(var_value))
+
+        return ''.join(parts)
+
+
+@lru_cache(maxsize=8192)
+def _compile_var_template(s: str) -> VarTemplate:
+    return VarTemplate(s)
+
+
+# 语句中可以调用的内置函数
+STATEMENT_BUILTINS = {
+    'abs': abs,
+    'all': all,
+    'any': any,
+    'bool': bool,
+    'float': float,
+    'int': int,
+    'len': len,
+    'max': max,
+    'min': min,
+    'round': round,
+    'sorted': sorted,
+    'str': str,
+    'sum': sum,
+}
+# 可用于逃逸沙箱的属性
+STATEMENT_DENIED_ATTRS = ('format', 'format_map')
+_STATEMENT_VAR_PREFIX = '__rain_var_'
+_STATEMENT_TEXT_FUNC = '__rain_text__'
+_STATEMENT_LITERAL_FUNC = '__rain_literal__'
+
+
+@lru_cache(maxsize=None)
+def _get_statement_allowed_nodes() -> tuple:
+    """
+    语句允许使用的语法节点，执行STATEMENT行时才导入 ast
+    """
+    import ast
+
+    return (
+        ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+        ast.Mod, ast.Pow, ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift, ast.UnaryOp, ast.Not, ast.USub,
+        ast.UAdd, ast.Invert, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+        ast.Is, ast.IsNot, ast.IfExp, ast.Call, ast.keyword, ast.Name, ast.Load, ast.Constant, ast.JoinedStr,
+        ast.FormattedValue, ast.Subscript, ast.Slice, ast.Tuple, ast.List, ast.Set, ast.Dict, ast.Attribute,
+        # Python 3.8
+        *((ast.Index,) if sys.version_info < (3, 9) else ()),
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_statement_transformer_class():
+    import ast
+
+    class StatementTransformer(ast.NodeTransformer):
+        """
+        将变量占位符替换为变量读取函数：
+            字符串中的 '${x}' -> f'{__rain_text__("x")}'
+            单独的 ${x}      -> __rain_literal__("x")
+        """
+
+        def __init__(self, variables: list):
+            self.variables = variables
+
+        def _var_call(self, func_name: str, index: int) -> ast.Call:
+            var_name, is_optional = self.variables[index]
+            return ast.Call(func=ast.Name(id=func_name, ctx=ast.Load()),
+                            args=[ast.Constant(value=var_name), ast.Constant(value=is_optional)],
+                            keywords=[])
+
+        def _split_text(self, value: str) -> list:
+            parts = []
+
+            for i, piece in enumerate(re.split(r'%s(\d+)__' % _STATEMENT_VAR_PREFIX, value)):
+                if i % 2:
+                    call = self._var_call(_STATEMENT_TEXT_FUNC, int(piece))
+                    parts.append(ast.FormattedValue(value=call, conversion=-1, format_spec=None))
+                elif piece:
+                    parts.append(ast.Constant(value=piece))
+
+            return parts
+
+        def visit_Name(self, node: ast.Name):
+            if node.id.startswith(_STATEMENT_VAR_PREFIX):
+                index = int(node.id[len(_STATEMENT_VAR_PREFIX):-2])
+                return ast.copy_location(self._var_call(_STATEMENT_LITERAL_FUNC, index), node)
+
+            return node
+
+        def visit_Constant(self, node: ast.Constant):
+            if isinstance(node.value, str) and _STATEMENT_VAR_PREFIX in node.value:
+                return ast.copy_location(ast.JoinedStr(values=self._split_text(node.value)), node)
+
+            return node
+
+        def visit_JoinedStr(self, node: ast.JoinedStr):
+            values = []
+
+            for value in node.values:
+                if isinstance(value, ast.Constant) and isinstance(value.value, str):
+                    values.extend(self._split_text(value.value))
+                else:
+                    values.append(self.visit(value))
+
+            node.values = values
+            return node
+
+    return StatementTransformer
+
+
+def _validate_statement_ast(tree):
+    import ast
+
+    allowed_nodes = _get_statement_allowed_nodes()
+    allowed_names = set(STATEMENT_BUILTINS) | {_STATEMENT_TEXT_FUNC, _STATEMENT_LITERAL_FUNC}
+
+    for node in ast.walk(tree):
+        if not isinstance(node, allowed_nodes):
+            raise HappyPyException('不允许使用%s' % type(node).__name__)
+
+        if isinstance(node, ast.Name) and node.id not in allowed_names:
+            raise HappyPyException('不允许使用名称"%s"' % node.id)
+
+        if isinstance(node, ast.Attribute) and (node.attr.startswith('_') or node.attr in STATEMENT_DENIED_ATTRS):
+            raise HappyPyException('不允许访问属性"%s"' % node.attr)
+
+
+def _is_spliced_statement(segments: tuple) -> bool:
+    """
+    变量与字母、数字、下划线或另一个变量相连，或者与小数点组成数字
+    （比如 ${a}${b}、${n}0、${major}.${minor}）时，变量的文本是表达式的一部分，
+    不能作为独立的值读取
+    """
+    for i, seg in enumerate(segments):
+        if seg.__class__ is str:
+            continue
+
+        prev_seg = segments[i - 1] if i > 0 else ''
+        next_seg = segments[i + 1] if i + 1 < len(segments) else ''
+
+        if prev_seg.__class__ is tuple or next_seg.__class__ is tuple:
+            return True
+
+        if prev_seg and (prev_seg[-1].isalnum() or prev_seg[-1] in '_.'):
+            return True
 
-            tmp = tmp.replace(var_expr, var_value)
+        if next_seg and (next_seg[0].isalnum() or next_seg[0] == '_'):
+            return True
 
-    # 感叹号开头的变量，替换为空
-    while True:
-        m = re.match(r'.*(\${!?[a-zA-Z\d_]+}).*', tmp)
+        if next_seg.startswith('.') and (next_seg[1:2].isdigit() or (next_seg == '.' and i + 2 < len(segments))):
+            return True
 
-        if m and m.group(1)[:3] == '${!':
-            tmp = tmp.replace(m.group(1), '')
+    return False
+
+
+@lru_cache(maxsize=4096)
+def _compile_statement(expr_line: str, is_int: bool):
+    """
+    将语句解析为语法树，校验后编译为代码对象。变量在执行时读取，
+    相同的语句只编译一次。变量是表达式文本的一部分时返回 None，
+    执行时替换为变量的文本后再编译
+    """
+    import ast
+
+    template = _compile_var_template(expr_line)
+
+    if _is_spliced_statement(template.segments):
+        return None
+
+    variables = []
+    source_parts = []
+
+    for seg in template.segments:
+        if seg.__class__ is str:
+            source_parts.append(seg)
         else:
-            break
+            source_parts.append('%s%d__' % (_STATEMENT_VAR_PREFIX, len(variables)))
+            variables.append(seg)
+
+    source = ''.join(source_parts)
+
+    if is_int:
+        source = 'int(%s)' % source
+
+    tree = _get_statement_transformer_class()(variables).visit(ast.parse(source.strip(), mode='eval'))
+    ast.fix_missing_locations(tree)
+    _validate_statement_ast(tree)
+
+    return compile(tree, '<statement>', 'eval')
+
+
+@lru_cache(maxsize=4096)
+def _compile_spliced_statement(source: str, is_int: bool):
+    """
+    编译已替换变量文本的语句，与之前的版本一致
+    """
+    import ast
+
+    if is_int:
+        source = 'int(%s)' % source
+
+    tree = ast.parse(source.strip(), mode='eval')
+    _validate_statement_ast(tree)
+
+    return compile(tree, '<statement>', 'eval')
+
+
+class OutputCapture:
+    """
+    逐块接收命令输出：超过内存上限的部分写入临时文件，
+    按需逐行写入日志并匹配过滤器
+    """
+
+    def __init__(self, session: 'Session', pattern=None, stop_after_match: bool = False, memory_limit: int = None,
+                 encoding: str = 'UTF-8'):
+        import tempfile
+
+        self.session = session
+        self.pattern = pattern
+        self.stop_after_match = stop_after_match
+        self.memory_limit = session.engine.output_memory_limit if memory_limit is None else memory_limit
+        self.encoding = encoding
+        self.spool = tempfile.SpooledTemporaryFile(max_size=self.memory_limit)
+        self.size = 0
+        self.match = None
+        self.stopped = False
+        # 只有需要打印日志或匹配过滤器时，才按行切分输出
+        self.log_lines = session.is_stream_log_enabled()
+        self.split_stdout = self.log_lines or pattern is not None
+        self.stderr_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        self._stdout_partial = b''
+        self._stderr_partial = b''
+
+    def feed_stdout(self, data: bytes):
+        if self.stopped:
+            # 已匹配到过滤器，丢弃剩余输出
+            return
+
+        self.spool.write(data)
+        self.size += len(data)
+
+        if self.split_stdout:
+            lines, self._stdout_partial = self._split_lines(self._stdout_partial + data)
+
+            for line in lines:
+                self._on_stdout_line(line)
+
+                if self.stopped:
+                    self._stdout_partial = b''
+                    return
+
+    def feed_stderr(self, data: bytes):
+        lines, self._stderr_partial = self._split_lines(self._stderr_partial + data)
+
+        for line in lines:
+            self._on_stderr_line(line)
+
+    def _split_lines(self, data: bytes) -> (list, bytes):
+        end = data.rfind(b'\n')
+
+        if end == -1:
+            # 没有换行符的超长行，按内存上限切分
+            if len(data) > self.memory_limit:
+                return [str(data, self.encoding, errors='replace')], b''
+
+            return [], data
+
+        return str(data[:end], self.encoding, errors='replace').split('\n'), data[end + 1:]
+
+    def _on_stdout_line(self, line: str):
+        if self.log_lines:
+            self.session.stream_log(self.session.build_message_no_status('[标准输出] %s' % line))
+
+        if self.pattern is not None and self.match is None:
+            self.match = self.pattern.match(line)
 
-    m = re.match(r'.*(\${[a-zA-Z\d_]+}).*', tmp)
+            if self.match is not None and self.stop_after_match:
+                self.stopped = True
 
-    if m:
-        log.error('存在未替换的变量：%s' % m.group(1))
-        raise HappyPyException(_output_message_builder(tmp, False))
+    def _on_stderr_line(self, line: str):
+        self.stderr_tail.append(line)
 
-    return tmp
+        if self.log_lines:
+            self.session.stream_log(self.session.build_message_no_status('[标准错误] %s' % line))
+
+    def close(self):
+        if self._stdout_partial and not self.stopped:
+            self._on_stdout_line(str(self._stdout_partial, self.encoding, errors='replace'))
+
+        if self._stderr_partial:
+            self._on_stderr_line(str(self._stderr_partial, self.encoding, errors='replace'))
+
+        self._stdout_partial = b''
+        self._stderr_partial = b''
+
+    def release(self):
+        self.spool.close()
+
+    def get_output(self) -> str:
+        # 与 execute_cmd(remove_white_char='\n') 一致，移除首尾空白字符
+        self.spool.seek(0)
+        return str(self.spool.read(), self.encoding, errors='replace').strip()
+
+    def get_stdout_tail(self) -> str:
+        self.spool.seek(max(0, self.size - OUTPUT_TAIL_BYTES))
+        lines = str(self.spool.read(), self.encoding, errors='replace').strip().split('\n')
+        return '\n'.join(lines[-OUTPUT_TAIL_LINES:])
+
+    def get_match(self):
+        if self.match is not None or self.pattern is None:
+            return self.match
+
+        # 没有任何一行匹配时，兼容旧版本，在内存中的完整输出上匹配一次
+        if self.size <= self.memory_limit:
+            return self.pattern.match(self.get_output())
+
+        return None
+
+
+EXIT_CODE_TIMEOUT = 124
+DEFAULT_KILL_GRACE = 5.0
+GUARD_POLL_INTERVAL = 0.5
+
+
+class RowTimeoutError(HappyPyException):
+    """
+    RUN行执行超时，命令已被终止
+    """
+    exit_code = EXIT_CODE_TIMEOUT
+
+
+class RunCancelledError(HappyPyException):
+    """
+    收到 SIGINT、SIGTERM 信号，取消执行
+    """
+
+    def __init__(self, signum: int):
+        self.exit_code = 128 + signum
+        super().__init__('收到%s信号，取消执行' % signal.Signals(signum).name)
+
+
+class RowAbortedError(HappyPyException):
+    """
+    并行执行时其它行执行失败，正在执行的命令被终止
+    """
+
+    def __init__(self):
+        super().__init__('其它行执行失败，已终止')
+
+
+def _pidfd_open(pid: int):
+    # 进程退出后 pidfd 可读，需要 Linux 5.3 以上
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+class ProcessGuard:
+    """
+    监视正在执行的命令：超时或取消执行时，向命令的进程组发送 SIGTERM，
+    超过宽限期后发送 SIGKILL
+    """
+
+    def __init__(self, session: 'Session', timeout: float = None):
+        self.session = session
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.kill_at = None
+        self.proc = None
+        self.timed_out = False
+        self.cancelled = False
+        self.aborted = False
+
+    def watch(self, proc):
+        self.proc = proc
+        self.session.add_guard(self)
+
+    def release(self):
+        self.session.remove_guard(self)
+
+    def cancel(self):
+        self.cancelled = True
+        self.terminate(signal.SIGTERM)
+
+    def abort(self):
+        self.aborted = True
+        self.terminate(signal.SIGTERM)
+
+    def terminate(self, sig: int):
+        if self.proc is None:
+            return
+
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            # 进程已退出
+            pass
+
+    def check(self) -> float:
+        """
+        检查是否需要终止命令，返回距下次检查的秒数
+        """
+        now = time.monotonic()
+
+        if self.kill_at is None:
+            if self.session.cancel_signal is not None:
+                self.cancelled = True
+            elif self.session.aborting:
+                self.aborted = True
+            elif self.deadline is not None and now >= self.deadline:
+                self.timed_out = True
+
+            if self.cancelled or self.aborted or self.timed_out:
+                self.terminate(signal.SIGTERM)
+                self.kill_at = now + self.session.engine.kill_grace
+        elif now >= self.kill_at:
+            self.terminate(signal.SIGKILL)
+            self.kill_at = float('inf')
+
+        wake = self.kill_at if self.kill_at is not None else self.deadline
+
+        if wake is None:
+            return GUARD_POLL_INTERVAL
+
+        return max(0.0, min(GUARD_POLL_INTERVAL, wake - now))
+
+
+class ShellSession:
+    """
+    常驻的 bash 协进程，用会话内唯一的分隔标记区分每条命令的输出和返回代码
+    """
+
+    def __init__(self, shell: str = 'bash', logger=None):
+        import uuid
+
+        self.shell = shell
+        self.log = logger if logger is not None else log
+        self.proc = None
+        # 启动会话时的环境变量快照，之后只同步ENV行设置的环境变量
+        self.base_env = None
+        self.overlay_sent = dict()
+        self.cwd = None
+        self.lock = threading.Lock()
+        # 上一条命令的分隔标记都读取完才会执行下一条命令，
+        # 整个会话使用同一个分隔标记
+        self.sentinel = '__RAIN_%s__' % uuid.uuid4().hex
+        self.script_suffix = ('__rain_rc=$?\n'
+                              'printf "\\n%s %%d\\n" "$__rain_rc"\n'
+                              'printf "\\n%s\\n" >&2\n') % (self.sentinel, self.sentinel)
+        self.stdout_end = None
+        self.stderr_end = None
+
+    def start(self, base_env: dict = None, cwd: str = None):
+        import subprocess
+
+        # 独立的进程组，超时或取消执行时终止整个会话
+        self.proc = subprocess.Popen([self.shell, '--noprofile', '--norc'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     env=base_env,
+                                     cwd=cwd,
+                                     start_new_session=True)
+        self.base_env = dict(os.environ if base_env is None else base_env)
+        self.overlay_sent = dict()
+        self.cwd = cwd
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def close(self):
+        import subprocess
+
+        if self.proc is None:
+            return
+
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.proc = None
+
+    def _build_env_script(self, overlay: dict) -> str:
+        # 只同步ENV行设置的环境变量与上次发送时的差异，被删除的变量恢复为启动时的值
+        if overlay == self.overlay_sent:
+            return ''
+
+        lines = []
+
+        for name, value in overlay.items():
+            if self.overlay_sent.get(name) != value:
+                lines.append('export %s=%s' % (name, shlex.quote(value)))
+
+        for name in self.overlay_sent:
+            if name not in overlay:
+                if name in self.base_env:
+                    lines.append('export %s=%s' % (name, shlex.quote(self.base_env[name])))
+                else:
+                    lines.append('unset %s' % name)
+
+        self.overlay_sent = dict(overlay)
+        return ''.join(line + '\n' for line in lines)
+
+    def execute(self, cmd: str, capture: OutputCapture, overlay: dict = None, guard: ProcessGuard = None) -> int:
+        """
+        在会话中执行命令，overlay 为ENV行设置的环境变量
+        """
+        with self.lock:
+            if not self.is_alive():
+                self.start(self.base_env, self.cwd)
+
+            if guard is not None:
+                guard.watch(self.proc)
+
+            script = self._build_env_script(overlay or {})
+            # eval 保证命令存在语法错误时，不会破坏分隔标记
+            script += 'eval %s </dev/null\n' % shlex.quote(cmd)
+            script += self.script_suffix
+
+            try:
+                self.proc.stdin.write(script.encode(capture.encoding))
+                self.proc.stdin.flush()
+            except BrokenPipeError:
+                return_code = self.proc.wait()
+                self.close()
+                return return_code
+
+            return_code = self._read_until(capture, guard)
+
+            if return_code is None:
+                # 命令中执行了 exit 等操作，或超时被终止，会话已退出，下次执行时重新启动
+                return_code = self.proc.wait()
+                self.close()
+
+                if guard is None or not (guard.timed_out or guard.cancelled):
+                    self.log.warning('shell会话已退出（%d），下次执行命令时重新启动' % return_code)
+
+            return return_code
+
+    def _read_until(self, capture: OutputCapture, guard: ProcessGuard = None):
+        """
+        转发输出直到两个管道都读到分隔标记，返回命令的返回代码。会话退出时返回 None
+        """
+        import selectors
+
+        if self.stdout_end is None:
+            sentinel = self.sentinel.encode(capture.encoding)
+            self.stdout_end = re.compile(b'\n' + re.escape(sentinel) + b' (-?\\d+)\n$')
+            self.stderr_end = b'\n' + sentinel + b'\n'
+
+        stdout_end, stderr_end = self.stdout_end, self.stderr_end
+        # 保留末尾可能属于分隔标记的字节，不转发
+        holdback = len(stderr_end) + 16
+        stdout_fd, stderr_fd = self.proc.stdout.fileno(), self.proc.stderr.fileno()
+        pending = {stdout_fd: bytearray(), stderr_fd: bytearray()}
+        feeds = {stdout_fd: capture.feed_stdout, stderr_fd: capture.feed_stderr}
+        return_code = None
+
+        with selectors.DefaultSelector() as sel:
+            for fd in pending:
+                sel.register(fd, selectors.EVENT_READ)
+
+            while pending:
+                for key, _ in sel.select(guard.check() if guard is not None else None):
+                    fd = key.fd
+                    data = os.read(fd, 65536)
+
+                    if not data:
+                        for rest_fd, buf in pending.items():
+                            feeds[rest_fd](bytes(buf))
+
+                        return None
+
+                    buf = pending[fd]
+                    buf += data
+
+                    if fd == stdout_fd:
+                        m = stdout_end.search(buf)
+                        end = m.start() if m else -1
+
+                        if m:
+                            return_code = int(m.group(1))
+                    else:
+                        end = len(buf) - len(stderr_end) if buf.endswith(stderr_end) else -1
+
+                    if end != -1:
+                        feeds[fd](bytes(buf[:end]))
+                        del pending[fd]
+                        sel.unregister(fd)
+                    elif len(buf) > holdback:
+                        feeds[fd](bytes(buf[:-holdback]))
+                        del buf[:-holdback]
+
+        return return_code
+
+
+SHELL_BACKEND_SPAWN = 'spawn'
+SHELL_BACKEND_SESSION = 'session'
+SHELL_BACKENDS = (SHELL_BACKEND_SPAWN, SHELL_BACKEND_SESSION)
+# RUN行的执行方式：自动判断、总是通过shell、总是直接执行（不经过shell）
+EXEC_MODE_AUTO = 'auto'
+EXEC_MODE_SHELL = 'shell'
+EXEC_MODE_DIRECT = 'direct'
+EXEC_MODES = (EXEC_MODE_AUTO, EXEC_MODE_SHELL, EXEC_MODE_DIRECT)
+# 管道、重定向、变量、命令替换、通配符、转义、注释、波浪号等需要shell处理的字符
+_SHELL_META_PATTERN = re.compile(r'[|&;<>()$`\\*?\[\]{}~#\n]')
+# shell内置命令和关键字，与同名的可执行文件行为不同或者没有对应的可执行文件
+SHELL_ONLY_COMMANDS = frozenset((
+    '.', ':', '[', '[[', '!', '{', '}', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue', 'do', 'done',
+    'echo', 'elif', 'else', 'esac', 'eval', 'exec', 'exit', 'export', 'false', 'fg', 'fi', 'for', 'function',
+    'getopts', 'hash', 'if', 'jobs', 'kill', 'local', 'printf', 'pwd', 'read', 'readonly', 'return', 'select', 'set',
+    'shift', 'source', 'test', 'then', 'time', 'times', 'trap', 'true', 'type', 'ulimit', 'umask', 'unalias', 'unset',
+    'until', 'wait', 'while',
+))
+# 命令输出在内存中保留的最大字节数，超出部分写入临时文件
+DEFAULT_OUTPUT_MEMORY_LIMIT = 1024 * 1024
+# 命令执行失败时，日志中打印的最后几行输出
+OUTPUT_TAIL_LINES = 20
+OUTPUT_TAIL_BYTES = 64 * 1024
+# 直接执行命令时，exec 失败的这些错误交给shell处理：
+# 命令不存在、没有执行权限、没有 #! 行的脚本
+DIRECT_EXEC_FALLBACK_ERRNOS = frozenset((errno.ENOENT, errno.EACCES, errno.EPERM, errno.ENOEXEC))
+
+
+@lru_cache(maxsize=4096)
+def split_direct_command(expr_line: str):
+    """
+    不需要shell处理的简单命令，返回参数元组，否则返回None
+    """
+    if _SHELL_META_PATTERN.search(expr_line):
+        return None
+
+    try:
+        argv = shlex.split(expr_line)
+    except ValueError:
+        return None
+
+    # 第一个单词为 NAME=VALUE 时是设置环境变量
+    if not argv or argv[0] in SHELL_ONLY_COMMANDS or '=' in argv[0]:
+        return None
+
+    return tuple(argv)
+
+
+def _waitstatus_to_exitcode(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
 
 
 class ColInfo(Enum):
@@ -92,7 +804,9 @@ class ColInfo(Enum):
     ReturnFilter = '过滤器'
     VarName = '变量名'
     Message = '提示消息'
-    __order__ = 'ModeType Expr ReturnCode ReturnType DefaultValue ReturnFilter VarName Message'
+    # 可选列，格式为 key=value;key
+    Options = '选项'
+    __order__ = 'ModeType Expr ReturnCode ReturnType DefaultValue ReturnFilter VarName Message Options'
 
 
 class ModeType(Enum):
@@ -104,6 +818,16 @@ class ModeType(Enum):
     STATEMENT = 5
     # 复制文件
     COPY = 6
+    # 包含其它CSV文件
+    INCLUDE = 7
+    # 循环执行到END行之间的行
+    FOREACH = 8
+    # 块结束
+    END = 9
+    # 条件成立时执行到ELSE或END行之间的行
+    IF = 10
+    # 条件不成立时执行到END行之间的行
+    ELSE = 11
 
 
 class ReturnType(Enum):
@@ -113,6 +837,9 @@ class ReturnType(Enum):
 
 
 class CsvRow:
+    __slots__ = ('mode_type', 'expr_line', 'return_code', 'return_type', 'default_value', 'return_filter',
+                 'var_name', 'message', 'options', 'line_number', 'filter_pattern', 'body', 'end')
+
     def __init__(self,
                  mode_type: ModeType,
                  expr_line: str,
@@ -121,7 +848,9 @@ class CsvRow:
                  default_value: str,
                  return_filter: str,
                  var_name: str,
-                 message: str):
+                 message: str,
+                 options: str = NULL_VALUE,
+                 line_number: int = 0):
         self.mode_type: ModeType = mode_type
         self.expr_line = expr_line
         self.return_code = return_code
@@ -131,167 +860,241 @@ class CsvRow:
         self.return_filter = return_filter
         self.var_name = var_name
         self.message = message
+        self.options = _parse_row_options(options)
+        self.line_number = line_number
+        # 不含变量的过滤器预先编译
+        self.filter_pattern = _compile_return_filter(return_filter)
+        # 块开始的行：块内的行和结束块的行
+        self.body = ()
+        self.end = None
+
+    def to_list(self) -> list:
+        return [self.mode_type.name, self.expr_line, self.return_code, self.return_type.name,
+                self.default_value, self.return_filter, self.var_name, self.message,
+                _format_row_options(self.options)]
+
+    def has_option(self, name: str) -> bool:
+        return name in self.options
+
+
+def _parse_row_options(value: str) -> dict:
+    options = {}
+
+    if value == NULL_VALUE:
+        return options
+
+    for item in value.split(';'):
+        item = item.strip()
+
+        if not item:
+            continue
+
+        name, _, option_value = item.partition('=')
+        options[name.strip()] = option_value.strip()
+
+    return options
+
+
+def _format_row_options(options: dict) -> str:
+    if not options:
+        return NULL_VALUE
+
+    return ';'.join(('%s=%s' % (k, v)) if v else k for k, v in options.items())
+
+
+def _compile_return_filter(return_filter: str):
+    if return_filter == NULL_VALUE or _VAR_EXPR_PATTERN.search(return_filter):
+        return None
+
+    try:
+        return re.compile(return_filter)
+    except re.error:
+        # 由行校验函数报告错误
+        return None
 
 
 class ColValidator:
     @staticmethod
-    def validate_mode_type(value: str):
+    def validate_mode_type(session: 'Session', value: str):
         try:
             # noinspection PyUnusedLocal
             tmp = ModeType[value]
         except KeyError:
-            msg = '第%d行->%s：无效值"%s"，可选值为CONST、VAR、ENV、RUN、MESSAGE、STATEMENT、COPY' \
-                  % (line_number, ColInfo.ModeType.value, value)
+            msg = '第%d行->%s：无效值"%s"，可选值为CONST、VAR、ENV、RUN、MESSAGE、STATEMENT、' \
+                  'COPY、INCLUDE、FOREACH、END、IF、ELSE' % (session.line_number, ColInfo.ModeType.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_expr_line(value: str):
+    def validate_expr_line(session: 'Session', value: str):
         if not (value or value == NULL_VALUE):
-            msg = '第%d行->%s：无效值"%s"，可以为NULL或非字符串' % (line_number, ColInfo.Expr.value, value)
+            msg = '第%d行->%s：无效值"%s"，可以为NULL或非字符串' \
+                  % (session.line_number, ColInfo.Expr.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_return_code(value: str):
+    def validate_return_code(session: 'Session', value: str):
         if not (value and (value == NULL_VALUE or value.isdigit())):
-            msg = '第%d行->%s：无效值"%s"，只能是数字' % (line_number, ColInfo.ReturnCode.value, value)
+            msg = '第%d行->%s：无效值"%s"，只能是数字' \
+                  % (session.line_number, ColInfo.ReturnCode.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_return_type(value: str):
+    def validate_return_type(session: 'Session', value: str):
         try:
             # noinspection PyUnusedLocal
             tmp = ReturnType[value]
         except KeyError:
-            msg = '第%d行->%s：无效值"%s"，可选值为NULL、INT、STR' % (line_number, ColInfo.ReturnType.value, value)
+            msg = '第%d行->%s：无效值"%s"，可选值为NULL、INT、STR' \
+                  % (session.line_number, ColInfo.ReturnType.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_default_value(value: str):
+    def validate_default_value(session: 'Session', value: str):
         if not (value or value == NULL_VALUE):
-            msg = '第%d行->%s：无效值"%s"，可以为NULL或非空字符串' % (line_number, ColInfo.DefaultValue.value, value)
+            msg = '第%d行->%s：无效值"%s"，可以为NULL或非空字符串' \
+                  % (session.line_number, ColInfo.DefaultValue.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_return_filter(value: str):
+    def validate_return_filter(session: 'Session', value: str):
         if not (value or value == NULL_VALUE):
-            msg = '第%d行->%s：无效值"%s"，可以为NULL或不为空的字符串' % (line_number, ColInfo.ReturnFilter.value, value)
+            msg = '第%d行->%s：无效值"%s"，可以为NULL或不为空的字符串' \
+                  % (session.line_number, ColInfo.ReturnFilter.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_var_name(value: str):
+    def validate_var_name(session: 'Session', value: str):
         if not (value and (value == NULL_VALUE or _is_alpha_num_underline_str(value))):
-            msg = '第%d行->%s：无效值"%s"，只能由数字、字母和下划线组成' % (line_number, ColInfo.VarName.value, value)
+            msg = '第%d行->%s：无效值"%s"，只能由数字、字母和下划线组成' \
+                  % (session.line_number, ColInfo.VarName.value, value)
             raise HappyPyException(msg)
 
     @staticmethod
-    def validate_message(value: str):
+    def validate_message(session: 'Session', value: str):
         if not value:
-            msg = '第%d行->%s：无效值"%s"，只能是非空字符串' % (line_number, ColInfo.Message.value, value)
+            msg = '第%d行->%s：无效值"%s"，只能是非空字符串' \
+                  % (session.line_number, ColInfo.Message.value, value)
             raise HappyPyException(msg)
 
+    @staticmethod
+    def validate_options(session: 'Session', value: str):
+        if value == NULL_VALUE:
+            return
+
+        for name in _parse_row_options(value):
+            if name not in ROW_OPTION_MODES:
+                msg = '第%d行->%s：无效值"%s"，可选项为%s' \
+                      % (session.line_number, ColInfo.Options.value, name, '、'.join(ROW_OPTION_MODES))
+                raise HappyPyException(msg)
+
 
 class RowValidator:
     @staticmethod
-    def validate_const_row(row: CsvRow):
+    def validate_const_row(session: 'Session', row: CsvRow):
         assert row.mode_type == ModeType.CONST
         row_desc = '常量'
 
         if row.expr_line != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.Expr.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.Expr.value, NULL_VALUE)
 
         if row.return_code != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
 
         if row.return_type == ReturnType.NULL:
-            _make_error_message_required(row_desc, ColInfo.ReturnType.value)
+            _make_error_message_required(session, row_desc, ColInfo.ReturnType.value)
 
         if not row.default_value or row.default_value == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.DefaultValue.value)
+            _make_error_message_required(session, row_desc, ColInfo.DefaultValue.value)
 
         if row.return_filter != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
 
         if row.var_name == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.VarName.value)
+            _make_error_message_required(session, row_desc, ColInfo.VarName.value)
 
         if row.message == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Message.value)
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
 
     @staticmethod
-    def validate_message_row(row: CsvRow):
+    def validate_message_row(session: 'Session', row: CsvRow):
         assert row.mode_type == ModeType.MESSAGE
         row_desc = '消息'
 
         if row.expr_line != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.Expr.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.Expr.value, NULL_VALUE)
 
         if row.return_code != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
 
         if row.return_type != ReturnType.NULL:
-            _make_error_message(row_desc, ColInfo.ReturnType.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
 
         if row.default_value != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
 
         if row.return_filter != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
 
         if row.var_name != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.VarName.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.VarName.value, NULL_VALUE)
 
         if row.message == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Message.value)
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
 
     @staticmethod
-    def validate_env_row(row: CsvRow):
+    def validate_env_row(session: 'Session', row: CsvRow):
         assert row.mode_type == ModeType.ENV
         row_desc = '环境变量'
 
         if row.expr_line != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.Expr.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.Expr.value, NULL_VALUE)
 
         if row.return_code != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
 
         if row.return_type != ReturnType.NULL:
-            _make_error_message(row_desc, ColInfo.ReturnType.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
 
         if row.default_value == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.DefaultValue.value)
+            _make_error_message_required(session, row_desc, ColInfo.DefaultValue.value)
 
         if row.return_filter != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
 
         if row.var_name == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.VarName.value)
+            _make_error_message_required(session, row_desc, ColInfo.VarName.value)
 
         if row.message == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Message.value)
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
 
     @staticmethod
-    def validate_run_row(row: CsvRow):
+    def validate_run_row(session: 'Session', row: CsvRow):
         assert row.mode_type == ModeType.RUN
         row_desc = '命令'
 
         if row.expr_line == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Expr.value)
+            _make_error_message_required(session, row_desc, ColInfo.Expr.value)
 
         if row.return_code == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.ReturnCode.value)
+            _make_error_message_required(session, row_desc, ColInfo.ReturnCode.value)
 
         # 忽略 row.return_type
 
         if row.default_value != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
 
         if row.return_filter != NULL_VALUE:
+            if row.filter_pattern is None and not _VAR_EXPR_PATTERN.search(row.return_filter):
+                msg = '第%d行->%s：无效的正则表达式"%s"' \
+                      % (session.line_number, ColInfo.ReturnFilter.value, row.return_filter)
+                raise HappyPyException(msg)
+
             # 设置了过滤器时，必须指定变量名和返回类型
             if row.var_name == NULL_VALUE:
-                _make_error_message_required(row_desc, ColInfo.VarName.value)
+                _make_error_message_required(session, row_desc, ColInfo.VarName.value)
 
             if row.return_type == NULL_VALUE:
-                _make_error_message_required(row_desc, ColInfo.ReturnType.value)
+                _make_error_message_required(session, row_desc, ColInfo.ReturnType.value)
         else:
             # 其它情况忽略 row.var_name
             pass
@@ -299,280 +1102,611 @@ class RowValidator:
         # 设置了变量名时，必须设置返回类型
         if row.var_name != NULL_VALUE:
             if row.return_type == NULL_VALUE:
-                _make_error_message_required(row_desc, ColInfo.ReturnType.value)
+                _make_error_message_required(session, row_desc, ColInfo.ReturnType.value)
+
+        timeout = row.options.get(ROW_OPTION_TIMEOUT)
+
+        if timeout is not None and not _is_positive_number(timeout):
+            msg = '第%d行->%s"%s"：无效值"%s"，应为正数' \
+                  % (session.line_number, ColInfo.Options.value, ROW_OPTION_TIMEOUT, timeout)
+            raise HappyPyException(msg)
+
+        exec_mode = row.options.get(ROW_OPTION_EXEC)
+
+        if exec_mode is not None and exec_mode not in EXEC_MODES:
+            msg = '第%d行->%s"%s"：无效值"%s"，可选值为%s' \
+                  % (session.line_number, ColInfo.Options.value, ROW_OPTION_EXEC, exec_mode, '、'.join(EXEC_MODES))
+            raise HappyPyException(msg)
 
         if row.message == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Message.value)
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
 
     @staticmethod
-    def validate_statement_row(row: CsvRow):
+    def validate_statement_row(session: 'Session', row: CsvRow):
         assert row.mode_type == ModeType.STATEMENT
         row_desc = '语句'
 
         if row.expr_line == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Expr.value)
+            _make_error_message_required(session, row_desc, ColInfo.Expr.value)
 
         if row.return_code != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
 
         if row.return_filter != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
 
         if row.message == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Message.value)
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
+
+        # 执行前检查语法和允许使用的语法节点
+        try:
+            _compile_statement(row.expr_line, row.return_type == ReturnType.INT)
+        except (SyntaxError, ValueError, HappyPyException) as e:
+            msg = '第%d行->%s：无效的语句"%s"：%s' \
+                  % (session.line_number, ColInfo.Expr.value, row.expr_line, e)
+            raise HappyPyException(msg)
 
     @staticmethod
-    def validate_copy_row(row: CsvRow):
+    def validate_copy_row(session: 'Session', row: CsvRow):
         assert row.mode_type == ModeType.COPY
         row_desc = '复制'
 
         if row.expr_line == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Expr.value)
+            _make_error_message_required(session, row_desc, ColInfo.Expr.value)
 
         if row.return_code != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
 
         if row.default_value != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
 
         if row.return_filter != NULL_VALUE:
-            _make_error_message(row_desc, ColInfo.ReturnType.value, NULL_VALUE)
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
 
         if row.var_name != NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.VarName.value)
+            _make_error_message_required(session, row_desc, ColInfo.VarName.value)
+
+        copy_mode = row.options.get(ROW_OPTION_COPY)
+
+        if copy_mode is not None and copy_mode not in COPY_MODES:
+            msg = '第%d行->%s"%s"：无效值"%s"，可选值为%s' \
+                  % (session.line_number, ColInfo.Options.value, ROW_OPTION_COPY, copy_mode, '、'.join(COPY_MODES))
+            raise HappyPyException(msg)
+
+        copy_jobs = row.options.get(ROW_OPTION_COPY_JOBS)
+
+        if copy_jobs is not None and not (copy_jobs.isdigit() and int(copy_jobs) > 0):
+            msg = '第%d行->%s"%s"：无效值"%s"，应为正整数' \
+                  % (session.line_number, ColInfo.Options.value, ROW_OPTION_COPY_JOBS, copy_jobs)
+            raise HappyPyException(msg)
 
         if row.message == NULL_VALUE:
-            _make_error_message_required(row_desc, ColInfo.Message.value)
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
 
+    @staticmethod
+    def validate_include_row(session: 'Session', row: CsvRow):
+        assert row.mode_type == ModeType.INCLUDE
+        row_desc = '包含'
+
+        if row.expr_line == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.Expr.value)
+
+        if row.return_code != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+
+        if row.return_type != ReturnType.NULL:
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
+
+        if row.default_value != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+
+        if row.return_filter != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+
+        if row.var_name != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.VarName.value, NULL_VALUE)
+
+        if row.message == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
 
-class RowHandler:
     @staticmethod
-    def const_handler(row: CsvRow):
-        global _var_tmp_storage_area
+    def validate_foreach_row(session: 'Session', row: CsvRow):
+        assert row.mode_type == ModeType.FOREACH
+        row_desc = '循环'
 
-        fn_name = inspect.stack()[0][3]
-        log.enter_func(fn_name)
+        if row.expr_line == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.Expr.value)
 
-        log.var('row', row)
+        if row.return_code != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
 
-        message = _replace_var(row.message)
-        log.var('message', message)
+        if row.return_type != ReturnType.NULL:
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
 
-        var_name = row.var_name
-        var_value = _replace_var(row.default_value)
-        log.var('var_name', var_name)
-        log.var('var_value', var_value)
-
-        if row.return_type == ReturnType.INT:
-            _var_tmp_storage_area[var_name] = int(var_value)
-        elif row.return_type == ReturnType.STR:
-            _var_tmp_storage_area[var_name] = var_value
-        else:
-            _var_tmp_storage_area[var_name] = var_value
+        if row.default_value != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+
+        if row.return_filter != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+
+        if row.var_name == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.VarName.value)
+
+        for name in (ROW_OPTION_PARALLEL, ROW_OPTION_BATCH):
+            value = row.options.get(name)
+
+            if value is not None and not (value.isdigit() and int(value) > 0):
+                msg = '第%d行->%s"%s"：无效值"%s"，应为正整数' \
+                      % (session.line_number, ColInfo.Options.value, name, value)
+                raise HappyPyException(msg)
+
+        if row.message == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
+
+    @staticmethod
+    def validate_if_row(session: 'Session', row: CsvRow):
+        assert row.mode_type == ModeType.IF
+        row_desc = '条件'
+
+        if row.expr_line == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.Expr.value)
+
+        if row.return_code != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+
+        if row.return_filter != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+
+        if row.var_name != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.VarName.value, NULL_VALUE)
+
+        if row.message == NULL_VALUE:
+            _make_error_message_required(session, row_desc, ColInfo.Message.value)
+
+        # 条件与STATEMENT行的语句相同，执行前检查语法
+        try:
+            _compile_statement(row.expr_line, row.return_type == ReturnType.INT)
+        except (SyntaxError, ValueError, HappyPyException) as e:
+            msg = '第%d行->%s：无效的条件"%s"：%s' \
+                  % (session.line_number, ColInfo.Expr.value, row.expr_line, e)
+            raise HappyPyException(msg)
+
+    @staticmethod
+    def validate_else_row(session: 'Session', row: CsvRow):
+        assert row.mode_type == ModeType.ELSE
+        row_desc = '条件分支'
 
-        log.info(_output_message_builder(message, True))
+        # 提示信息可以为NULL
+        if row.expr_line != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.Expr.value, NULL_VALUE)
+
+        if row.return_code != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+
+        if row.return_type != ReturnType.NULL:
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
+
+        if row.default_value != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+
+        if row.return_filter != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+
+        if row.var_name != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.VarName.value, NULL_VALUE)
+
+    @staticmethod
+    def validate_end_row(session: 'Session', row: CsvRow):
+        assert row.mode_type == ModeType.END
+        row_desc = '块结束'
+
+        # 提示信息可以为NULL
+        if row.expr_line != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.Expr.value, NULL_VALUE)
+
+        if row.return_code != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnCode.value, NULL_VALUE)
+
+        if row.return_type != ReturnType.NULL:
+            _make_error_message(session, row_desc, ColInfo.ReturnType.value, NULL_VALUE)
+
+        if row.default_value != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.DefaultValue.value, NULL_VALUE)
+
+        if row.return_filter != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.ReturnFilter.value, NULL_VALUE)
+
+        if row.var_name != NULL_VALUE:
+            _make_error_message(session, row_desc, ColInfo.VarName.value, NULL_VALUE)
+
+    @staticmethod
+    def validate_row_options(session: 'Session', row: CsvRow):
+        for name in row.options:
+            if row.mode_type not in ROW_OPTION_MODES[name]:
+                msg = '第%d行->%s模式的行不支持%s"%s"' \
+                      % (session.line_number, row.mode_type.name, ColInfo.Options.value, name)
+                raise HappyPyException(msg)
 
-        log.exit_func(fn_name)
 
+class RowHandler:
     @staticmethod
-    def message_handler(row: CsvRow):
-        fn_name = inspect.stack()[0][3]
-        log.enter_func(fn_name)
+    @traced
+    def const_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
+
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
+
+        var_name = row.var_name
 
-        log.var('row', row)
+        # 矩阵执行时预设的变量，不被CONST行覆盖，但按CONST行的返回类型转换
+        if var_name in session.pinned_vars:
+            session.vars.set(var_name, session.vars[var_name], row.return_type)
+            session.log.info(session.build_message('%s（使用矩阵变量：%s=%s）'
+                                                   % (message, var_name, session.vars[var_name]), True))
+            return
 
-        message = _replace_var(row.message)
-        log.var('message', message)
+        var_value = session.replace_var(row.default_value)
 
-        log.info(_output_message_builder_no_status(message))
+        if session.tracing:
+            session.log.var('var_name', var_name)
+            session.log.var('var_value', var_value)
 
-        log.exit_func(fn_name)
+        session.vars.set(var_name, var_value, row.return_type)
+
+        session.log.info(session.build_message(message, True))
 
     @staticmethod
-    def env_handler(row: CsvRow):
-        import os
-        fn_name = inspect.stack()[0][3]
-        log.enter_func(fn_name)
+    @traced
+    def message_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
+
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
 
-        log.var('row', row)
+        session.log.info(session.build_message_no_status(message))
+
+    @staticmethod
+    @traced
+    def env_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
 
-        message = _replace_var(row.message)
-        log.var('message', message)
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
 
         env_name = row.var_name
-        env_value = _replace_var(row.default_value)
-        log.var('env_name', env_name)
-        log.var('env_value', env_value)
+        env_value = session.replace_var(row.default_value)
+
+        if session.tracing:
+            session.log.var('env_name', env_name)
+            session.log.var('env_value', env_value)
 
         try:
-            os.environ[env_name] = env_value
-            log.info(_output_message_builder(message, True))
+            session.vars.set_env(env_name, env_value)
+            session.log.info(session.build_message(message, True))
         except Exception as e:
-            log.critical(e)
-            raise HappyPyException(_output_message_builder(message, False))
-
-        log.exit_func(fn_name)
+            session.log.critical(e)
+            raise HappyPyException(session.build_message(message, False))
 
     @staticmethod
-    def run_handler(row: CsvRow):
-        fn_name = inspect.stack()[0][3]
-        log.enter_func(fn_name)
+    @traced
+    def run_handler(session: 'Session', row: CsvRow):
+        import subprocess
 
-        log.var('row', row)
+        message = session.replace_var(row.message)
 
-        message = _replace_var(row.message)
-        log.var('message', message)
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
 
-        expr_line = _replace_var(row.expr_line)
+        expr_line = session.replace_var(row.expr_line)
         expected_return_code = int(row.return_code)
         expected_return_type = row.return_type
-        return_filter = _replace_var(row.return_filter)
+        return_filter = session.replace_var(row.return_filter)
         save_var_name = row.var_name
-        log.var('expr_line', expr_line)
-        log.var('expected_return_code', expected_return_code)
-        log.var('expected_return_type', expected_return_type)
-        log.var('return_filter', return_filter)
-        log.var('save_var_name', save_var_name)
 
-        return_code, result = execute_cmd(expr_line, remove_white_char='\n')
-        log.var('return_code', return_code)
-        log.var('result', result)
+        if session.tracing:
+            session.log.var('expr_line', expr_line)
+            session.log.var('expected_return_code', expected_return_code)
+            session.log.var('expected_return_type', expected_return_type)
+            session.log.var('return_filter', return_filter)
+            session.log.var('save_var_name', save_var_name)
+
+        if return_filter != NULL_VALUE and save_var_name != NULL_VALUE:
+            pattern = row.filter_pattern or re.compile(return_filter)
+        else:
+            pattern = None
+
+        result_cache = session.engine.result_cache
+        cache_key = None
+
+        if result_cache is not None and ResultCache.is_cached_row(row):
+            cache_key = result_cache.make_key(session, row, expr_line)
+
+            if session.tracing:
+                session.log.var('cache_key', cache_key)
+
+            if result_cache.restore(session, cache_key, row):
+                session.log.info(session.build_message('%s（使用缓存结果）' % message, True))
+                return
+
+        timeout = float(row.options[ROW_OPTION_TIMEOUT]) if row.has_option(ROW_OPTION_TIMEOUT) \
+            else session.engine.timeout
+
+        if session.tracing:
+            session.log.var('timeout', timeout)
+
+        capture = OutputCapture(session, pattern, row.has_option(ROW_OPTION_STOP_AFTER_MATCH))
+
+        try:
+            return_code = session.execute_cmd(expr_line, capture, timeout,
+                                              row.options.get(ROW_OPTION_EXEC, EXEC_MODE_AUTO))
+
+            if session.tracing:
+                session.log.var('return_code', return_code)
+                session.log.var('output_size', capture.size)
+
+            RowHandler._save_run_result(session, row, message, expr_line, return_code, capture)
+        except subprocess.TimeoutExpired:
+            session.log.error(expr_line)
+            session.log.info(session.build_message(message, 'TIMEOUT'))
+            raise RowTimeoutError('执行命令超过%s秒，已终止' % ('%g' % timeout))
+        finally:
+            capture.release()
+
+        if cache_key is not None:
+            result_cache.store(session, cache_key, row)
+
+    @staticmethod
+    def _save_run_result(session: 'Session', row: CsvRow, message: str, expr_line: str, return_code: int,
+                         capture: OutputCapture):
+        expected_return_code = int(row.return_code)
+        expected_return_type = row.return_type
+        save_var_name = row.var_name
 
         if expected_return_code == return_code:
-            if return_filter != NULL_VALUE and save_var_name != NULL_VALUE:
-                m = re.match(r'%s' % return_filter, result)
+            if capture.pattern is not None:
+                m = capture.get_match()
 
                 if m:
                     value = m.group(1)
                     # 保存筛选结果到暂存变量
-                    if expected_return_type == ReturnType.INT:
-                        exec('_var_tmp_storage_area[\'%s\'] = %d' % (save_var_name, int(value)), globals())
-                    else:
-                        exec('_var_tmp_storage_area[\'%s\'] = \'%s\'' % (save_var_name, m.group(1)), globals())
-                    log.info(_output_message_builder(message, True))
+                    session.vars.set(save_var_name, value, expected_return_type)
+                    session.log.info(session.build_message(message, True))
                 else:
-                    log.error(expr_line)
-                    log.info(_output_message_builder(message, False))
+                    session.log.error(expr_line)
+                    session.log.info(session.build_message(message, False))
                     raise HappyPyException('在执行结果上匹配过滤器，匹配内容为空')
             else:
                 if save_var_name != NULL_VALUE:
-                    _var_tmp_storage_area[save_var_name] = result
+                    session.vars.set(save_var_name, capture.get_output())
 
-                log.info(_output_message_builder(message, True))
+                session.log.info(session.build_message(message, True))
         else:
-            log.error(expr_line)
-            log.info(_output_message_builder(message, False))
+            session.log.error(expr_line)
+            session.log.info(session.build_message(message, False))
             raise HappyPyException('执行命令返回代码（%s）与预期（%s）不符' % (return_code, expected_return_code))
 
-        log.exit_func(fn_name)
-
     @staticmethod
-    def statement_handler(row: CsvRow):
-        fn_name = inspect.stack()[0][3]
-        log.enter_func(fn_name)
-
-        log.var('row', row)
+    @traced
+    def statement_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
 
-        message = _replace_var(row.message)
-        log.var('message', message)
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
 
-        expr_line = _replace_var(row.expr_line)
-        return_filter = _replace_var(row.return_filter)
+        # 语句中的变量在执行时读取，不替换文本
+        expr_line = row.expr_line
         save_var_name = row.var_name
         expected_return_type = row.return_type
         is_expected_return_int_type = expected_return_type == ReturnType.INT
         expected_return_value = int(row.default_value) if expected_return_type == ReturnType.INT else row.default_value
-        log.var('expr_line', expr_line)
-        log.var('return_filter', return_filter)
-        log.var('save_var_name', save_var_name)
-        log.var('expected_return_type', expected_return_type)
-        log.var('is_expected_return_int_type', is_expected_return_int_type)
-        log.var('expected_return_value', expected_return_value)
-
-        if expected_return_type == ReturnType.INT:
-            statement = 'tmp = int(%s)' % expr_line
-        else:
-            statement = 'tmp = %s' % expr_line
 
-        log.var('statement', statement)
+        if session.tracing:
+            session.log.var('expr_line', expr_line)
+            session.log.var('save_var_name', save_var_name)
+            session.log.var('expected_return_type', expected_return_type)
+            session.log.var('is_expected_return_int_type', is_expected_return_int_type)
+            session.log.var('expected_return_value', expected_return_value)
 
         try:
-            exec(statement, locals())
-            result = locals().get('tmp')
+            result = session.evaluate_statement(expr_line, is_expected_return_int_type)
 
             if expected_return_type != ReturnType.NULL and expected_return_value != ReturnType.NULL:
-                log.debug('以判断语句方式运行')
+                if session.debugging:
+                    session.log.debug('以判断语句方式运行')
+
                 result = int(result) if is_expected_return_int_type else str(result)
 
                 if expected_return_value == result:
-                    log.info(_output_message_builder(message, True))
+                    session.log.info(session.build_message(message, True))
 
                     # 保存执行结果到暂存变量
                     if save_var_name != NULL_VALUE:
-                        _var_tmp_storage_area[save_var_name] = result
+                        session.vars.set(save_var_name, result)
                 else:
-                    log.info(_output_message_builder(message, False))
+                    session.log.info(session.build_message(message, False))
                     raise HappyPyException('返回值（%s）与预期（%s）不符' % (result, expected_return_value))
             else:
-                log.debug('以赋值语句方式运行')
-                log.info(_output_message_builder(message, True))
+                if session.debugging:
+                    session.log.debug('以赋值语句方式运行')
+
+                session.log.info(session.build_message(message, True))
 
                 # 保存执行结果到暂存变量
                 if save_var_name != NULL_VALUE:
-                    _var_tmp_storage_area[save_var_name] = result
+                    session.vars.set(save_var_name, result)
         except Exception as e:
-            log.error(statement)
-            log.critical(e)
-            raise HappyPyException(_output_message_builder(message, False))
-
-        log.exit_func(fn_name)
+            session.log.error(expr_line)
+            session.log.critical(e)
+            raise HappyPyException(session.build_message(message, False))
 
     @staticmethod
-    def copy_handler(row: CsvRow):
-        fn_name = inspect.stack()[0][3]
-        log.enter_func(fn_name)
+    @traced
+    def copy_handler(session: 'Session', row: CsvRow):
+        from shutil import SameFileError
 
-        log.var('row', row)
+        message = session.replace_var(row.message)
 
-        message = _replace_var(row.message)
-        log.var('message', message)
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
 
-        expr_line = _replace_var(row.expr_line)
-        log.var('expr_line', expr_line)
+        expr_line = session.replace_var(row.expr_line)
+
+        if session.tracing:
+            session.log.var('expr_line', expr_line)
 
         try:
             src, dst = expr_line.split(' ')
 
-            src_path = Path(src)
-            dst_path = Path(dst)
+            src_path = Path(session.resolve_path(src))
+            dst_path = Path(session.resolve_path(dst))
 
             if not src_path.exists():
-                raise HappyPyException(_output_message_builder('源文件或目录不存在：%s' % src_path, False))
+                raise HappyPyException(session.build_message('源文件或目录不存在：%s' % src_path, False))
 
             if dst_path.is_file() and src_path.is_dir():
-                raise HappyPyException(_output_message_builder(
+                raise HappyPyException(session.build_message(
                     '不能将一个源目录（%s）复制到目标文件（%s）' % (src_path, dst_path), False))
 
-            if src_path.is_dir():
-                log.debug('复制源目录（%s）到目标目录（%s）' % (src_path, dst_path))
-                copytree(src, dst)
-            elif src_path.is_file() or src_path.is_symlink():
-                log.debug('复制源文件（%s）到目标文件或目录（%s）' % (src_path, dst_path))
-                copy(src, dst, follow_symlinks=True)
+            if dst.endswith(os.sep) and not src_path.is_dir():
+                dst_path.mkdir(parents=True, exist_ok=True)
 
-            log.info(_output_message_builder(message, True))
-        except OSError as e:
-            log.critical(e)
-            raise HappyPyException(_output_message_builder('执行复制操作时，出现错误', False))
+            engine = CopyEngine(row.options.get(ROW_OPTION_COPY, COPY_MODE_FULL),
+                                int(row.options.get(ROW_OPTION_COPY_JOBS, DEFAULT_COPY_JOBS)),
+                                session.log)
+            if session.debugging:
+                session.log.debug('复制源%s（%s）到目标（%s），复制方式：%s'
+                                  % ('目录' if src_path.is_dir() else '文件', src_path, dst_path, engine.mode))
+
+            start = time.perf_counter()
+            stats = engine.copy(src_path, dst_path)
+            elapsed = time.perf_counter() - start
+
+            summary = '复制%d个文件（%s），跳过%d个文件' \
+                      % (stats.files, _format_size(stats.bytes), stats.skipped)
+
+            if stats.linked:
+                summary += '，链接%d个文件' % stats.linked
+
+            summary += '，%s/s' % _format_size(stats.bytes / elapsed if elapsed > 0 else 0)
+            session.log.info(session.build_message('%s（%s）' % (message, summary), True))
         except SameFileError as e:
-            log.critical(e)
-            raise HappyPyException(_output_message_builder('源和目标指向同一个文件或目录', False))
+            session.log.critical(e)
+            raise HappyPyException(session.build_message('源和目标指向同一个文件或目录', False))
+        except OSError as e:
+            session.log.critical(e)
+            raise HappyPyException(session.build_message('执行复制操作时，出现错误', False))
+
+    @staticmethod
+    @traced
+    def include_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
+
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
+
+        include_file = session.replace_var(row.expr_line)
+
+        if session.tracing:
+            session.log.var('include_file', include_file)
+
+        try:
+            session.run_include(include_file)
+        except Exception:
+            session.log.info(session.build_message(message, False))
+            raise
+
+        session.log.info(session.build_message(message, True))
+
+    @staticmethod
+    @traced
+    def foreach_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
+
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
+
+        items = expand_foreach_items(session, session.replace_var(row.expr_line))
+        batch_size = int(row.options.get(ROW_OPTION_BATCH, 1))
+        parallel = int(row.options.get(ROW_OPTION_PARALLEL, 1))
+
+        if session.tracing:
+            session.log.var('items', items)
+            session.log.var('batch_size', batch_size)
+            session.log.var('parallel', parallel)
+
+        if batch_size > 1:
+            # 多项合并为一次迭代，适合一条命令处理多个文件
+            values = [' '.join(shlex.quote(item) for item in items[i:i + batch_size])
+                      for i in range(0, len(items), batch_size)]
+        else:
+            values = items
+
+        message = '%s（%d项，%d次迭代）' % (message, len(items), len(values))
+
+        try:
+            session.run_foreach(row.body, row.var_name, values, parallel)
+        except Exception:
+            session.log.info(session.build_message(message, False))
+            raise
+
+        session.log.info(session.build_message(message, True))
+
+    @staticmethod
+    @traced
+    def if_handler(session: 'Session', row: CsvRow):
+        message = session.replace_var(row.message)
+
+        if session.tracing:
+            session.log.var('row', row)
+            session.log.var('message', message)
+
+        # 条件与STATEMENT行的语句相同，变量在执行时读取；有返回值时与返回值比较，
+        # 否则按真假判断
+        expected_return_type = row.return_type
+        is_expected_return_int_type = expected_return_type == ReturnType.INT
+
+        try:
+            result = session.evaluate_statement(row.expr_line, is_expected_return_int_type)
+
+            if expected_return_type != ReturnType.NULL and row.default_value != NULL_VALUE:
+                if is_expected_return_int_type:
+                    matched = int(result) == int(row.default_value)
+                else:
+                    matched = str(result) == row.default_value
+            else:
+                matched = bool(result)
+        except Exception as e:
+            session.log.error(row.expr_line)
+            session.log.critical(e)
+            raise HappyPyException(session.build_message(message, False))
+
+        if session.tracing:
+            session.log.var('result', result)
+            session.log.var('matched', matched)
+
+        result = '条件成立' if matched else '条件不成立'
+        session.log.info(session.build_message('%s（%s）' % (message, result), True))
 
-        log.exit_func(fn_name)
+        else_rows = row.end.body if row.end.mode_type == ModeType.ELSE else ()
+
+        if matched:
+            session.run_if(row.body, else_rows)
+        else:
+            session.run_if(else_rows, row.body)
 
 
-# 列数量
+# 列数量，最后的选项列可以省略
 COL_SIZE = len(ColInfo)
+MIN_COL_SIZE = COL_SIZE - 1
 # 每列对应的值校验函数
 COL_VALIDATE_X_MAP = {
     ColInfo.ModeType: ColValidator.validate_mode_type,
@@ -583,6 +1717,7 @@ COL_VALIDATE_X_MAP = {
     ColInfo.ReturnFilter: ColValidator.validate_return_filter,
     ColInfo.VarName: ColValidator.validate_var_name,
     ColInfo.Message: ColValidator.validate_message,
+    ColInfo.Options: ColValidator.validate_options,
 }
 # 每种模式的行逻辑校验函数
 ROW_VALIDATE_X_MAP = {
@@ -592,6 +1727,11 @@ ROW_VALIDATE_X_MAP = {
     ModeType.RUN: RowValidator.validate_run_row,
     ModeType.STATEMENT: RowValidator.validate_statement_row,
     ModeType.COPY: RowValidator.validate_copy_row,
+    ModeType.INCLUDE: RowValidator.validate_include_row,
+    ModeType.FOREACH: RowValidator.validate_foreach_row,
+    ModeType.END: RowValidator.validate_end_row,
+    ModeType.IF: RowValidator.validate_if_row,
+    ModeType.ELSE: RowValidator.validate_else_row,
 }
 # 每种模式的行处理函数
 ROW_HANDLER_MAP = {
@@ -601,17 +1741,133 @@ ROW_HANDLER_MAP = {
     ModeType.RUN: RowHandler.run_handler,
     ModeType.STATEMENT: RowHandler.statement_handler,
     ModeType.COPY: RowHandler.copy_handler,
+    ModeType.INCLUDE: RowHandler.include_handler,
+    ModeType.FOREACH: RowHandler.foreach_handler,
+    ModeType.IF: RowHandler.if_handler,
 }
+# 行选项名称 -> 支持的模式
+ROW_OPTION_BARRIER = 'barrier'
+ROW_OPTION_STOP_AFTER_MATCH = 'stop_after_match'
+ROW_OPTION_CACHE_INPUTS = 'cache_inputs'
+ROW_OPTION_CACHE_OUTPUTS = 'cache_outputs'
+ROW_OPTION_COPY = 'copy'
+ROW_OPTION_COPY_JOBS = 'copy_jobs'
+ROW_OPTION_TIMEOUT = 'timeout'
+ROW_OPTION_PARALLEL = 'parallel'
+ROW_OPTION_BATCH = 'batch'
+ROW_OPTION_EXEC = 'exec'
+ROW_OPTION_MODES = {
+    # 屏障行：等待之前所有行执行完成后才执行，之后的行等待它执行完成
+    ROW_OPTION_BARRIER: tuple(ModeType),
+    # 过滤器匹配成功后，不再保存和匹配剩余的输出
+    ROW_OPTION_STOP_AFTER_MATCH: (ModeType.RUN,),
+    # 结果缓存：输入文件（空格分隔，支持通配符）和输出文件或目录（空格分隔）
+    ROW_OPTION_CACHE_INPUTS: (ModeType.RUN,),
+    ROW_OPTION_CACHE_OUTPUTS: (ModeType.RUN,),
+    # 复制方式和复制目录树的线程数
+    ROW_OPTION_COPY: (ModeType.COPY,),
+    ROW_OPTION_COPY_JOBS: (ModeType.COPY,),
+    # 命令执行超时的秒数，超时后终止命令的进程组
+    ROW_OPTION_TIMEOUT: (ModeType.RUN,),
+    # 执行方式：auto（默认，没有shell特殊字符的命令直接执行）、shell、direct
+    ROW_OPTION_EXEC: (ModeType.RUN,),
+    # 同时执行的迭代数，以及每次迭代处理的项数（多项以空格分隔后赋值给循环变量）
+    ROW_OPTION_PARALLEL: (ModeType.FOREACH,),
+    ROW_OPTION_BATCH: (ModeType.FOREACH,),
+}
+# 并行模式下，可以在线程池中执行的模式
+PARALLEL_MODE_TYPES = (ModeType.RUN, ModeType.COPY)
+# 包含其它行的模式，读写的变量在执行前未知
+BLOCK_MODE_TYPES = (ModeType.INCLUDE, ModeType.FOREACH, ModeType.IF)
+# 块开始的行，到对应的END行结束
+BLOCK_START_MODE_TYPES = (ModeType.FOREACH, ModeType.IF)
+# FOREACH行的表达式以该前缀开头时，按通配符匹配文件
+FOREACH_GLOB_PREFIX = 'glob:'
+
+
+def expand_foreach_items(session: 'Session', value: str) -> list:
+    """
+    FOREACH行的循环项：glob:通配符匹配的文件；
+    多行文本（比如RUN行的输出）的每个非空行；只有一行时按空格分隔（支持引号）
+    """
+    if value.startswith(FOREACH_GLOB_PREFIX):
+        pattern = value[len(FOREACH_GLOB_PREFIX):].strip()
+        return sorted(glob.glob(session.resolve_path(pattern)))
+
+    lines = [line.strip() for line in value.splitlines() if line.strip()]
+
+    if len(lines) == 1:
+        return shlex.split(lines[0])
+
+    return lines
+
+
+def nest_block_rows(rows: list) -> tuple:
+    """
+    把块开始和END行之间的行移到块开始行的 body，返回最外层的行
+    """
+    top = []
+    stack = []
+
+    for row in rows:
+        if row.mode_type == ModeType.END:
+            if not stack:
+                raise HappyPyException('第%d行->END行没有对应的块开始行' % row.line_number)
+
+            block, body = stack.pop()
+            block.body = tuple(body)
+            block.end = row
+            continue
 
+        if row.mode_type == ModeType.ELSE:
+            # ELSE行结束IF块的条件成立分支，它之后到END行之间的行为 ELSE 行的 body
+            if not stack or stack[-1][0].mode_type != ModeType.IF:
+                raise HappyPyException('第%d行->ELSE行没有对应的IF行' % row.line_number)
 
-def to_csv_row_obj(row: list) -> CsvRow:
-    fn_name = inspect.stack()[0][3]
-    log.enter_func(fn_name)
+            block, body = stack.pop()
+            block.body = tuple(body)
+            block.end = row
+            stack.append((row, []))
+            continue
 
-    log.var('row', row)
+        (stack[-1][1] if stack else top).append(row)
+
+        if row.mode_type in BLOCK_START_MODE_TYPES:
+            stack.append((row, []))
+
+    if stack:
+        block = stack[-1][0]
+        raise HappyPyException('第%d行->%s块缺少对应的END行' % (block.line_number, block.mode_type.name))
+
+    return tuple(top)
+
+
+def flatten_block_rows(rows: tuple) -> list:
+    """
+    nest_block_rows 的逆操作，按文件中的顺序返回全部行
+    """
+    flat = []
+
+    for row in rows:
+        flat.append(row)
+
+        if row.end is not None:
+            flat.extend(flatten_block_rows(row.body))
+            flat.extend(flatten_block_rows((row.end,)))
+
+    return flat
+
+
+@traced
+def to_csv_row_obj(session: 'Session', row: list) -> CsvRow:
+    if session.tracing:
+        session.log.var('row', row)
+
+    if len(row) == MIN_COL_SIZE:
+        row = [*row, NULL_VALUE]
 
     if len(row) != COL_SIZE:
-        raise HappyPyException('数组%s的数量不正确，应该有%d个元素' % (row, COL_SIZE))
+        raise HappyPyException('数组%s的数量不正确，应该有%d或%d个元素' % (row, MIN_COL_SIZE, COL_SIZE))
 
     n = 0
     for c in ColInfo:
@@ -619,7 +1875,7 @@ def to_csv_row_obj(row: list) -> CsvRow:
         # 获取校验函数
         col_validate_fun = COL_VALIDATE_X_MAP.get(c)
         # 调用列对应的校验函数
-        col_validate_fun(row[n])
+        col_validate_fun(session, row[n])
         n += 1
 
     mode_type = ModeType[row[0]]
@@ -630,98 +1886,3508 @@ def to_csv_row_obj(row: list) -> CsvRow:
     return_filter = row[5]
     var_name = row[6]
     message = row[7]
+    options = row[8]
 
     csv_row = CsvRow(mode_type, expr_line, return_code, return_type,
-                     default_value, return_filter, var_name, message)
+                     default_value, return_filter, var_name, message, options)
     row_validate_fun = ROW_VALIDATE_X_MAP.get(mode_type)
 
     if row_validate_fun:
-        row_validate_fun(csv_row)
+        row_validate_fun(session, csv_row)
     else:
-        msg = '第%d行->%s：无效值"%s"，可选值为CONST、VAR、ENV、RUN、MESSAGE、STATEMENT、COPY' \
-              % (line_number, ColInfo.ModeType.value, row[1])
+        msg = '第%d行->%s：无效值"%s"，可选值为CONST、VAR、ENV、RUN、MESSAGE、STATEMENT、' \
+              'COPY、INCLUDE、FOREACH、END、IF、ELSE' % (session.line_number, ColInfo.ModeType.value, row[1])
         raise HappyPyException(msg)
 
-    log.exit_func(fn_name)
+    RowValidator.validate_row_options(session, csv_row)
     return csv_row
 
 
-def raining(csv_file: str):
-    global line_number
+class ExecutionPlan:
+    """
+    编译后的执行计划，执行前已完成全部行的解析和校验
+    """
+    __slots__ = ('csv_file', 'csv_hash', 'rows')
 
-    try:
-        with open(csv_file, encoding='UTF-8') as f:
-            try:
-                reader = csv.reader(f)
+    def __init__(self, csv_file: str, csv_hash: str, rows: tuple):
+        self.csv_file = csv_file
+        self.csv_hash = csv_hash
+        self.rows = rows
+
+    def to_dict(self) -> dict:
+        return {
+            'version': __version__,
+            'csv_file': self.csv_file,
+            'csv_hash': self.csv_hash,
+            'rows': [[row.line_number, *row.to_list()] for row in flatten_block_rows(self.rows)],
+        }
 
-                for row in reader:
-                    line_number += 1
+    @staticmethod
+    def from_dict(csv_file: str, data: dict) -> 'ExecutionPlan':
+        rows = []
 
-                    # 跳过标题行
-                    if line_number == 1:
-                        continue
+        for line, mode_type, expr_line, return_code, return_type, default_value, return_filter, var_name, \
+                message, options in data['rows']:
+            rows.append(CsvRow(ModeType[mode_type], expr_line, return_code, ReturnType[return_type],
+                               default_value, return_filter, var_name, message, options, line))
 
-                    row_obj = to_csv_row_obj(row)
-                    handler = ROW_HANDLER_MAP.get(row_obj.mode_type)
-                    handler(row_obj)
-            except csv.Error as e:
-                msg = '解析CSV文件行时出现错误\n'
-                msg += '%s,%d行: %s' % (csv_file, reader.line_num, e)
-                raise HappyPyException(msg)
-    except FileExistsError as e:
+        return ExecutionPlan(csv_file, data['csv_hash'], nest_block_rows(rows))
+
+
+# 磁盘上最多保留的编译缓存文件数，超过时删除最久未使用（按修改时间）的文件
+PLAN_CACHE_MAX_FILES = 256
+
+
+def _get_plan_cache_dir() -> Path:
+    cache_dir = os.environ.get('RAIN_SHELL_SCRIPTER_CACHE_DIR')
+
+    if cache_dir:
+        return Path(cache_dir)
+
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'rain_shell_scripter'
+
+
+def _get_plan_cache_file(csv_hash: str) -> Path:
+    return _get_plan_cache_dir() / 'plans' / ('%s.json' % csv_hash)
+
+
+def _read_csv_file(csv_file: str) -> bytes:
+    try:
+        with open(csv_file, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        msg = '文件不存在：%s' % csv_file
+        log.error(msg)
+        raise HappyPyException(msg)
+    except OSError as e:
         msg = '读取文件错误：%s：%s' % (csv_file, e)
         log.error(msg)
         raise HappyPyException(msg)
-    except FileNotFoundError:
-        msg = '文件不存在：%s' % csv_file
-        log.error('文件不存在：%s' % csv_file)
+
+
+def _hash_csv_content(content: bytes) -> str:
+    # 版本号和计划格式参与计算，升级后自动失效
+    salt = ('%s-%d' % (__version__, PLAN_FORMAT_VERSION)).encode()
+    return hashlib.sha256(salt + b'\0' + content).hexdigest()
+
+
+@traced
+def parse_plan(session: 'Session', csv_file: str, content: bytes, csv_hash: str) -> ExecutionPlan:
+    import csv
+
+    rows = []
+    profiler = session.profiler
+    session.line_number = 0
+    reader = csv.reader(io.StringIO(content.decode('UTF-8'), newline=''))
+
+    try:
+        for row in reader:
+            session.line_number += 1
+
+            # 跳过标题行
+            if session.line_number == 1:
+                continue
+
+            if profiler is None:
+                row_obj = to_csv_row_obj(session, row)
+            else:
+                start = time.perf_counter()
+                row_obj = to_csv_row_obj(session, row)
+                profiler.validate_times[session.line_number] = time.perf_counter() - start
+
+            row_obj.line_number = session.line_number
+            rows.append(row_obj)
+    except csv.Error as e:
+        msg = '解析CSV文件行时出现错误\n'
+        msg += '%s,%d行: %s' % (csv_file, reader.line_num, e)
         raise HappyPyException(msg)
 
+    rows = nest_block_rows(rows)
+    return ExecutionPlan(csv_file, csv_hash, rows)
 
-def main():
-    global log
-    parser = argparse.ArgumentParser(prog='rain_shell_scripter',
-                                     description='用Python加持Linux Shell脚本，编写CSV文件即可完美解决脚本中的返回值、数值运算、错误处理、流程控制难题~',
-                                     usage='%(prog)s -f|-l')
 
-    parser.add_argument('-f',
-                        '--file',
-                        help='CSV文件',
-                        required=True,
-                        action='store',
-                        dest='csv_file')
+def compile_plan(csv_file: str,
+                 use_cache: bool = True,
+                 session: 'Session' = None,
+                 memory_cache: 'PlanMemoryCache' = None) -> ExecutionPlan:
+    """
+    解析并校验整个CSV文件，生成执行计划。
+    相同内容的文件直接使用内存或磁盘上的编译缓存
+    """
+    if session is None:
+        session = Session()
 
-    parser.add_argument('-l',
-                        '--log-level',
-                        help='日志级别，CRITICAL|ERROR|WARNING|INFO|DEBUG|TRACE，默认等级3（INFO）',
-                        type=int,
-                        choices=HappyLogLevel.get_list(),
-                        default=HappyLogLevel.INFO.value,
-                        required=False,
-                        dest='log_level')
+    start = time.perf_counter()
+    file_key = None
 
-    parser.add_argument('-v',
-                        '--version',
-                        help='显示版本信息',
-                        action='version',
-                        version='%(prog)s/v' + __version__)
+    if use_cache and memory_cache is not None:
+        # 文件的修改时间和大小不变时，不读取文件内容
+        file_key = PlanMemoryCache.stat_file(csv_file)
+        plan = memory_cache.get_file(file_key)
 
-    args = parser.parse_args()
-    log.set_level(args.log_level)
+        if plan is not None:
+            session.log.debug('使用内存中的编译缓存：%s' % csv_file)
+            _record_plan_profile(session, start, True, len(plan.rows))
+            return ExecutionPlan(csv_file, plan.csv_hash, plan.rows)
+
+    content = _read_csv_file(csv_file)
+    csv_hash = _hash_csv_content(content)
+    cache_file = _get_plan_cache_file(csv_hash)
+
+    if use_cache and memory_cache is not None:
+        plan = memory_cache.get(csv_hash)
+
+        if plan is not None:
+            session.log.debug('使用内存中的编译缓存：%s' % csv_file)
+            memory_cache.put(plan, file_key)
+            _record_plan_profile(session, start, True, len(plan.rows))
+            return ExecutionPlan(csv_file, csv_hash, plan.rows)
+
+    if use_cache and cache_file.is_file():
+        try:
+            with open(cache_file, encoding='UTF-8') as f:
+                plan = ExecutionPlan.from_dict(csv_file, json.load(f))
+
+            _touch_plan_cache(cache_file)
+            session.log.debug('使用编译缓存：%s' % cache_file)
+            _record_plan_profile(session, start, True, len(plan.rows))
+
+            if memory_cache is not None:
+                memory_cache.put(plan, file_key)
+
+            return plan
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            session.log.warning('编译缓存无效，重新编译：%s：%s' % (cache_file, e))
+
+    plan = parse_plan(session, csv_file, content, csv_hash)
+
+    if use_cache:
+        save_plan(plan, cache_file)
+
+        if memory_cache is not None:
+            memory_cache.put(plan, file_key)
+
+    _record_plan_profile(session, start, False, len(plan.rows))
+    return plan
+
+
+def _record_plan_profile(session: 'Session', start: float, cache_hit: bool, row_count: int):
+    profiler = session.profiler
+
+    if profiler is None:
+        return
+
+    elapsed = time.perf_counter() - start
+    validate = sum(profiler.validate_times.values())
+    profiler.plan.update({
+        'compile': elapsed,
+        'parse': max(0.0, elapsed - validate),
+        'validate': validate,
+        'cache_hit': cache_hit,
+        'rows': row_count,
+    })
+
+
+PLAN_MEMORY_CACHE_SIZE = 256
+
+
+class PlanMemoryCache:
+    """
+    内存中的编译缓存，按CSV文件内容的哈希值保存最近使用的执行计划，
+    多个线程可以同时使用
+
+    同时记录文件路径、修改时间和大小对应的哈希值，文件未修改时不需要读取文件内容
+    """
+
+    def __init__(self, max_size: int = PLAN_MEMORY_CACHE_SIZE):
+        self.max_size = max_size
+        self.plans = OrderedDict()
+        # 文件绝对路径 -> (修改时间, 大小, inode, 哈希值)
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def stat_file(csv_file: str):
+        try:
+            st = os.stat(csv_file)
+        except OSError:
+            return None
+
+        return os.path.abspath(csv_file), st.st_mtime_ns, st.st_size, st.st_ino
+
+    def get_file(self, file_key):
+        if file_key is None:
+            return None
+
+        with self.lock:
+            entry = self.files.get(file_key[0])
+
+            if entry is None or entry[:3] != file_key[1:]:
+                return None
+
+            plan = self.plans.get(entry[3])
+
+            if plan is not None:
+                self.plans.move_to_end(entry[3])
+                self.files.move_to_end(file_key[0])
+
+            return plan
+
+    def get(self, csv_hash: str):
+        with self.lock:
+            plan = self.plans.get(csv_hash)
+
+            if plan is not None:
+                self.plans.move_to_end(csv_hash)
+
+            return plan
+
+    def put(self, plan: ExecutionPlan, file_key=None):
+        with self.lock:
+            self.plans[plan.csv_hash] = plan
+            self.plans.move_to_end(plan.csv_hash)
+
+            while len(self.plans) > self.max_size:
+                self.plans.popitem(last=False)
+
+            if file_key is not None:
+                self.files[file_key[0]] = (*file_key[1:], plan.csv_hash)
+                self.files.move_to_end(file_key[0])
+
+                while len(self.files) > self.max_size:
+                    self.files.popitem(last=False)
+
+
+# 进程内共用的内存编译缓存
+_process_plan_memory_cache = PlanMemoryCache()
+
+
+def save_plan(plan: ExecutionPlan, cache_file: Path) -> bool:
+    tmp_file = cache_file.with_name('%s.%d.%d.tmp' % (cache_file.name, os.getpid(), threading.get_ident()))
+
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(tmp_file, 'w', encoding='UTF-8') as f:
+            json.dump(plan.to_dict(), f, ensure_ascii=False)
+
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        log.warning('写入编译缓存失败：%s：%s' % (cache_file, e))
+        return False
+
+    evict_plan_cache(cache_file.parent)
+    return True
+
+
+def _touch_plan_cache(cache_file: Path):
+    # 命中时更新修改时间，淘汰时按修改时间判断最近是否使用
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+
+
+def evict_plan_cache(cache_dir: Path, max_files: int = PLAN_CACHE_MAX_FILES) -> int:
+    """
+    缓存文件数超过上限时，删除最久未使用的文件，返回删除的文件数
+    """
+    entries = []
+
+    try:
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass
+    except OSError:
+        return 0
+
+    if len(entries) <= max_files:
+        return 0
+
+    entries.sort()
+    removed = 0
+
+    for _, path in entries[:len(entries) - max_files]:
+        try:
+            os.unlink(path)
+            removed += 1
+        except OSError:
+            pass
+
+    return removed
+
+
+# COPY行的复制方式：全部复制、跳过大小和修改时间相同的文件、
+# 跳过大小和哈希值相同的文件、硬链接、reflink
+COPY_MODE_FULL = 'full'
+COPY_MODE_INCREMENTAL = 'incremental'
+COPY_MODE_HASH = 'hash'
+COPY_MODE_HARDLINK = 'hardlink'
+COPY_MODE_REFLINK = 'reflink'
+COPY_MODES = (COPY_MODE_FULL, COPY_MODE_INCREMENTAL, COPY_MODE_HASH, COPY_MODE_HARDLINK, COPY_MODE_REFLINK)
+# 复制目录树的默认线程数
+DEFAULT_COPY_JOBS = min(32, (os.cpu_count() or 1) * 4)
+# 内核复制每次调用的最大字节数
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# 内核复制不可用时，回退到普通读写
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP)
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# 结果缓存的默认最大容量
+DEFAULT_RESULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def _hash_file(path) -> str:
+    h = hashlib.sha256()
+
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return 'missing'
+
+    return h.hexdigest()
+
+
+def _format_size(size: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '%.1f%s' % (size, unit) if unit != 'B' else '%d%s' % (size, unit)
+
+        size /= 1024
+
+    return '%.1fTiB' % size
+
+
+class CopyStats:
+    """
+    COPY行的统计：复制的文件数、字节数，跳过的文件数，链接的文件数
+    """
+    __slots__ = ('files', 'bytes', 'skipped', 'linked')
+
+    def __init__(self, files: int = 0, size: int = 0, skipped: int = 0, linked: int = 0):
+        self.files = files
+        self.bytes = size
+        self.skipped = skipped
+        self.linked = linked
+
+    def merge(self, other: 'CopyStats'):
+        self.files += other.files
+        self.bytes += other.bytes
+        self.skipped += other.skipped
+        self.linked += other.linked
+
+
+class CopyEngine:
+    """
+    COPY行的复制引擎：大文件在内核中复制，目录树用线程池并行复制，
+    已存在的目标目录合并复制
+    """
+
+    def __init__(self, mode: str = COPY_MODE_FULL, jobs: int = DEFAULT_COPY_JOBS, logger=None):
+        self.mode = mode
+        self.jobs = jobs
+        self.log = logger if logger is not None else log
+
+    def copy(self, src: Path, dst: Path) -> CopyStats:
+        if src.is_dir():
+            return self.copy_tree(src, dst)
+
+        if dst.is_dir():
+            dst = dst / src.name
+
+        return self.copy_file(src, dst)
+
+    def copy_tree(self, src: Path, dst: Path) -> CopyStats:
+        from concurrent.futures import ThreadPoolExecutor
+        from shutil import copystat
+
+        dirs = []
+        files = []
+
+        for root, dir_names, file_names in os.walk(src, followlinks=True):
+            rel = Path(root).relative_to(src)
+            dirs.append((Path(root), dst / rel))
+            files.extend((Path(root, name), dst / rel / name) for name in file_names)
+
+        for _, dst_dir in dirs:
+            dst_dir.mkdir(parents=True, exist_ok=True)
+
+        self.log.debug('复制目录树：%d个目录，%d个文件，%d个线程' % (len(dirs), len(files), self.jobs))
+        stats = CopyStats()
+
+        if self.jobs > 1 and len(files) > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='copy') as executor:
+                for file_stats in executor.map(lambda pair: self.copy_file(*pair), files):
+                    stats.merge(file_stats)
+        else:
+            for src_file, dst_file in files:
+                stats.merge(self.copy_file(src_file, dst_file))
+
+        # 文件复制完成后再复制目录属性，避免目录修改时间被改变
+        for src_dir, dst_dir in reversed(dirs):
+            copystat(src_dir, dst_dir)
+
+        return stats
+
+    def _is_up_to_date(self, src_stat: os.stat_result, dst: Path, src: Path) -> bool:
+        try:
+            dst_stat = dst.stat()
+        except FileNotFoundError:
+            return False
+
+        if dst_stat.st_size != src_stat.st_size:
+            return False
+
+        if self.mode == COPY_MODE_INCREMENTAL:
+            return int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+
+        if self.mode == COPY_MODE_HASH:
+            return _hash_file(src) == _hash_file(dst)
+
+        return self.mode == COPY_MODE_HARDLINK and os.path.samestat(src_stat, dst_stat)
+
+    def copy_file(self, src: Path, dst: Path) -> CopyStats:
+        from shutil import copystat
+
+        src_stat = src.stat()
+
+        if self.mode != COPY_MODE_FULL and self._is_up_to_date(src_stat, dst, src):
+            return CopyStats(skipped=1)
+
+        if self.mode == COPY_MODE_HARDLINK and self._link_file(src, dst, src_stat):
+            return CopyStats(linked=1)
+
+        size = self._copy_file_data(src, dst, src_stat)
+        copystat(src, dst)
+
+        return CopyStats(files=1, size=size)
+
+    def _link_file(self, src: Path, dst: Path, src_stat: os.stat_result) -> bool:
+        try:
+            if dst.parent.stat().st_dev != src_stat.st_dev:
+                return False
+
+            if dst.exists() or dst.is_symlink():
+                dst.unlink()
+
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            self.log.debug('创建硬链接失败，改为复制文件（%s）：%s' % (dst, e))
+            return False
+
+    def _copy_file_data(self, src: Path, dst: Path, src_stat: os.stat_result) -> int:
+        from shutil import SameFileError
+
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            raise SameFileError('%s 和 %s 是同一个文件' % (src, dst))
+
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            src_fd = fsrc.fileno()
+            dst_fd = fdst.fileno()
+
+            if self.mode == COPY_MODE_REFLINK:
+                try:
+                    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                    return src_stat.st_size
+                except OSError as e:
+                    self.log.debug('文件系统不支持reflink，改为复制文件（%s）：%s' % (dst, e))
+
+            return self._copy_fd(src_fd, dst_fd, src_stat.st_size, fsrc, fdst)
+
+    @staticmethod
+    def _copy_fd(src_fd: int, dst_fd: int, size: int, fsrc, fdst) -> int:
+        from shutil import copyfileobj
+
+        offset = 0
+
+        # 优先在内核中复制数据，不经过用户态缓冲区
+        for name in ('copy_file_range', 'sendfile'):
+            fn = getattr(os, name, None)
+
+            if fn is None:
+                continue
+
+            try:
+                while offset < size:
+                    if name == 'copy_file_range':
+                        n = fn(src_fd, dst_fd, min(size - offset, COPY_CHUNK_SIZE))
+                    else:
+                        n = fn(dst_fd, src_fd, offset, min(size - offset, COPY_CHUNK_SIZE))
+
+                    if n == 0:
+                        break
+
+                    offset += n
+
+                return offset
+            except OSError as e:
+                if offset or e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+
+        copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+
+        return fdst.tell()
+
+
+class ResultCache:
+    """
+    RUN行的结果缓存：以展开后的命令和输入文件内容的哈希值为键，
+    保存输出文件和变量值，按最近使用时间淘汰
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int = DEFAULT_RESULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # 缓存总大小的估计值，第一次写入时扫描缓存目录得到，之后累加写入的大小，
+        # 超过上限时才重新扫描
+        self.total_size = None
+
+    @staticmethod
+    def is_cached_row(row: CsvRow) -> bool:
+        return row.has_option(ROW_OPTION_CACHE_INPUTS) or row.has_option(ROW_OPTION_CACHE_OUTPUTS)
+
+    @staticmethod
+    def get_paths(session: 'Session', row: CsvRow, option: str) -> list:
+        value = row.options.get(option)
+        return session.replace_var(value).split() if value else []
+
+    @staticmethod
+    def _expand_inputs(session: 'Session', patterns: list) -> list:
+        files = []
+
+        for pattern in patterns:
+            pattern = session.resolve_path(pattern)
+            matched = sorted(glob.glob(pattern, recursive=True))
+
+            if not matched:
+                files.append(pattern)
+
+            for path in matched:
+                if os.path.isdir(path):
+                    for root, dirs, names in os.walk(path):
+                        dirs.sort()
+                        files.extend(os.path.join(root, name) for name in sorted(names))
+                else:
+                    files.append(path)
+
+        return files
+
+    def make_key(self, session: 'Session', row: CsvRow, expr_line: str) -> str:
+        h = hashlib.sha256()
+        h.update(json.dumps([__version__, expr_line, row.return_code, row.return_type.name,
+                             row.return_filter, row.var_name,
+                             self.get_paths(session, row, ROW_OPTION_CACHE_OUTPUTS)],
+                            ensure_ascii=False).encode('UTF-8'))
+
+        for path in self._expand_inputs(session, self.get_paths(session, row, ROW_OPTION_CACHE_INPUTS)):
+            h.update(b'\0' + path.encode('UTF-8') + b'\0' + _hash_file(path).encode())
+
+        return h.hexdigest()
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def restore(self, session: 'Session', key: str, row: CsvRow) -> bool:
+        entry_dir = self._entry_dir(key)
+        meta_file = entry_dir / 'meta.json'
+
+        try:
+            with open(meta_file, encoding='UTF-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        try:
+            for i, path in enumerate(meta['outputs']):
+                _copy_path(entry_dir / 'outputs' / str(i), Path(session.resolve_path(path)))
+
+            # 更新最近使用时间
+            os.utime(meta_file)
+        except OSError as e:
+            session.log.warning('恢复缓存的输出文件失败，重新执行命令：%s' % e)
+            return False
+
+        if row.var_name != NULL_VALUE and meta['value'] is not None:
+            session.vars.set(row.var_name, meta['value'])
+
+        return True
+
+    def store(self, session: 'Session', key: str, row: CsvRow):
+        from shutil import rmtree
+
+        outputs = self.get_paths(session, row, ROW_OPTION_CACHE_OUTPUTS)
+        entry_dir = self._entry_dir(key)
+        tmp_dir = entry_dir.with_name('%s.%d.%d.tmp' % (key, os.getpid(), threading.get_ident()))
+        size = 0
+
+        try:
+            for i, path in enumerate(outputs):
+                path = session.resolve_path(path)
+
+                if not os.path.exists(path):
+                    session.log.warning('输出文件不存在，不缓存执行结果：%s' % path)
+                    return
+
+                size += _copy_path(Path(path), tmp_dir / 'outputs' / str(i))
+
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            value = session.vars.get(row.var_name) if row.var_name != NULL_VALUE else None
+            meta = {'value': value, 'outputs': outputs, 'size': size, 'expr_line': row.expr_line}
+
+            with open(tmp_dir / 'meta.json', 'w', encoding='UTF-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+            if entry_dir.exists():
+                rmtree(entry_dir, ignore_errors=True)
+
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            session.log.warning('写入结果缓存失败：%s' % e)
+            return
+        finally:
+            if tmp_dir.exists():
+                rmtree(tmp_dir, ignore_errors=True)
+
+        with self.lock:
+            if self.total_size is not None:
+                self.total_size += size
+
+                if self.total_size <= self.max_size:
+                    return
+
+        self.evict(session.log)
+
+    def evict(self, logger=None):
+        """
+        扫描缓存目录，总大小超过上限时删除最久未使用的结果
+        """
+        from shutil import rmtree
+
+        with self.lock:
+            entries = []
+            total = 0
+
+            for meta_file in self.cache_dir.glob('*/*/meta.json'):
+                try:
+                    with open(meta_file, encoding='UTF-8') as f:
+                        size = json.load(f).get('size', 0)
+
+                    entries.append((meta_file.stat().st_mtime, size, meta_file.parent))
+                except (OSError, ValueError):
+                    continue
+
+                total += size
+
+            # 淘汰最久未使用的缓存
+            for _, size, entry_dir in sorted(entries):
+                if total <= self.max_size:
+                    break
+
+                rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                (logger or log).debug('淘汰结果缓存：%s' % entry_dir)
+
+            self.total_size = total
+
+
+def _copy_path(src: Path, dst: Path) -> int:
+    """
+    复制文件或目录，返回复制的字节数
+    """
+    from shutil import copytree, copy2
+
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    if src.is_dir():
+        copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+        return sum(p.stat().st_size for p in dst.rglob('*') if p.is_file())
+
+    copy2(src, dst)
+    return dst.stat().st_size
+
+
+class RowProfile:
+    __slots__ = ('line_number', 'mode', 'status', 'wall', 'phases', 'child')
+
+    def __init__(self, row: CsvRow):
+        self.line_number = row.line_number
+        self.mode = row.mode_type.name
+        self.status = 'running'
+        self.wall = 0.0
+        self.phases = {'validate': 0.0, 'substitute': 0.0, 'execute': 0.0, 'handle': 0.0}
+        # 子进程资源使用情况，常驻shell会话无法单独统计
+        self.child = None
+
+    def add_child_usage(self, ru):
+        child = self.child or {'user': 0.0, 'sys': 0.0, 'max_rss_kb': 0, 'inblock': 0, 'oublock': 0}
+        child['user'] += ru.ru_utime
+        child['sys'] += ru.ru_stime
+        child['max_rss_kb'] = max(child['max_rss_kb'], ru.ru_maxrss)
+        child['inblock'] += ru.ru_inblock
+        child['oublock'] += ru.ru_oublock
+        self.child = child
+
+    def to_dict(self) -> dict:
+        return {
+            'line_number': self.line_number,
+            'mode': self.mode,
+            'status': self.status,
+            'wall': round(self.wall, 6),
+            'phases': {k: round(v, 6) for k, v in self.phases.items()},
+            'child': self.child,
+        }
+
+
+TRACE_BATCH_SIZE = 256
+TRACE_FLUSH_INTERVAL = 0.5
+
+
+class TraceWriter:
+    """
+    结构化跟踪：执行线程只把事件放入队列，后台线程批量编码为JSON行并写入文件
+    """
+
+    def __init__(self, trace_file: str, batch_size: int = TRACE_BATCH_SIZE,
+                 flush_interval: float = TRACE_FLUSH_INTERVAL):
+        self.trace_file = trace_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.row_ids = count(1)
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        try:
+            self.f = open(trace_file, 'w', encoding='UTF-8')
+        except OSError as e:
+            raise HappyPyException('无法写入跟踪文件：%s：%s' % (trace_file, e))
+
+        self.thread = threading.Thread(target=self._run, name='rain-trace', daemon=True)
+        self.thread.start()
+
+    def emit(self, event: str, **fields):
+        self.events.append({'ts': time.time(), 'event': event, 'thread': threading.current_thread().name, **fields})
+
+        # 攒够一批再唤醒后台线程
+        if len(self.events) >= self.batch_size:
+            with self.cond:
+                self.cond.notify()
+
+    def _write_batch(self) -> int:
+        lines = []
+
+        while self.events:
+            lines.append(json.dumps(self.events.popleft(), ensure_ascii=False, default=str))
+
+        if lines:
+            self.f.write('\n'.join(lines) + '\n')
+            self.f.flush()
+
+        return len(lines)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(self.flush_interval)
+
+                closed = self.closed
+
+            try:
+                self._write_batch()
+            except OSError as e:
+                log.warning('写入跟踪文件失败：%s：%s' % (self.trace_file, e))
+                return
+
+            if closed:
+                return
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+        self.thread.join()
+        self.f.close()
+
+
+class Profiler:
+    """
+    记录每行的耗时、各阶段耗时和子进程资源使用情况
+    """
+
+    def __init__(self, profile_file: str, top_n: int = 10, logger=None):
+        self.profile_file = profile_file
+        self.top_n = top_n
+        self.log = logger if logger is not None else log
+        self.plan = dict()
+        self.validate_times = dict()
+        self.rows = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def begin_row(self, row: CsvRow) -> RowProfile:
+        record = RowProfile(row)
+        record.phases['validate'] = self.validate_times.get(row.line_number, 0.0)
+
+        with self.lock:
+            self.rows.append(record)
+
+        return record
+
+    @staticmethod
+    def end_row(record: RowProfile, wall: float, status: str):
+        record.wall = wall
+        record.status = status
+        phases = record.phases
+        phases['handle'] = max(0.0, wall - phases['substitute'] - phases['execute'])
+
+    def to_dict(self) -> dict:
+        return {
+            'version': __version__,
+            'wall': round(time.perf_counter() - self.start, 6),
+            'plan': {k: (round(v, 6) if isinstance(v, float) else v) for k, v in self.plan.items()},
+            'rows': [record.to_dict() for record in self.rows],
+        }
+
+    def save(self):
+        try:
+            with open(self.profile_file, 'w', encoding='UTF-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            self.log.warning('写入性能分析文件失败：%s：%s' % (self.profile_file, e))
+            return
+
+        self.log.info('性能分析结果已写入：%s' % self.profile_file)
+
+    def log_summary(self):
+        top_rows = sorted(self.rows, key=lambda r: r.wall, reverse=True)[:self.top_n]
+
+        if not top_rows:
+            return
+
+        self.log.info('耗时最长的%d行：' % len(top_rows))
+
+        for record in top_rows:
+            child = record.child
+
+            if child:
+                usage = '，子进程用户态 %.3fs，内核态 %.3fs，最大内存 %dKB' \
+                        % (child['user'], child['sys'], child['max_rss_kb'])
+            else:
+                usage = ''
+
+            self.log.info('行号：%s -> %s %.3fs（替换变量 %.3fs，执行 %.3fs）%s'
+                          % (record.line_number, record.mode, record.wall, record.phases['substitute'],
+                             record.phases['execute'], usage))
+
+
+# 统计每行耗时时使用的最近执行次数
+HISTORY_WINDOW = 20
+# 最近一次耗时超过之前中位数的倍数，并且至少多出的秒数时，视为性能退化
+HISTORY_REGRESSION_THRESHOLD = 1.5
+HISTORY_REGRESSION_MIN_SECONDS = 1.0
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    csv_file TEXT NOT NULL,
+    csv_hash TEXT NOT NULL,
+    started REAL NOT NULL,
+    wall REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS row_durations (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    csv_file TEXT NOT NULL,
+    row_hash TEXT NOT NULL,
+    line_number INTEGER NOT NULL,
+    wall REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS row_durations_key ON row_durations (csv_file, row_hash, line_number, run_id);
+'''
+
+
+def percentile(values: list, p: int) -> float:
+    """
+    最近秩法计算百分位数，values 必须已排序
+    """
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+class RowHistory:
+    """
+    行耗时历史：执行时在内存中记录最外层每行的耗时，
+    执行结束后在一个事务中追加到SQLite数据库。
+    按CSV文件的绝对路径、行内容哈希和行号查询，行内容改变后重新统计
+    """
+
+    def __init__(self, history_file: str, logger=None):
+        self.history_file = history_file
+        self.log = logger if logger is not None else log
+        self.rows = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def connect(self):
+        import sqlite3
+
+        try:
+            conn = sqlite3.connect(self.history_file, timeout=30)
+            conn.executescript(HISTORY_SCHEMA)
+        except sqlite3.Error as e:
+            raise HappyPyException('无法打开耗时历史数据库：%s：%s' % (self.history_file, e))
+
+        return conn
+
+    def add(self, row: CsvRow, wall: float, status: str):
+        with self.lock:
+            self.rows.append((row, wall, status))
+
+    def save(self, plan: ExecutionPlan, status: str):
+        import sqlite3
+
+        csv_file = os.path.abspath(plan.csv_file)
+        rows = [(csv_file, CheckpointJournal.hash_row(row), row.line_number, wall, row_status)
+                for row, wall, row_status in self.rows]
+
+        try:
+            conn = self.connect()
+
+            try:
+                with conn:
+                    run_id = conn.execute('INSERT INTO runs (csv_file, csv_hash, started, wall, status) '
+                                          'VALUES (?, ?, ?, ?, ?)',
+                                          (csv_file, plan.csv_hash, self.started, time.time() - self.started,
+                                           status)).lastrowid
+                    conn.executemany('INSERT INTO row_durations '
+                                     '(run_id, csv_file, row_hash, line_number, wall, status) '
+                                     'VALUES (%d, ?, ?, ?, ?, ?)' % run_id, rows)
+            finally:
+                conn.close()
+        except (HappyPyException, sqlite3.Error) as e:
+            # 记录历史失败不影响执行结果
+            self.log.warning('写入耗时历史失败：%s：%s' % (self.history_file, e))
+
+    def load(self, plan: ExecutionPlan, window: int = HISTORY_WINDOW) -> dict:
+        """
+        返回执行计划中每行最近 window 次执行成功的耗时：行号 -> 耗时列表（从旧到新）
+        """
+        import sqlite3
+
+        keys = {(CheckpointJournal.hash_row(row), row.line_number): row.line_number for row in plan.rows}
+        durations = {line_number: [] for line_number in keys.values()}
+        conn = self.connect()
+
+        try:
+            cursor = conn.execute(
+                'SELECT row_hash, line_number, wall FROM ('
+                '    SELECT row_hash, line_number, wall, run_id, ROW_NUMBER() OVER ('
+                '        PARTITION BY row_hash, line_number ORDER BY run_id DESC) AS n'
+                '    FROM row_durations WHERE csv_file = ? AND status = ?'
+                ') WHERE n <= ? ORDER BY run_id',
+                (os.path.abspath(plan.csv_file), 'ok', window))
+
+            for row_hash, line_number, wall in cursor:
+                line = keys.get((row_hash, line_number))
+
+                if line is not None:
+                    durations[line].append(wall)
+        except sqlite3.Error as e:
+            raise HappyPyException('读取耗时历史失败：%s：%s' % (self.history_file, e))
+        finally:
+            conn.close()
+
+        return durations
+
+    def expected_durations(self, plan: ExecutionPlan) -> dict:
+        """
+        每行耗时的中位数，没有历史记录的行不包含在内
+        """
+        return {line: percentile(sorted(walls), 50) for line, walls in self.load(plan).items() if walls}
+
+
+def get_row_reads(row: CsvRow) -> set:
+    names = set()
+
+    for value in (row.expr_line, row.default_value, row.return_filter, row.message, *row.options.values()):
+        if '${' in value:
+            # 感叹号开头的变量总是替换为空，不读取变量
+            names.update(m[1] for m in _VAR_EXPR_PATTERN.findall(value) if not m[0])
+
+    return names
+
+
+def get_row_writes(row: CsvRow) -> set:
+    if row.var_name != NULL_VALUE and row.mode_type in (ModeType.CONST, ModeType.ENV, ModeType.RUN, ModeType.STATEMENT):
+        return {row.var_name}
+
+    return set()
+
+
+def is_barrier_row(row: CsvRow) -> bool:
+    # 子进程继承环境变量，ENV行必须等待之前的命令执行完成；INCLUDE、
+    # FOREACH行读写的变量在执行前未知
+    return row.mode_type == ModeType.ENV or row.mode_type in BLOCK_MODE_TYPES or row.has_option(ROW_OPTION_BARRIER)
+
+
+def build_row_dependencies(rows: tuple) -> list:
+    """
+    根据变量读写关系生成依赖图，返回每行依赖的前序行下标集合
+    """
+    deps = []
+    last_writer = dict()
+    readers = dict()
+    last_barrier = None
+    since_barrier = []
+
+    for i, row in enumerate(rows):
+        row_deps = set()
+        reads = get_row_reads(row)
+        writes = get_row_writes(row)
+
+        # 先写后读
+        for name in reads:
+            if name in last_writer:
+                row_deps.add(last_writer[name])
+
+        # 先读后写、先写后写
+        for name in writes:
+            row_deps.update(readers.get(name, ()))
+
+            if name in last_writer:
+                row_deps.add(last_writer[name])
+
+        if is_barrier_row(row):
+            row_deps.update(since_barrier)
+            since_barrier = []
+            last_barrier = i
+        elif last_barrier is not None:
+            row_deps.add(last_barrier)
+
+        row_deps.discard(i)
+        deps.append(row_deps)
+        since_barrier.append(i)
+
+        for name in reads:
+            readers.setdefault(name, set()).add(i)
+
+        for name in writes:
+            last_writer[name] = i
+            readers[name] = set()
+
+    return deps
+
+
+# 断点续跑日志同步到磁盘的最小间隔（秒）
+CHECKPOINT_FSYNC_INTERVAL = 1.0
+
+
+class CheckpointJournal:
+    """
+    断点续跑日志：每行执行成功后追加一条记录（行号、行内容哈希、
+    写入的变量和环境变量），批量同步到磁盘
+    """
+
+    def __init__(self, session: 'Session', state_file: str, fsync_interval: float = CHECKPOINT_FSYNC_INTERVAL):
+        self.session = session
+        self.state_file = state_file
+        self.fsync_interval = fsync_interval
+        self.f = None
+        self.lock = threading.Lock()
+        self.last_fsync = 0.0
+        self.unsynced = 0
+
+    @staticmethod
+    def hash_row(row: CsvRow) -> str:
+        """
+        行的哈希值；FOREACH、IF等块包括块内的全部行，修改块内任意一行后哈希值随之改变
+        """
+        rows = [r.to_list() for r in flatten_block_rows((row,))]
+        return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode('UTF-8')).hexdigest()
+
+    def open(self, plan: ExecutionPlan, append: bool):
+        self.f = open(self.state_file, 'a' if append else 'w', encoding='UTF-8')
+
+        if not append:
+            self._write({'type': 'header', 'version': __version__, 'csv_file': plan.csv_file,
+                         'csv_hash': plan.csv_hash})
+            self.sync()
+
+    def _write(self, record: dict):
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        # 写入操作系统缓存，进程异常退出时不会丢失
+        self.f.flush()
+        self.unsynced += 1
+
+    def record(self, row: CsvRow):
+        variables = dict()
+        env = dict()
+
+        if row.mode_type in BLOCK_MODE_TYPES:
+            # 块内的行写入的变量在执行前未知，保存全部变量和环境变量
+            snapshot = self.session.vars.snapshot()
+            variables.update(snapshot.items())
+            env.update(snapshot.env_items())
+
+        for name in get_row_writes(row):
+            if row.mode_type == ModeType.ENV:
+                env[name] = self.session.vars.get_env(name)
+            elif name in self.session.vars:
+                variables[name] = self.session.vars[name]
+
+        with self.lock:
+            self._write({'type': 'row', 'line': row.line_number, 'hash': self.hash_row(row),
+                         'vars': variables, 'env': env})
+
+            now = time.monotonic()
+
+            if now - self.last_fsync >= self.fsync_interval:
+                self._sync(now)
+
+    def _sync(self, now: float):
+        os.fsync(self.f.fileno())
+        self.last_fsync = now
+        self.unsynced = 0
+
+    def sync(self):
+        with self.lock:
+            if self.f is not None and self.unsynced:
+                self._sync(time.monotonic())
+
+    def close(self):
+        if self.f is None:
+            return
+
+        self.sync()
+        self.f.close()
+        self.f = None
+
+    def remove(self):
+        self.close()
+
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
+
+    def load(self, plan: ExecutionPlan) -> set:
+        """
+        校验已执行的行与当前CSV文件一致，恢复变量和环境变量，返回已执行的行号
+        """
+        rows = {row.line_number: row for row in plan.rows}
+        done = set()
+
+        with open(self.state_file, encoding='UTF-8') as f:
+            for text in f:
+                try:
+                    record = json.loads(text)
+                except ValueError:
+                    # 进程异常退出时，最后一条记录可能不完整
+                    self.session.log.warning('忽略不完整的断点记录：%s' % text.strip())
+                    continue
+
+                if record.get('type') != 'row':
+                    continue
+
+                line = record['line']
+                row = rows.get(line)
+
+                if row is None or self.hash_row(row) != record['hash']:
+                    msg = '第%d行的内容在上次执行后已经改变，无法从断点继续执行：%s' \
+                          % (line, self.state_file)
+                    raise HappyPyException(msg)
+
+                self.session.vars.update(record['vars'])
+
+                for name, value in record['env'].items():
+                    if value is None:
+                        self.session.vars.unset_env(name)
+                    else:
+                        self.session.vars.set_env(name, value)
+
+                done.add(line)
+
+        return done
+
+
+class VarStore:
+    """
+    分层的变量存储区，查找顺序：块内局部变量（由内向外）-> ENV行设置的环境变量 ->
+    基础环境变量 -> 暂存变量
+
+    按字典的方式读写时只操作暂存变量，快照采用写时复制，创建快照不复制数据
+    """
+
+    def __init__(self, variables: dict = None, env: dict = None, base_env: dict = None):
+        # 基础环境变量，默认为当前进程的环境变量
+        self.base_env = os.environ if base_env is None else dict(base_env)
+        # ENV行设置的环境变量，只传递给执行的命令，不修改 os.environ
+        self._env = dict(env) if env else dict()
+        # CONST、RUN、STATEMENT行保存的变量
+        self._vars = dict(variables) if variables else dict()
+        # 块内局部变量，最后一个为最内层
+        self._locals = []
+        # 与快照共享数据，写入前需要先复制
+        self._shared = False
+        self._lock = threading.Lock()
+
+    def _own(self):
+        if self._shared:
+            self._env = dict(self._env)
+            self._vars = dict(self._vars)
+            self._locals = [dict(scope) for scope in self._locals]
+            self._shared = False
+
+    def snapshot(self) -> 'VarStore':
+        """
+        创建快照，快照和原存储区中任意一方第一次写入时才复制数据
+        """
+        with self._lock:
+            store = VarStore.__new__(VarStore)
+            store.base_env = self.base_env
+            store._env = self._env
+            store._vars = self._vars
+            store._locals = self._locals
+            store._shared = True
+            store._lock = threading.Lock()
+            self._shared = True
+
+        return store
+
+    def lookup(self, name: str):
+        # 最内层的作用域优先：局部变量优先于环境变量，环境变量优先于暂存变量，
+        # 不合并字典
+        for scope in reversed(self._locals):
+            value = scope.get(name, _MISSING)
+
+            if value is not _MISSING:
+                return value
+
+        value = self._env.get(name, _MISSING)
+
+        if value is _MISSING:
+            value = self.base_env.get(name, _MISSING)
+
+        if value is _MISSING:
+            value = self._vars.get(name, _MISSING)
+
+        return value
+
+    @staticmethod
+    def convert(name: str, value, return_type: ReturnType = None):
+        """
+        按返回类型转换变量的值
+        """
+        if return_type == ReturnType.INT:
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                raise HappyPyException('变量"%s"的值不是整数：%s' % (name, value))
+        elif return_type == ReturnType.STR:
+            return value if value.__class__ is str else str(value)
+
+        return value
+
+    def set(self, name: str, value, return_type: ReturnType = None):
+        """
+        保存变量，变量已存在于块内局部变量时修改最内层的局部变量
+        """
+        value = self.convert(name, value, return_type)
+
+        with self._lock:
+            self._own()
+
+            for scope in reversed(self._locals):
+                if name in scope:
+                    scope[name] = value
+                    return value
+
+            self._vars[name] = value
+
+        return value
+
+    def get_env(self, name: str, default=None):
+        return self._env.get(name, default)
+
+    def env_items(self):
+        return self._env.items()
+
+    def env_overlay(self) -> dict:
+        """
+        ENV行设置的环境变量，返回内部字典，调用方不能修改
+        """
+        return self._env
+
+    def set_env(self, name: str, value: str):
+        with self._lock:
+            self._own()
+            self._env[name] = value
+
+    def unset_env(self, name: str):
+        with self._lock:
+            self._own()
+            self._env.pop(name, None)
+
+    def push_locals(self, variables: dict = None):
+        with self._lock:
+            self._own()
+            self._locals.append(dict(variables) if variables else dict())
+
+    def pop_locals(self) -> dict:
+        with self._lock:
+            self._own()
+            return self._locals.pop()
+
+    def environ(self):
+        """
+        执行命令使用的环境变量，没有ENV行且未指定基础环境变量时为 None，
+        即继承当前进程的环境变量
+        """
+        if not self._env and self.base_env is os.environ:
+            return None
+
+        return {**self.base_env, **self._env}
+
+    def dump(self) -> str:
+        return dict_to_pretty_json({
+            '环境变量': self._env,
+            '局部变量': self._locals,
+            '暂存变量': self._vars,
+        })
+
+    def __getitem__(self, name: str):
+        return self._vars[name]
+
+    def __setitem__(self, name: str, value):
+        self.set(name, value)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._vars
+
+    def __iter__(self):
+        return iter(self._vars)
+
+    def __len__(self) -> int:
+        return len(self._vars)
+
+    def get(self, name: str, default=None):
+        return self._vars.get(name, default)
+
+    def keys(self):
+        return self._vars.keys()
+
+    def items(self):
+        return self._vars.items()
+
+    def update(self, variables: dict):
+        for name, value in variables.items():
+            self.set(name, value)
+
+
+# 正在执行的会话，收到信号时全部取消
+_running_sessions = set()
+
+
+def cancel_running_sessions(signum: int):
+    """
+    取消当前进程中所有正在执行的会话，由信号处理函数调用
+    """
+    for session in _running_sessions.copy():
+        session.cancel(signum)
+
+
+class Session:
+    """
+    一次执行的全部状态：变量暂存区、环境变量、当前行号和日志。
+    会话之间互不影响，一个进程中可以同时执行多个会话
+    """
+
+    def __init__(self,
+                 engine: 'Engine' = None,
+                 variables: dict = None,
+                 env: dict = None,
+                 logger=None,
+                 pinned_vars=(),
+                 base_env: dict = None,
+                 cwd: str = None):
+        self.engine = engine if engine is not None else Engine()
+        self.log = logger if logger is not None else self.engine.log
+        # 变量暂存区，包括ENV行设置的环境变量
+        self.vars = VarStore(variables, env, base_env)
+        # 矩阵执行时预设的变量名，不被CONST行覆盖
+        self.pinned_vars = frozenset(pinned_vars)
+        # 会话的工作目录，默认为当前进程的工作目录
+        self.cwd = cwd
+        self.line_number = 0
+        self.failed_line = None
+        self.profiler = None
+        self.checkpoint = None
+        self.history = None
+        self.shell_backend = self.engine.shell_backend
+        self.shell_session = None
+        # 收到的取消信号和正在执行的命令；并行执行时其它行执行失败，
+        # 终止正在执行的行
+        self.cancel_signal = None
+        self.aborting = False
+        self._guards = set()
+        # 正在执行的CSV文件和被包含的文件，用于检查循环包含
+        self._include_stack = []
+        # FOREACH行并行执行的迭代
+        self._branches = set()
+        # 结构化跟踪
+        self.tracer = None
+        # 并行执行时，工作线程的当前行
+        self._row_context = threading.local()
+        self.update_log_level()
+        self._statement_namespace = {
+            '__builtins__': {},
+            **STATEMENT_BUILTINS,
+            _STATEMENT_TEXT_FUNC: self._statement_text,
+            _STATEMENT_LITERAL_FUNC: self._statement_literal,
+        }
+
+    def update_log_level(self):
+        """
+        每次执行前检查一次日志级别，关闭的TRACE、DEBUG日志不再格式化
+        """
+        self.tracing = self.log.logger.isEnabledFor(TRACE_LEVEL_NUM)
+        self.debugging = self.log.logger.isEnabledFor(logging.DEBUG)
+
+    def current_line_number(self) -> int:
+        # 并行执行时，工作线程使用各自的行号
+        return getattr(self._row_context, 'line_number', self.line_number)
+
+    def build_message(self, message: str, status) -> str:
+        if not isinstance(status, str):
+            status = 'OK' if status else 'FAILED'
+
+        return '行号：%s -> %s...[ %s ]' % (self.current_line_number(), message, status)
+
+    def build_message_no_status(self, message: str) -> str:
+        return '行号：%s -> %s' % (self.current_line_number(), message)
+
+    def lookup_var(self, var_name: str):
+        return self.vars.lookup(var_name)
+
+    def replace_var(self, s: str) -> str:
+        if self.profiler is None:
+            return _compile_var_template(s).render(self)
+
+        start = time.perf_counter()
+
+        try:
+            return _compile_var_template(s).render(self)
+        finally:
+            self.add_phase('substitute', time.perf_counter() - start)
+
+    def environ(self):
+        return self.vars.environ()
+
+    def resolve_path(self, path: str) -> str:
+        """
+        相对路径基于会话的工作目录
+        """
+        if self.cwd is None:
+            return path
+
+        return os.path.join(self.cwd, path)
+
+    def _statement_var(self, var_name: str, is_optional: bool):
+        # 与替换文本一致，感叹号开头的变量为空字符串
+        if is_optional:
+            return ''
+
+        var_value = self.lookup_var(var_name)
+
+        if var_value is _MISSING or var_value == '' or var_value is None:
+            if var_value is _MISSING:
+                self.log.error('存在未替换的变量：${%s}' % var_name)
+            else:
+                self.log.error('替换变量时出现空值：%s -> %s，type=%s'
+                               % (var_name, var_value, type(var_value)))
+
+            raise HappyPyException('变量"%s"不存在或值为空' % var_name)
+
+        return var_value
+
+    def _statement_text(self, var_name: str, is_optional: bool) -> str:
+        return str(self._statement_var(var_name, is_optional))
+
+    def _statement_literal(self, var_name: str, is_optional: bool):
+        # 与直接替换文本的效果一致：数字、布尔值等按字面量解析，其它值作为字符串
+        var_value = self._statement_var(var_name, is_optional)
+
+        if var_value.__class__ is not str:
+            return var_value
+
+        import ast
+
+        try:
+            return ast.literal_eval(var_value.strip())
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            return var_value
+
+    def evaluate_statement(self, expr_line: str, is_int: bool = False):
+        code = _compile_statement(expr_line, is_int)
+
+        if code is None:
+            code = _compile_spliced_statement(self.replace_var(expr_line), is_int)
+
+        return eval(code, self._statement_namespace)
+
+    def add_phase(self, phase: str, elapsed: float):
+        record = getattr(self._row_context, 'profile', None)
+
+        if record is not None:
+            record.phases[phase] += elapsed
+
+    def add_child_usage(self, ru):
+        record = getattr(self._row_context, 'profile', None)
+
+        if record is not None:
+            record.add_child_usage(ru)
+
+    def is_stream_log_enabled(self) -> bool:
+        return self.engine.stream_output or self.debugging
+
+    def stream_log(self, message: str):
+        # 默认为调试日志，--stream-output 时为普通日志
+        if self.engine.stream_output:
+            self.log.info(message)
+        else:
+            self.log.debug(message)
+
+    def open_shell_backend(self):
+        from shutil import which
+
+        self.shell_backend = self.engine.shell_backend
+
+        if self.shell_backend != SHELL_BACKEND_SESSION:
+            return
+
+        shell = which('bash')
+
+        if shell is None:
+            self.log.warning('未找到bash，回退到逐条命令启动shell的方式')
+            self.shell_backend = SHELL_BACKEND_SPAWN
+            return
+
+        self.shell_session = ShellSession(shell, self.log)
+
+        try:
+            base_env = self.vars.base_env
+            self.shell_session.start(None if base_env is os.environ else base_env, self.cwd)
+        except OSError as e:
+            self.log.warning('启动shell会话失败，回退到逐条命令启动shell的方式：%s' % e)
+            self.shell_session = None
+            self.shell_backend = SHELL_BACKEND_SPAWN
+
+    def add_guard(self, guard: ProcessGuard):
+        self._guards.add(guard)
+
+    def remove_guard(self, guard: ProcessGuard):
+        self._guards.discard(guard)
+
+    def cancel(self, signum: int):
+        """
+        取消执行：终止正在执行的命令，不再执行剩余的行。可以在信号处理函数中调用
+        """
+        self.cancel_signal = signum
+
+        for guard in self._guards.copy():
+            guard.cancel()
+
+        for branch in self._branches.copy():
+            branch.cancel(signum)
+
+    def abort(self):
+        """
+        其它行执行失败：终止正在执行的命令（包括并行迭代中的命令），
+        不再执行块内剩余的行
+        """
+        self.aborting = True
+
+        for guard in self._guards.copy():
+            guard.abort()
+
+        for branch in self._branches.copy():
+            branch.abort()
+
+    def close_shell_backend(self):
+        if self.shell_session is not None:
+            self.shell_session.close()
+            self.shell_session = None
+
+    def popen_cmd(self, expr_line: str, argv: tuple = None):
+        import subprocess
+
+        # 有参数列表时直接执行命令，不启动shell；独立的进程组，
+        # 超时或取消执行时终止命令启动的所有进程
+        return subprocess.Popen(expr_line if argv is None else argv, shell=argv is None, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=self.environ(), cwd=self.cwd, start_new_session=True)
+
+    def spawn_cmd(self, expr_line: str, capture: OutputCapture, guard: ProcessGuard, proc=None) -> int:
+        """
+        启动命令（或使用已启动的进程），转发输出并等待进程退出
+        """
+        import selectors
+
+        if proc is None:
+            proc = self.popen_cmd(expr_line)
+
+        guard.watch(proc)
+        pidfd = _pidfd_open(proc.pid)
+
+        try:
+            with selectors.DefaultSelector() as sel:
+                sel.register(proc.stdout, selectors.EVENT_READ, capture.feed_stdout)
+                sel.register(proc.stderr, selectors.EVENT_READ, capture.feed_stderr)
+
+                if pidfd is not None:
+                    sel.register(pidfd, selectors.EVENT_READ)
+
+                # 等待两个管道关闭且进程退出
+                while sel.get_map():
+                    for key, _ in sel.select(guard.check()):
+                        if key.data is None:
+                            sel.unregister(pidfd)
+                            continue
+
+                        data = os.read(key.fd, 65536)
+
+                        if data:
+                            key.data(data)
+                        else:
+                            sel.unregister(key.fileobj)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+
+            proc.stdout.close()
+            proc.stderr.close()
+
+        # 使用 wait4 获取子进程的资源使用情况
+        _, status, ru = os.wait4(proc.pid, 0)
+        proc.returncode = _waitstatus_to_exitcode(status)
+
+        if self.profiler is not None:
+            self.add_child_usage(ru)
+
+        return proc.returncode
+
+    def get_direct_argv(self, expr_line: str, exec_mode: str):
+        """
+        返回直接执行命令时的参数，需要通过shell执行时返回None
+        """
+        if exec_mode == EXEC_MODE_SHELL or (exec_mode == EXEC_MODE_AUTO and not self.engine.direct_exec):
+            return None
+
+        if exec_mode == EXEC_MODE_DIRECT:
+            try:
+                return tuple(shlex.split(expr_line))
+            except ValueError as e:
+                raise HappyPyException('无法拆分命令的参数：%s：%s' % (expr_line, e))
+
+        # 常驻shell会话中执行的命令可以改变会话的状态，自动判断时不绕过会话
+        if self.shell_backend == SHELL_BACKEND_SESSION and self.shell_session is not None:
+            return None
+
+        return split_direct_command(expr_line)
+
+    def execute_cmd(self, expr_line: str, capture: OutputCapture, timeout: float = None,
+                    exec_mode: str = EXEC_MODE_AUTO) -> int:
+        argv = self.get_direct_argv(expr_line, exec_mode)
+
+        if self.debugging:
+            self.log.debug('cmd=%s' % expr_line)
+
+            if argv is not None:
+                self.log.debug('直接执行，argv=%s' % list(argv))
+
+        start = time.perf_counter()
+        guard = ProcessGuard(self, timeout)
+
+        try:
+            if argv is not None:
+                # 只处理启动命令时 exec 失败的错误，此时命令没有执行；
+                # 执行过程中的错误不重新执行命令
+                try:
+                    proc = self.popen_cmd(expr_line, argv)
+                except OSError as e:
+                    if e.errno not in DIRECT_EXEC_FALLBACK_ERRNOS:
+                        raise
+
+                    proc = None
+
+                    if exec_mode == EXEC_MODE_DIRECT:
+                        # 与shell一致：命令不存在时返回127，无法执行时返回126
+                        capture.feed_stderr(('%s: %s\n' % (argv[0] if argv else '', e.strerror)).encode())
+                        return_code = 127 if e.errno == errno.ENOENT else 126
+                    else:
+                        # 命令不存在、没有执行权限或者是没有 #! 行的脚本，交给shell处理
+                        return_code = self.spawn_cmd(expr_line, capture, guard)
+
+                if proc is not None:
+                    return_code = self.spawn_cmd(expr_line, capture, guard, proc)
+            elif self.shell_backend == SHELL_BACKEND_SESSION and self.shell_session is not None:
+                return_code = self.shell_session.execute(expr_line, capture, self.vars.env_overlay(), guard)
+            else:
+                return_code = self.spawn_cmd(expr_line, capture, guard)
+        finally:
+            guard.release()
+
+        capture.close()
+
+        if self.profiler is not None:
+            self.add_phase('execute', time.perf_counter() - start)
+
+        if guard.cancelled:
+            raise RunCancelledError(self.cancel_signal)
+
+        if guard.aborted:
+            raise RowAbortedError()
+
+        if guard.timed_out:
+            import subprocess
+
+            raise subprocess.TimeoutExpired(expr_line, timeout)
+
+        if return_code != 0:
+            self.log.error('error code: %d, error message: %s' % (return_code, '\n'.join(capture.stderr_tail)))
+            self.log.error(capture.get_stdout_tail())
+
+        return return_code
+
+    def compile(self, csv_file: str) -> ExecutionPlan:
+        return compile_plan(self.resolve_path(csv_file), self.engine.use_plan_cache, self,
+                            self.engine.plan_memory_cache)
+
+    def run_include(self, include_file: str):
+        """
+        按顺序执行被包含的CSV文件中的行，相对路径基于包含它的文件所在的目录
+        """
+        if self._include_stack:
+            base_dir = os.path.dirname(self._include_stack[-1])
+        else:
+            base_dir = os.path.abspath(self.cwd or '')
+
+        path = os.path.normpath(os.path.join(base_dir, include_file))
+
+        if path in self._include_stack:
+            raise HappyPyException('循环包含CSV文件：%s' % ' -> '.join([*self._include_stack, path]))
+
+        # 使用独立的会话编译，不影响当前会话的行号和性能分析
+        compiler = Session(self.engine, logger=self.log)
+
+        try:
+            plan = compile_plan(path, self.engine.use_plan_cache, compiler, self.engine.plan_memory_cache)
+        except HappyPyException:
+            self.log.error('编译被包含的文件失败：%s' % path)
+            raise
+
+        _, suffix = getattr(self._row_context, 'label', ('', ''))
+        self._include_stack.append(path)
+
+        try:
+            # 日志中的行号为 文件:行号
+            self.run_rows(plan.rows, include_file + ':', suffix)
+        finally:
+            self._include_stack.pop()
+
+    def run_rows(self, rows: tuple, prefix: str = '', suffix: str = ''):
+        """
+        按顺序执行块内的行，日志中的行号为 前缀 + 行号 + 后缀
+        """
+        ctx = self._row_context
+        outer = ctx.__dict__.copy()
+
+        try:
+            for row in rows:
+                if self.cancel_signal is not None:
+                    raise RunCancelledError(self.cancel_signal)
+
+                if self.aborting:
+                    raise RowAbortedError()
+
+                ctx.line_number = '%s%d%s' % (prefix, row.line_number, suffix)
+                ctx.label = (prefix, suffix)
+                self.call_handler(ROW_HANDLER_MAP[row.mode_type], row)
+        finally:
+            for name in ('line_number', 'label'):
+                if name in outer:
+                    setattr(ctx, name, outer[name])
+                else:
+                    ctx.__dict__.pop(name, None)
+
+    def run_foreach(self, rows: tuple, var_name: str, values: list, parallel: int = 1):
+        """
+        每个值执行一次块内的行，循环变量为块内的局部变量。并行执行时，
+        每次迭代使用变量暂存区的快照
+        """
+        prefix, suffix = getattr(self._row_context, 'label', ('', ''))
+
+        if parallel <= 1 or len(values) <= 1:
+            for i, value in enumerate(values, 1):
+                self.vars.push_locals({var_name: value})
+
+                try:
+                    self.run_rows(rows, prefix, '%s[%d]' % (suffix, i))
+                finally:
+                    self.vars.pop_locals()
+
+            return
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='rain-foreach') as pool:
+            futures = [pool.submit(self._run_branch, rows, {var_name: value}, prefix, '%s[%d]' % (suffix, i))
+                       for i, value in enumerate(values, 1)]
+            _, pending = wait(futures, return_when=FIRST_EXCEPTION)
+
+            if pending:
+                # 任意一次迭代失败后，不再执行尚未开始的迭代，终止正在执行的迭代
+                for future in pending:
+                    future.cancel()
+
+                for branch in self._branches.copy():
+                    branch.abort()
+
+        errors = [future.exception() for future in futures
+                  if not future.cancelled() and future.exception() is not None]
+
+        if errors:
+            # 优先抛出失败的迭代的异常，而不是被终止的迭代的异常
+            raise next((e for e in errors if not isinstance(e, RowAbortedError)), errors[0])
+
+    def run_if(self, rows: tuple, skipped_rows: tuple):
+        """
+        执行IF块中条件对应分支的行，另一个分支的行不执行，按文件中的顺序记录为跳过
+        """
+        prefix, suffix = getattr(self._row_context, 'label', ('', ''))
+
+        if rows and skipped_rows and skipped_rows[0].line_number < rows[0].line_number:
+            self.skip_rows(skipped_rows, prefix, suffix)
+            self.run_rows(rows, prefix, suffix)
+        else:
+            self.run_rows(rows, prefix, suffix)
+            self.skip_rows(skipped_rows, prefix, suffix)
+
+    def skip_rows(self, rows: tuple, prefix: str, suffix: str):
+        for row in flatten_block_rows(rows):
+            if row.mode_type not in (ModeType.ELSE, ModeType.END):
+                self.log.info('行号：%s%d%s -> %s...[ SKIPPED ]'
+                              % (prefix, row.line_number, suffix, self.preview_var(row.message)))
+
+    def preview_var(self, s: str) -> str:
+        """
+        只替换已定义的变量，未定义的变量保持原样，不报错
+        """
+        if '${' not in s:
+            return s
+
+        def replace(m):
+            if m.group(1) == '!':
+                return ''
+
+            value = self.lookup_var(m.group(2))
+            return m.group(0) if value is _MISSING or value is None else str(value)
+
+        return _VAR_EXPR_PATTERN.sub(replace, s)
+
+    def _run_branch(self, rows: tuple, local_vars: dict, prefix: str, suffix: str):
+        branch = Session(self.engine, logger=self.log, pinned_vars=self.pinned_vars, cwd=self.cwd)
+        branch.vars = self.vars.snapshot()
+        branch.vars.push_locals(local_vars)
+        branch._include_stack = list(self._include_stack)
+        branch.tracer = self.tracer
+        self._branches.add(branch)
+        _job_exception_log.bind(self.log)
+
+        try:
+            if self.cancel_signal is not None:
+                branch.cancel(self.cancel_signal)
+            elif self.aborting:
+                branch.abort()
+
+            branch.run_rows(rows, prefix, suffix)
+        finally:
+            self._branches.discard(branch)
+
+    def call_handler(self, handler, row: CsvRow):
+        tracer = self.tracer
+
+        if tracer is None:
+            return handler(self, row)
+
+        row_id = next(tracer.row_ids)
+        label = self.current_line_number()
+        tracer.emit('row_start', row_id=row_id, row=label, mode=row.mode_type.name)
+        start = time.perf_counter()
+        status = 'failed'
+
+        try:
+            handler(self, row)
+            status = 'ok'
+        finally:
+            tracer.emit('row_end', row_id=row_id, row=label, status=status, elapsed=time.perf_counter() - start)
+
+    def execute_row(self, row: CsvRow):
+        handler = ROW_HANDLER_MAP.get(row.mode_type)
+
+        try:
+            if self.cancel_signal is not None:
+                raise RunCancelledError(self.cancel_signal)
+
+            if self.aborting:
+                raise RowAbortedError()
+
+            if self.profiler is None and self.history is None:
+                self.call_handler(handler, row)
+            else:
+                record = self.profiler.begin_row(row) if self.profiler is not None else None
+                self._row_context.profile = record
+                start = time.perf_counter()
+                status = 'failed'
+
+                try:
+                    self.call_handler(handler, row)
+                    status = 'ok'
+                finally:
+                    wall = time.perf_counter() - start
+
+                    if record is not None:
+                        self.profiler.end_row(record, wall, status)
+
+                    if self.history is not None:
+                        self.history.add(row, wall, status)
+
+                    self._row_context.profile = None
+        except Exception:
+            if self.failed_line is None:
+                self.failed_line = row.line_number
+
+            raise
+
+        if self.checkpoint is not None:
+            self.checkpoint.record(row)
+
+    def _run_row(self, row: CsvRow):
+        # 在线程池中执行，守护进程中错误信息写入任务的日志
+        _job_exception_log.bind(self.log)
+        self._row_context.line_number = row.line_number
+        self.execute_row(row)
+
+    def _run_plan_parallel(self, plan: ExecutionPlan, jobs: int, durations: dict = None):
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        rows = plan.rows
+        deps = build_row_dependencies(rows)
+        dependents = [[] for _ in rows]
+        remaining = [len(d) for d in deps]
+        ready = []
+
+        for i, row_deps in enumerate(deps):
+            for d in row_deps:
+                dependents[d].append(i)
+
+        # 有耗时历史时，可以执行的行中，先执行到结束为止剩余耗时最长的行；
+        # 否则按行的顺序
+        priority = [0.0] * len(rows)
+
+        if durations:
+            for i in range(len(rows) - 1, -1, -1):
+                priority[i] = min((priority[j] for j in dependents[i]), default=0.0) \
+                              - durations.get(rows[i].line_number, 0.0)
+
+        for i, row_deps in enumerate(deps):
+            if not row_deps:
+                heappush(ready, (priority[i], i))
+
+        def mark_done(index: int):
+            for j in dependents[index]:
+                remaining[j] -= 1
+
+                if remaining[j] == 0:
+                    heappush(ready, (priority[j], j))
+
+        running = dict()
+        error = None
+        failed_line = 0
+
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='rain') as pool:
+            while error is None and (ready or running):
+                deferred = []
+
+                while ready and error is None:
+                    i = heappop(ready)[1]
+                    row = rows[i]
+
+                    if row.mode_type in PARALLEL_MODE_TYPES and not is_barrier_row(row):
+                        if len(running) < jobs:
+                            running[pool.submit(self._run_row, row)] = i
+                        else:
+                            deferred.append(i)
+                    else:
+                        # 其它模式的行开销很小，在主线程按顺序执行
+                        self.line_number = row.line_number
+
+                        try:
+                            self._run_row(row)
+                            mark_done(i)
+                        except Exception as e:
+                            error = e
+                            failed_line = row.line_number
+
+                for i in deferred:
+                    heappush(ready, (priority[i], i))
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    i = running.pop(future)
+                    e = future.exception()
+
+                    if e is None:
+                        mark_done(i)
+                    elif error is None:
+                        error = e
+                        failed_line = rows[i].line_number
+
+            if error is not None:
+                # 不再调度剩余的行，终止正在执行的行并等待它们退出
+                self.log.error('第%d行执行失败，终止正在执行的%d行，不再执行剩余的行'
+                               % (failed_line, len(running)))
+                self.abort()
+                wait(running)
+                raise error
+
+    def open_checkpoint(self, plan: ExecutionPlan, state_file: str, resume: bool) -> ExecutionPlan:
+        self.checkpoint = CheckpointJournal(self, state_file)
+        done = set()
+
+        if resume:
+            if os.path.isfile(state_file):
+                done = self.checkpoint.load(plan)
+                self.log.info('从断点继续执行，跳过已执行成功的%d行' % len(done))
+            else:
+                self.log.warning('断点文件不存在，从头开始执行：%s' % state_file)
+
+        try:
+            self.checkpoint.open(plan, append=bool(done))
+        except OSError as e:
+            raise HappyPyException('无法写入断点文件：%s：%s' % (state_file, e))
+
+        if not done:
+            return plan
+
+        rows = tuple(row for row in plan.rows if row.line_number not in done)
+        return ExecutionPlan(plan.csv_file, plan.csv_hash, rows)
+
+    def run(self,
+            csv_file: str = None,
+            plan: ExecutionPlan = None,
+            profile_file: str = None,
+            profile_top_n: int = 10,
+            state_file: str = None,
+            resume: bool = False,
+            trace_file: str = None):
+        """
+        编译并执行CSV文件，已编译的执行计划可以通过 plan 传入
+        """
+        self.update_log_level()
+        self.profiler = Profiler(self.resolve_path(profile_file), profile_top_n, self.log) if profile_file else None
+        self.history = RowHistory(self.resolve_path(self.engine.history_file), self.log) \
+            if self.engine.history_file else None
+        _running_sessions.add(self)
+        status = 'failed'
+
+        try:
+            if trace_file:
+                self.tracer = TraceWriter(self.resolve_path(trace_file))
+                self.tracer.emit('run_start', csv_file=csv_file or plan.csv_file, pid=os.getpid())
+
+            if plan is None:
+                plan = self.compile(csv_file)
+
+            self._include_stack = [os.path.abspath(plan.csv_file)]
+
+            if state_file:
+                plan = self.open_checkpoint(plan, self.resolve_path(state_file), resume)
+
+            self.open_shell_backend()
+
+            try:
+                if self.engine.jobs > 1:
+                    durations = self.history.expected_durations(plan) if self.history is not None else None
+                    self._run_plan_parallel(plan, self.engine.jobs, durations)
+                else:
+                    for row_obj in plan.rows:
+                        self.line_number = row_obj.line_number
+                        self.execute_row(row_obj)
+            finally:
+                self.close_shell_backend()
+
+            # 全部执行成功，不再需要断点
+            if self.checkpoint is not None:
+                self.checkpoint.remove()
+        except BaseException as e:
+            if self.tracer is not None:
+                self.tracer.emit('run_end', status='failed', failed_line=self.failed_line, error=str(e))
+
+            raise
+        else:
+            status = 'ok'
+
+            if self.tracer is not None:
+                self.tracer.emit('run_end', status='ok')
+        finally:
+            _running_sessions.discard(self)
+
+            if self.history is not None:
+                if plan is not None:
+                    self.history.save(plan, status)
+
+                self.history = None
+
+            if self.tracer is not None:
+                self.tracer.close()
+                self.tracer = None
+
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+                self.checkpoint = None
+
+            if self.profiler is not None:
+                self.profiler.save()
+                self.profiler.log_summary()
+                self.profiler = None
+
+
+class Engine:
+    """
+    执行引擎：保存执行选项和共享的结果缓存，每次执行创建独立的会话
+    """
+
+    def __init__(self,
+                 use_plan_cache: bool = True,
+                 jobs: int = 1,
+                 shell_backend: str = SHELL_BACKEND_SPAWN,
+                 stream_output: bool = False,
+                 output_memory_limit: int = DEFAULT_OUTPUT_MEMORY_LIMIT,
+                 use_result_cache: bool = True,
+                 result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE,
+                 logger=None,
+                 plan_memory_cache: PlanMemoryCache = None,
+                 timeout: float = None,
+                 kill_grace: float = DEFAULT_KILL_GRACE,
+                 history_file: str = None,
+                 direct_exec: bool = True):
+        self.use_plan_cache = use_plan_cache
+        # 内存编译缓存，默认为进程内共用的缓存，被包含的文件在进程内只编译一次
+        self.plan_memory_cache = plan_memory_cache if plan_memory_cache is not None else _process_plan_memory_cache
+        self.jobs = jobs
+        self.shell_backend = shell_backend
+        # 没有shell特殊字符的RUN行直接执行，不启动shell
+        self.direct_exec = direct_exec
+        self.stream_output = stream_output
+        # 命令输出在内存中保留的最大字节数，超出部分写入临时文件
+        self.output_memory_limit = output_memory_limit
+        # RUN行默认的超时秒数，以及超时或取消执行后，强制结束命令前等待的秒数
+        self.timeout = timeout
+        self.kill_grace = kill_grace
+        # 行耗时历史数据库，并行执行时按历史耗时安排执行顺序
+        self.history_file = history_file
+        self.log = logger if logger is not None else log
+        self.result_cache = ResultCache(_get_plan_cache_dir() / 'results', result_cache_size) \
+            if use_result_cache else None
+
+    def session(self,
+                variables: dict = None,
+                env: dict = None,
+                logger=None,
+                pinned_vars=(),
+                base_env: dict = None,
+                cwd: str = None) -> Session:
+        return Session(self, variables, env, logger, pinned_vars, base_env, cwd)
+
+    def compile(self, csv_file: str) -> ExecutionPlan:
+        return self.session().compile(csv_file)
+
+    def run(self,
+            csv_file: str = None,
+            plan: ExecutionPlan = None,
+            variables: dict = None,
+            env: dict = None,
+            logger=None,
+            pinned_vars=(),
+            base_env: dict = None,
+            cwd: str = None,
+            **kwargs) -> Session:
+        """
+        在新的会话中执行CSV文件，返回执行完成的会话
+        """
+        session = self.session(variables, env, logger, pinned_vars, base_env, cwd)
+        session.run(csv_file, plan, **kwargs)
+        return session
+
+
+def raining(csv_file: str,
+            use_plan_cache: bool = True,
+            jobs: int = 1,
+            shell_backend: str = SHELL_BACKEND_SPAWN,
+            stream_output: bool = False,
+            output_memory_limit: int = DEFAULT_OUTPUT_MEMORY_LIMIT,
+            profile_file: str = None,
+            profile_top_n: int = 10,
+            state_file: str = None,
+            resume: bool = False,
+            use_result_cache: bool = True,
+            result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE,
+            plan: ExecutionPlan = None,
+            timeout: float = None,
+            kill_grace: float = DEFAULT_KILL_GRACE,
+            trace_file: str = None,
+            history_file: str = None,
+            direct_exec: bool = True) -> Session:
+    engine = Engine(use_plan_cache, jobs, shell_backend, stream_output, output_memory_limit,
+                    use_result_cache, result_cache_size, timeout=timeout, kill_grace=kill_grace,
+                    history_file=history_file, direct_exec=direct_exec)
+
+    return engine.run(csv_file,
+                      plan,
+                      profile_file=profile_file,
+                      profile_top_n=profile_top_n,
+                      state_file=state_file,
+                      resume=resume,
+                      trace_file=trace_file)
+
+
+def compile_only(csv_file: str) -> Path:
+    plan = compile_plan(csv_file, use_cache=False)
+    cache_file = _get_plan_cache_file(plan.csv_hash)
+
+    if not save_plan(plan, cache_file):
+        raise HappyPyException('无法写入编译结果：%s' % cache_file)
+
+    return cache_file
+
+
+# 关键路径超过该行数时，只显示开头和结尾
+CHECK_PATH_DISPLAY_LIMIT = 20
+
+
+class PlanChecker:
+    """
+    静态检查执行计划，不执行任何命令：按行的顺序推导每行执行前已经定义的变量，
+    报告未定义、被环境变量遮蔽和写入后没有被读取的变量
+    """
+
+    def __init__(self, session: 'Session', base_env=None):
+        self.session = session
+        # os.environ 每次查找都要编码变量名，复制一份
+        self.base_env = dict(os.environ if base_env is None else base_env)
+        # (级别, 行号, 消息)，级别为 error 或 warning
+        self.issues = []
+        # 变量名 -> 最近一次写入的行号
+        self.defined = dict()
+        # ENV行设置的环境变量
+        self.env_defined = set()
+        # 写入后还没有被读取的变量：变量名 -> 行号
+        self.pending = dict()
+        self.all_writes = set()
+        self.optional_reads = []
+        self.include_stack = []
+        # 遇到无法静态分析的INCLUDE行后，未定义的变量只作为警告
+        self.opaque = False
+
+    def error(self, label: str, message: str):
+        self.issues.append(('error' if not self.opaque else 'warning', label, message))
+
+    def warning(self, label: str, message: str):
+        self.issues.append(('warning', label, message))
+
+    @staticmethod
+    def row_var_refs(row: CsvRow):
+        # 不经过模板缓存，避免检查大文件时挤掉执行时使用的模板
+        for value in (row.expr_line, row.default_value, row.return_filter, row.message, *row.options.values()):
+            if '${' in value:
+                for m in _VAR_EXPR_PATTERN.finditer(value):
+                    yield m.group(2), m.group(1) == '!'
+
+    def check(self, plan: ExecutionPlan) -> list:
+        self.include_stack.append(os.path.abspath(plan.csv_file))
+        self.walk(plan.rows, '', os.path.dirname(os.path.abspath(plan.csv_file)), [])
+        self.include_stack.pop()
+
+        for name, label in self.pending.items():
+            self.warning(label, '写入的变量"%s"之后没有被读取' % name)
+
+        for label, name in self.optional_reads:
+            if name in self.all_writes or name in self.base_env:
+                self.warning(label, '${!%s}总是替换为空字符串，读取变量"%s"的值应使用${%s}'
+                             % (name, name, name))
+
+        return self.issues
+
+    def read(self, label: str, name: str, is_optional: bool, scopes: list):
+        if is_optional:
+            # 感叹号开头的变量总是替换为空，不读取变量
+            if not (scopes and any(name in scope for scope in scopes)):
+                self.optional_reads.append((label, name))
+
+            return
+
+        if scopes and any(name in scope for scope in scopes):
+            return
+
+        if name in self.defined:
+            self.pending.pop(name, None)
+        elif name in self.base_env or name in self.env_defined:
+            pass
+        else:
+            self.error(label, '变量"%s"在读取前没有被写入，也不是环境变量' % name)
+
+    def write(self, label: str, row: CsvRow, scopes: list):
+        for name in get_row_writes(row):
+            self.all_writes.add(name)
+
+            if row.mode_type == ModeType.ENV:
+                if name in self.defined:
+                    self.warning(label, 'ENV行设置的环境变量"%s"遮蔽了第%s行写入的变量'
+                                 % (name, self.defined[name]))
+
+                self.env_defined.add(name)
+                continue
+
+            if scopes and any(name in scope for scope in scopes):
+                # 修改循环变量，只在本次迭代中有效
+                continue
+
+            if name in self.base_env or name in self.env_defined:
+                self.warning(label, '变量"%s"与环境变量同名，读取时使用环境变量的值' % name)
+
+            if name in self.pending:
+                self.warning(self.pending[name], '写入的变量"%s"在第%s行被覆盖前没有被读取'
+                             % (name, label))
+
+            self.defined[name] = label
+            self.pending[name] = label
+
+    def walk(self, rows: tuple, prefix: str, base_dir: str, scopes: list):
+        for row in rows:
+            label = '%s%d' % (prefix, row.line_number)
+
+            for name, is_optional in self.row_var_refs(row):
+                self.read(label, name, is_optional, scopes)
+
+            if row.mode_type == ModeType.FOREACH:
+                self.walk_foreach(row, label, prefix, base_dir, scopes)
+            elif row.mode_type == ModeType.IF:
+                self.walk_if(row, prefix, base_dir, scopes)
+            elif row.mode_type == ModeType.INCLUDE:
+                self.walk_include(row, label, base_dir, scopes)
+            else:
+                self.write(label, row, scopes)
+
+    def walk_foreach(self, row: CsvRow, label: str, prefix: str, base_dir: str, scopes: list):
+        name = row.var_name
+
+        if name in self.base_env or name in self.env_defined:
+            self.warning(label, '循环变量"%s"在块内遮蔽了同名的环境变量' % name)
+        elif name in self.defined:
+            self.warning(label, '循环变量"%s"遮蔽了第%s行写入的变量' % (name, self.defined[name]))
+
+        parallel = int(row.options.get(ROW_OPTION_PARALLEL, 1)) > 1
+
+        if parallel:
+            # 并行迭代使用变量暂存区的快照，块内写入的变量在循环结束后丢弃
+            saved = dict(self.defined), set(self.env_defined)
+
+        before = set(self.pending.items())
+        self.walk(row.body, prefix, base_dir, [*scopes, {name}])
+
+        # 块内先读后写的变量，在下一次迭代中被读取
+        body_reads = {ref[0] for body_row in flatten_block_rows(row.body) for ref in self.row_var_refs(body_row)}
+
+        for pending_name, pending_label in list(self.pending.items()):
+            if (pending_name, pending_label) not in before and pending_name in body_reads:
+                del self.pending[pending_name]
+
+        if parallel:
+            for pending_name in [n for n, lb in self.pending.items() if (n, lb) not in before]:
+                del self.pending[pending_name]
+
+            self.defined, self.env_defined = saved
+
+    def walk_if(self, row: CsvRow, prefix: str, base_dir: str, scopes: list):
+        else_rows = row.end.body if row.end.mode_type == ModeType.ELSE else ()
+        saved = dict(self.defined), dict(self.pending), set(self.env_defined)
+
+        self.walk(row.body, prefix, base_dir, scopes)
+        defined, pending, env_defined = self.defined, self.pending, self.env_defined
+        self.defined, self.pending, self.env_defined = dict(saved[0]), dict(saved[1]), set(saved[2])
+        self.walk(else_rows, prefix, base_dir, scopes)
+
+        # 任意一个分支写入的变量在块结束后都可能已定义；
+        # 之前写入的变量只要在一个分支中被读取，就不是未使用的变量
+        self.defined = {**defined, **self.defined}
+        self.env_defined |= env_defined
+        merged = dict()
+
+        for name in pending.keys() | self.pending.keys():
+            old = saved[1].get(name)
+            labels = (pending.get(name), self.pending.get(name))
+            labels = [lb for lb in labels if lb is not None and (lb != old or labels[0] == labels[1])]
+
+            if labels:
+                merged[name] = labels[0]
+
+        self.pending = merged
+
+    def walk_include(self, row: CsvRow, label: str, base_dir: str, scopes: list):
+        if _VAR_EXPR_PATTERN.search(row.expr_line):
+            self.warning(label, '被包含的文件名中有变量，无法静态分析：%s' % row.expr_line)
+            self.opaque = True
+            return
+
+        path = os.path.normpath(os.path.join(base_dir, row.expr_line))
+
+        if path in self.include_stack:
+            cycle = ' -> '.join([*self.include_stack, path])
+            self.issues.append(('error', label, '循环包含CSV文件：%s' % cycle))
+            return
+
+        try:
+            engine = self.session.engine
+            plan = compile_plan(path, engine.use_plan_cache, Session(engine, logger=self.session.log),
+                                engine.plan_memory_cache)
+        except HappyPyException as e:
+            self.issues.append(('error', label, '编译被包含的文件失败：%s：%s' % (row.expr_line, e)))
+            return
+
+        self.include_stack.append(path)
+        self.walk(plan.rows, row.expr_line + ':', os.path.dirname(path), scopes)
+        self.include_stack.pop()
+
+
+def load_row_durations(profile_file: str) -> dict:
+    """
+    从 --profile 输出的文件中读取每行的耗时
+    """
+    try:
+        with open(profile_file, encoding='UTF-8') as f:
+            return {record['line_number']: record['wall'] for record in json.load(f)['rows']}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise HappyPyException('读取行耗时失败：%s：%s' % (profile_file, e))
+
+
+def build_plan_graph(plan: ExecutionPlan, durations: dict = None) -> dict:
+    """
+    生成最外层行的依赖图和关键路径。没有历史耗时时，每行的权重为1
+    """
+    rows = plan.rows
+    deps = build_row_dependencies(rows)
+    weights = [durations.get(row.line_number, 0.0) if durations is not None else 1 for row in rows]
+    finish = [0] * len(rows)
+    prev = [None] * len(rows)
+
+    # 依赖的行总在前面，按顺序计算每行最早的完成时间
+    for i, row_deps in enumerate(deps):
+        start = 0
+
+        for d in row_deps:
+            if finish[d] > start:
+                start = finish[d]
+                prev[i] = d
+
+        finish[i] = start + weights[i]
+
+    path = []
+    i = max(range(len(rows)), key=finish.__getitem__) if rows else None
+
+    while i is not None:
+        path.append(i)
+        i = prev[i]
+
+    path.reverse()
+    critical = set(path)
+    total = sum(weights)
+    length = finish[path[-1]] if path else 0
+
+    return {
+        'csv_file': plan.csv_file,
+        'weighted_by': 'durations' if durations is not None else 'rows',
+        'nodes': [{'line': row.line_number, 'mode': row.mode_type.name, 'message': row.message,
+                   'weight': weights[i], 'critical': i in critical} for i, row in enumerate(rows)],
+        'edges': [[rows[d].line_number, rows[i].line_number]
+                  for i, row_deps in enumerate(deps) for d in sorted(row_deps)],
+        'critical_path': [rows[i].line_number for i in path],
+        'total': total,
+        'critical_length': length,
+        'parallelism': total / length if length else 1.0,
+    }
+
+
+def format_graph_dot(graph: dict) -> str:
+    lines = ['digraph plan {', '    node [shape=box];']
+
+    for node in graph['nodes']:
+        label = '%d %s\\n%s' % (node['line'], node['mode'], node['message'].replace('"', '\\"'))
+        style = ', color=red, penwidth=2' if node['critical'] else ''
+        lines.append('    n%d [label="%s"%s];' % (node['line'], label, style))
+
+    for src, dst in graph['edges']:
+        lines.append('    n%d -> n%d;' % (src, dst))
+
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def check_csv_file(csv_file: str,
+                   use_plan_cache: bool = True,
+                   graph_file: str = None,
+                   durations_file: str = None,
+                   history_file: str = None) -> bool:
+    """
+    静态检查CSV文件，打印检查结果和关键路径，返回是否没有错误
+    """
+    start = time.perf_counter()
+    session = Engine(use_plan_cache=use_plan_cache, use_result_cache=False).session()
+    plan = session.compile(csv_file)
+    issues = PlanChecker(session).check(plan)
+
+    if durations_file:
+        durations = load_row_durations(durations_file)
+    elif history_file:
+        durations = RowHistory(history_file).expected_durations(plan)
+    else:
+        durations = None
+
+    graph = build_plan_graph(plan, durations)
+    elapsed = time.perf_counter() - start
+
+    for level, label, message in issues:
+        (log.error if level == 'error' else log.warning)('第%s行->%s' % (label, message))
+
+    errors = sum(1 for issue in issues if issue[0] == 'error')
+    path = [str(line) for line in graph['critical_path']]
+
+    if len(path) > CHECK_PATH_DISPLAY_LIMIT:
+        path[CHECK_PATH_DISPLAY_LIMIT // 2:-CHECK_PATH_DISPLAY_LIMIT // 2] = ['...']
+
+    log.info('%s：%d个错误，%d个警告，检查耗时%.1fms'
+             % (csv_file, errors, len(issues) - errors, elapsed * 1000))
+
+    if durations is not None:
+        weight = '，耗时%.3fs，全部%.3fs' % (graph['critical_length'], graph['total'])
+    else:
+        weight = '，全部%d行' % graph['total']
+
+    log.info('关键路径：%s（共%d行%s，最大并行度%.2f）'
+             % (' -> '.join(path), len(graph['critical_path']), weight, graph['parallelism']))
+
+    if graph_file:
+        with open(graph_file, 'w', encoding='UTF-8') as f:
+            if graph_file.endswith('.dot'):
+                f.write(format_graph_dot(graph))
+            else:
+                json.dump(graph, f, ensure_ascii=False, indent=2)
+
+        log.info('依赖图已写入：%s' % graph_file)
+
+    return errors == 0
+
+
+def report_row_history(csv_file: str,
+                       history_file: str,
+                       threshold: float = HISTORY_REGRESSION_THRESHOLD,
+                       use_plan_cache: bool = True) -> bool:
+    """
+    打印每行的耗时统计，返回是否没有性能退化的行：
+    最近一次耗时超过之前中位数的 threshold 倍
+    """
+    session = Engine(use_plan_cache=use_plan_cache, use_result_cache=False).session()
+    plan = session.compile(csv_file)
+    history = RowHistory(history_file)
+    regressed = 0
+
+    durations = history.load(plan)
+
+    for row in plan.rows:
+        walls = durations[row.line_number]
+
+        if not walls:
+            continue
+
+        latest = walls[-1]
+        ordered = sorted(walls)
+        log.info('行号：%d -> %s 执行%d次，p50 %.3fs，p95 %.3fs，最近 %.3fs'
+                 % (row.line_number, row.message, len(walls), percentile(ordered, 50), percentile(ordered, 95),
+                    latest))
+
+        if len(walls) < 2:
+            continue
+
+        before = percentile(sorted(walls[:-1]), 50)
+
+        if latest > before * threshold and latest - before >= HISTORY_REGRESSION_MIN_SECONDS:
+            regressed += 1
+            log.warning('行号：%d -> 耗时退化：最近 %.3fs，之前的中位数 %.3fs（%.1f倍）'
+                        % (row.line_number, latest, before, latest / before if before else float('inf')))
+
+    log.info('%s：%d行有耗时历史，%d行耗时退化'
+             % (csv_file, sum(1 for walls in durations.values() if walls), regressed))
+    return regressed == 0
+
+
+class _LogPrefixFilter(logging.Filter):
+    """
+    批量执行时，在每条日志前加上CSV文件名，区分不同进程的输出
+    """
+
+    def __init__(self, prefix: str):
+        super().__init__()
+        self.prefix = prefix
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = '[%s] %s' % (self.prefix, record.msg)
+        return True
+
+
+def expand_csv_files(patterns: list) -> list:
+    """
+    展开命令行指定的CSV文件：目录表示其中所有的.csv文件，支持通配符，
+    重复的文件只保留一个
+    """
+    csv_files = []
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matched = sorted(glob.glob(os.path.join(pattern, '*.csv')))
+        elif glob.has_magic(pattern):
+            matched = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matched = [pattern]
+
+        if not matched:
+            raise HappyPyException('没有找到匹配的CSV文件：%s' % pattern)
+
+        for csv_file in matched:
+            if csv_file not in csv_files:
+                csv_files.append(csv_file)
+
+    return csv_files
+
+
+# 工作进程收到的取消信号，之后分配的任务不再执行
+_worker_cancel_signal = None
+
+
+# noinspection PyUnusedLocal
+def _cancel_handler(sig, frame):
+    global _worker_cancel_signal
+    _worker_cancel_signal = sig
+    cancel_running_sessions(sig)
+
+
+def _init_batch_worker(log_level: int):
+    log.set_level(log_level)
+    # Ctrl+C 同时发送给父进程和工作进程，工作进程取消正在执行的任务
+    signal.signal(signal.SIGINT, _cancel_handler)
+    signal.signal(signal.SIGTERM, _cancel_handler)
+
+
+def _run_batch_task(csv_file: str, options: dict, label: str, seed_vars: dict = None, plan=None) -> dict:
+    """
+    在工作进程中执行一个CSV文件，每个任务使用独立的会话
+    """
+    session = Engine(**options).session(variables=seed_vars, pinned_vars=seed_vars or ())
+    prefix_filter = _LogPrefixFilter(label)
+    log.logger.addFilter(prefix_filter)
+    result = {'label': label, 'csv_file': csv_file, 'success': True, 'exit_code': 0, 'failed_line': None, 'error': None}
+    start = time.perf_counter()
+
+    if _worker_cancel_signal is not None:
+        session.cancel(_worker_cancel_signal)
+
+    try:
+        session.run(csv_file, plan)
+    except Exception as e:
+        result.update(success=False, exit_code=getattr(e, 'exit_code', 1),
+                      failed_line=session.failed_line or session.line_number or None, error=str(e))
+
+        if not isinstance(e, HappyPyException):
+            log.critical('执行时出现未知错误：%r' % e)
+    finally:
+        result['duration'] = time.perf_counter() - start
+        log.logger.removeFilter(prefix_filter)
+
+    if seed_vars is not None:
+        result['seed_vars'] = seed_vars
+        result['vars'] = {k: v if isinstance(v, (int, float, bool)) or v is None else str(v)
+                          for k, v in session.vars.items()}
+
+    return result
+
+
+def _run_tasks(tasks: list, processes: int, log_level: int) -> list:
+    """
+    用进程池执行任务，打印汇总结果，返回与任务顺序一致的执行结果
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    processes = max(1, min(processes, len(tasks)))
+    results = dict()
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=_init_batch_worker,
+                             initargs=(log_level,)) as executor:
+        futures = {executor.submit(_run_batch_task, *task): i for i, task in enumerate(tasks)}
+
+        for future in as_completed(futures):
+            i = futures[future]
+
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # 工作进程异常退出
+                results[i] = {'label': tasks[i][2], 'csv_file': tasks[i][0], 'success': False, 'exit_code': 1,
+                              'failed_line': None, 'error': '工作进程异常退出：%r' % e, 'duration': 0.0}
+
+    results = [results[i] for i in range(len(tasks))]
+    failed = [result for result in results if not result['success']]
+
+    log.info('执行结果：')
+
+    for result in results:
+        line = '  %s %8.2fs  %s' % ('通过' if result['success'] else '失败', result['duration'], result['label'])
+
+        if not result['success']:
+            if result['failed_line']:
+                line += '，第%d行' % result['failed_line']
+
+            line += '：%s' % result['error']
+            log.error(line)
+        else:
+            log.info(line)
+
+    log.info('共%d个任务，通过%d个，失败%d个，总耗时%.2fs'
+             % (len(results), len(results) - len(failed), len(failed), time.perf_counter() - start))
+
+    return results
+
+
+def run_batch(csv_files: list, processes: int, options: dict, log_level: int = HappyLogLevel.INFO.value) -> bool:
+    """
+    用进程池批量执行多个CSV文件，打印汇总结果，全部执行成功时返回True
+    """
+    log.info('批量执行%d个CSV文件，进程数：%d' % (len(csv_files), max(1, min(processes, len(csv_files)))))
+    tasks = [(csv_file, options, csv_file) for csv_file in csv_files]
+
+    return all(result['success'] for result in _run_tasks(tasks, processes, log_level))
+
+
+def load_matrix(matrix_file: str) -> list:
+    """
+    读取矩阵文件，返回变量集合列表：CSV文件第一行为变量名，之后每行为一组变量值；
+    JSON文件为对象数组
+    """
+    import csv
+
+    try:
+        if matrix_file.endswith('.json'):
+            with open(matrix_file, encoding='UTF-8') as f:
+                matrix = json.load(f)
+        else:
+            with open(matrix_file, newline='', encoding='UTF-8') as f:
+                matrix = [dict(cell) for cell in csv.DictReader(f)]
+    except (OSError, ValueError) as e:
+        raise HappyPyException('读取矩阵文件失败：%s：%s' % (matrix_file, e))
+
+    if not isinstance(matrix, list) or not matrix:
+        raise HappyPyException('矩阵文件应包含至少一组变量：%s' % matrix_file)
+
+    for i, cell in enumerate(matrix, 1):
+        if not isinstance(cell, dict):
+            raise HappyPyException('矩阵文件第%d组变量应为对象：%s' % (i, matrix_file))
+
+        for name, value in cell.items():
+            if not isinstance(name, str) or not _is_alpha_num_underline_str(name):
+                raise HappyPyException('矩阵文件第%d组变量：无效的变量名"%s"' % (i, name))
+
+            if value is None or isinstance(value, (list, dict)):
+                raise HappyPyException('矩阵文件第%d组变量：变量"%s"的值应为字符串或数字'
+                                       % (i, name))
+
+    return matrix
+
+
+def run_matrix(csv_file: str,
+               matrix_file: str,
+               processes: int,
+               options: dict,
+               log_level: int = HappyLogLevel.INFO.value,
+               result_file: str = None) -> bool:
+    """
+    用矩阵文件中的每组变量执行同一个CSV文件，CSV文件只编译一次，
+    全部执行成功时返回True
+    """
+    matrix = load_matrix(matrix_file)
+    plan = Engine(**options).compile(csv_file)
+    log.info('矩阵执行%s：%d组变量，进程数：%d'
+             % (csv_file, len(matrix), max(1, min(processes, len(matrix)))))
+
+    tasks = []
+
+    for i, seed_vars in enumerate(matrix, 1):
+        label = '%s#%d %s' % (Path(csv_file).name, i, ','.join('%s=%s' % item for item in seed_vars.items()))
+        tasks.append((csv_file, options, label, seed_vars, plan))
+
+    results = _run_tasks(tasks, processes, log_level)
+
+    if result_file:
+        try:
+            with open(result_file, 'w', encoding='UTF-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            raise HappyPyException('写入矩阵执行结果失败：%s：%s' % (result_file, e))
+
+        log.info('矩阵执行结果：%s' % result_file)
+
+    return all(result['success'] for result in results)
+
+
+class JobLog(HappyLog):
+    """
+    守护进程中一个任务的日志，接口与 HappyLog 相同，每条日志发送给提交任务的客户端
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, send, log_level: int = HappyLogLevel.INFO.value):
+        self.logger = logging.Logger('rain_shell_scripter.job')
+        self.logger.addHandler(_JobLogHandler(send))
+        self.set_level(log_level)
+
+
+class JobExceptionLog:
+    """
+    守护进程中 HappyPyException 使用的日志：
+    构造异常时的错误信息写入当前线程所属任务的日志，
+    不属于任务时写入守护进程的日志
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def bind(self, logger):
+        self.local.logger = logger
+
+    def error(self, msg):
+        (getattr(self.local, 'logger', None) or log).error(msg)
+
+
+_job_exception_log = JobExceptionLog()
+
+
+class _JobLogHandler(logging.Handler):
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record: logging.LogRecord):
+        self.send({'type': 'log', 'time': record.created, 'level': record.levelname, 'message': record.getMessage()})
+
+
+class _JobRequestHandler:
+    """
+    一个连接提交一个任务：请求为一行JSON，应答为多行JSON，最后一行为任务的退出状态。
+    与 socketserver.StreamRequestHandler 组合使用
+    """
+
+    def send(self, message: dict):
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(message, ensure_ascii=False) + '\n').encode('UTF-8'))
+            except OSError:
+                # 客户端已断开，任务继续执行
+                pass
+
+    def handle(self):
+        self.lock = threading.Lock()
+
+        try:
+            job = json.loads(self.rfile.readline())
+
+            if not isinstance(job, dict):
+                raise ValueError('应为JSON对象')
+        except ValueError as e:
+            self.send({'type': 'exit', 'code': 2, 'error': '无效的任务请求：%s' % e})
+            return
+
+        self.send({'type': 'exit', **self.server.run_job(job, self.send)})
+
+
+class JobServer:
+    """
+    守护进程：在Unix套接字上接收任务，每个任务在独立的线程和会话中执行，
+    共用内存中的编译缓存。
+    与 socketserver.ThreadingUnixStreamServer 组合使用，见 create_job_server
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, handler_class):
+        super().__init__(socket_path, handler_class)
+        self.socket_path = socket_path
+        self.plan_memory_cache = PlanMemoryCache()
+        self.job_ids = count(1)
+
+    def server_bind(self):
+        # 任务使用守护进程用户的权限执行，只允许同一用户连接：
+        # 创建时就不允许其它用户访问，之后再明确设置权限
+        old_umask = os.umask(0o177)
+
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+        os.chmod(self.server_address, 0o600)
+
+    def run_job(self, job: dict, send) -> dict:
+        job_id = next(self.job_ids)
+        csv_file = job.get('csv_file')
+        cwd = job.get('cwd') or os.getcwd()
+        job_log = JobLog(send, int(job.get('log_level', HappyLogLevel.INFO.value)))
+        log.info('任务%d开始：%s（工作目录：%s）' % (job_id, csv_file, cwd))
+        result = {'code': 0, 'error': None}
+        start = time.perf_counter()
+        _job_exception_log.bind(job_log)
+
+        try:
+            if not csv_file:
+                raise HappyPyException('任务请求缺少CSV文件')
+
+            shell_backend = job.get('shell_backend', SHELL_BACKEND_SPAWN)
+
+            if shell_backend not in SHELL_BACKENDS:
+                raise HappyPyException('无效的执行方式：%s' % shell_backend)
+
+            engine = Engine(use_plan_cache=job.get('use_plan_cache', True),
+                            jobs=int(job.get('jobs', 1)),
+                            shell_backend=shell_backend,
+                            stream_output=job.get('stream_output', False),
+                            use_result_cache=job.get('use_result_cache', True),
+                            logger=job_log,
+                            plan_memory_cache=self.plan_memory_cache,
+                            timeout=job.get('timeout'))
+            engine.run(csv_file, variables=job.get('variables'), base_env=job.get('env'), cwd=cwd)
+        except HappyPyException as e:
+            result.update(code=getattr(e, 'exit_code', 1), error=str(e))
+        except Exception as e:
+            log.critical('任务%d执行时出现未知错误：%r' % (job_id, e))
+            result.update(code=1, error='执行时出现未知错误：%r' % e)
+        finally:
+            _job_exception_log.bind(None)
+
+        log.info('任务%d结束：%s，退出代码：%d，耗时%.2fs'
+                 % (job_id, csv_file, result['code'], time.perf_counter() - start))
+        return result
+
+
+def create_job_server(socket_path: str) -> JobServer:
+    # socketserver 只在守护进程中导入
+    import socketserver
+
+    handler_class = type('JobRequestHandler', (_JobRequestHandler, socketserver.StreamRequestHandler), {})
+    server_class = type('UnixJobServer', (JobServer, socketserver.ThreadingUnixStreamServer), {})
+    return server_class(socket_path, handler_class)
+
+
+def serve(socket_path: str):
+    """
+    以守护进程方式运行，直到收到 SIGTERM 或 Ctrl+C
+    """
+    import socket
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            probe.connect(socket_path)
+            raise HappyPyException('守护进程已在运行：%s' % socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # 上次退出时遗留的套接字文件
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    try:
+        server = create_job_server(socket_path)
+    except OSError as e:
+        raise HappyPyException('无法监听套接字：%s：%s' % (socket_path, e))
+
+    # 任务执行时的错误信息写入任务的日志，发送给提交任务的客户端
+    HappyPyException.hlog = _job_exception_log
+
+    # noinspection PyUnusedLocal
+    def shutdown_handler(sig, frame):
+        log.info('收到信号%d，取消正在执行的任务，守护进程退出......' % sig)
+        cancel_running_sessions(sig)
+        # shutdown 会等待 serve_forever 结束，不能在同一个线程中调用
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+
+    log.info('守护进程已启动：%s' % socket_path)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def submit_job(socket_path: str, job: dict) -> int:
+    """
+    向守护进程提交任务，打印任务的日志，返回任务的退出代码
+    """
+    import socket
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    except OSError as e:
+        print('无法连接守护进程：%s：%s' % (socket_path, e), file=sys.stderr)
+        return 2
+
+    with sock, sock.makefile('rwb') as f:
+        f.write((json.dumps(job, ensure_ascii=False) + '\n').encode('UTF-8'))
+        f.flush()
+
+        for line in f:
+            message = json.loads(line)
+
+            if message['type'] == 'log':
+                print('%s [%s] %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(message['time'])),
+                                      message['level'], message['message']), flush=True)
+            elif message['type'] == 'exit':
+                if message['error']:
+                    print(message['error'], file=sys.stderr)
+
+                return message['code']
+
+    print('守护进程意外断开连接', file=sys.stderr)
+    return 2
+
+
+def client_main():
+    parser = argparse.ArgumentParser(prog='rain_shell_scripter_client',
+                                     description='向 rain_shell_scripter --serve 启动的守护进程'
+                                                 '提交CSV文件，使用当前的工作目录和环境变量执行')
+
+    parser.add_argument('-s',
+                        '--socket',
+                        help='守护进程监听的Unix套接字',
+                        required=True,
+                        action='store',
+                        dest='socket_path')
+
+    parser.add_argument('-f',
+                        '--file',
+                        help='CSV文件',
+                        required=True,
+                        action='store',
+                        dest='csv_file')
+
+    parser.add_argument('-l',
+                        '--log-level',
+                        help='日志级别，CRITICAL|ERROR|WARNING|INFO|DEBUG|TRACE，默认等级3（INFO）',
+                        type=int,
+                        choices=HappyLogLevel.get_list(),
+                        default=HappyLogLevel.INFO.value,
+                        required=False,
+                        dest='log_level')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        help='并行执行互不依赖的RUN、COPY行的最大数量，默认为1（顺序执行）',
+                        type=int,
+                        default=1,
+                        required=False,
+                        dest='jobs')
+
+    parser.add_argument('--shell-backend',
+                        help='RUN行的执行方式：spawn（默认）|session',
+                        choices=SHELL_BACKENDS,
+                        default=SHELL_BACKEND_SPAWN,
+                        required=False,
+                        dest='shell_backend')
+
+    parser.add_argument('--stream-output',
+                        help='实时打印RUN行的输出',
+                        action='store_true',
+                        default=False,
+                        dest='stream_output')
+
+    parser.add_argument('--no-plan-cache',
+                        help='不读写编译缓存',
+                        action='store_true',
+                        default=False,
+                        dest='no_plan_cache')
+
+    parser.add_argument('--no-cache',
+                        help='不使用RUN行的结果缓存',
+                        action='store_true',
+                        default=False,
+                        dest='no_cache')
+
+    parser.add_argument('--timeout',
+                        help='RUN行默认的超时秒数，超时后终止命令',
+                        type=float,
+                        required=False,
+                        dest='timeout')
+
+    args = parser.parse_args()
+
+    job = dict(csv_file=args.csv_file,
+               cwd=os.getcwd(),
+               env=dict(os.environ),
+               log_level=args.log_level,
+               jobs=args.jobs,
+               shell_backend=args.shell_backend,
+               stream_output=args.stream_output,
+               use_plan_cache=not args.no_plan_cache,
+               use_result_cache=not args.no_cache,
+               timeout=args.timeout)
+
+    exit(submit_job(args.socket_path, job))
+
+
+def main():
+    global log
+    parser = argparse.ArgumentParser(prog='rain_shell_scripter',
+                                     description='用Python加持Linux Shell脚本，编写CSV文件即可完美解决脚本中的返回值、数值运算、错误处理、流程控制难题~',
+                                     usage='%(prog)s -f|-l|-c|--serve')
+
+    parser.add_argument('-f',
+                        '--file',
+                        help='CSV文件，可以指定多个文件、目录或通配符，多个文件时批量执行',
+                        required=False,
+                        nargs='+',
+                        action='store',
+                        dest='csv_files')
+
+    parser.add_argument('-l',
+                        '--log-level',
+                        help='日志级别，CRITICAL|ERROR|WARNING|INFO|DEBUG|TRACE，默认等级3（INFO）',
+                        type=int,
+                        choices=HappyLogLevel.get_list(),
+                        default=HappyLogLevel.INFO.value,
+                        required=False,
+                        dest='log_level')
+
+    parser.add_argument('-c',
+                        '--compile-only',
+                        help='仅解析和校验CSV文件，输出编译结果路径，不执行',
+                        action='store_true',
+                        default=False,
+                        dest='compile_only')
+
+    parser.add_argument('--check',
+                        help='静态检查CSV文件，报告未定义、被遮蔽和未使用的变量，'
+                             '以及行的关键路径，不执行',
+                        action='store_true',
+                        default=False,
+                        dest='check')
+
+    parser.add_argument('--graph',
+                        help='--check 时把行的依赖图写入指定文件，扩展名为 .dot 时为DOT格式，'
+                             '否则为JSON格式',
+                        action='store',
+                        required=False,
+                        dest='graph_file')
+
+    parser.add_argument('--durations',
+                        help='--check 时按 --profile 记录的每行耗时计算关键路径',
+                        action='store',
+                        required=False,
+                        dest='durations_file')
+
+    parser.add_argument('--no-plan-cache',
+                        help='不读写编译缓存',
+                        action='store_true',
+                        default=False,
+                        dest='no_plan_cache')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        help='并行执行互不依赖的RUN、COPY行的最大数量，默认为1（顺序执行）；'
+                             '批量执行时为进程数',
+                        type=int,
+                        default=1,
+                        required=False,
+                        dest='jobs')
+
+    parser.add_argument('--shell-backend',
+                        help='RUN行的执行方式：spawn（每条命令启动一个shell，默认）|'
+                             'session（所有命令共用一个常驻bash进程）',
+                        choices=SHELL_BACKENDS,
+                        default=SHELL_BACKEND_SPAWN,
+                        required=False,
+                        dest='shell_backend')
+
+    parser.add_argument('--stream-output',
+                        help='实时打印RUN行的输出，默认只在调试模式下打印',
+                        action='store_true',
+                        default=False,
+                        dest='stream_output')
+
+    parser.add_argument('--no-direct-exec',
+                        help='所有RUN行都通过shell执行；默认没有shell特殊字符的命令直接执行，'
+                             '不启动shell',
+                        action='store_true',
+                        default=False,
+                        dest='no_direct_exec')
+
+    parser.add_argument('--output-memory-limit',
+                        help='RUN行输出在内存中保留的最大字节数，超出部分写入临时文件，'
+                             '默认1MiB',
+                        type=int,
+                        default=DEFAULT_OUTPUT_MEMORY_LIMIT,
+                        required=False,
+                        dest='output_memory_limit')
+
+    parser.add_argument('--profile',
+                        help='记录每行的耗时和子进程资源使用情况，'
+                             '结果以JSON格式写入指定文件',
+                        action='store',
+                        required=False,
+                        dest='profile_file')
+
+    parser.add_argument('--profile-top',
+                        help='执行结束后打印耗时最长的行数，默认10',
+                        type=int,
+                        default=10,
+                        required=False,
+                        dest='profile_top_n')
+
+    parser.add_argument('--trace',
+                        help='结构化跟踪：'
+                             '每行的开始、结束时间和状态以JSON行格式写入指定文件',
+                        action='store',
+                        required=False,
+                        dest='trace_file')
+
+    parser.add_argument('--history',
+                        help='执行结束后把每行的耗时追加到指定的SQLite数据库；'
+                             '并行执行时先执行剩余耗时最长的行，'
+                             '--check 时按耗时的中位数计算关键路径',
+                        action='store',
+                        required=False,
+                        dest='history_file')
+
+    parser.add_argument('--history-report',
+                        help='打印 --history 中每行耗时的p50、p95，报告耗时退化的行，不执行',
+                        action='store_true',
+                        default=False,
+                        dest='history_report')
+
+    parser.add_argument('--regression-threshold',
+                        help='最近一次耗时超过之前中位数的倍数时视为耗时退化，'
+                             '默认为%(default)s',
+                        type=float,
+                        default=HISTORY_REGRESSION_THRESHOLD,
+                        dest='regression_threshold')
+
+    parser.add_argument('--state-file',
+                        help='断点文件，每行执行成功后记录执行进度，全部执行成功后删除',
+                        action='store',
+                        required=False,
+                        dest='state_file')
+
+    parser.add_argument('--resume',
+                        help='从断点文件记录的进度继续执行，需要同时指定--state-file',
+                        action='store_true',
+                        default=False,
+                        dest='resume')
+
+    parser.add_argument('--no-cache',
+                        help='不使用RUN行的结果缓存（cache_inputs、cache_outputs选项）',
+                        action='store_true',
+                        default=False,
+                        dest='no_cache')
+
+    parser.add_argument('--cache-size',
+                        help='结果缓存的最大容量（MiB），超出时淘汰最久未使用的结果，'
+                             '默认1024',
+                        type=int,
+                        default=DEFAULT_RESULT_CACHE_SIZE // 1024 // 1024,
+                        required=False,
+                        dest='cache_size')
+
+    parser.add_argument('--matrix',
+                        help='矩阵文件（CSV或JSON），用其中的每组变量执行同一个CSV文件，'
+                             '-j 为同时执行的进程数',
+                        action='store',
+                        required=False,
+                        dest='matrix_file')
+
+    parser.add_argument('--matrix-result',
+                        help='矩阵执行结果（每组变量的执行状态、耗时和最终的变量）'
+                             '以JSON格式写入指定文件',
+                        action='store',
+                        required=False,
+                        dest='matrix_result_file')
+
+    parser.add_argument('--timeout',
+                        help='RUN行默认的超时秒数，超时后终止命令的进程组，退出代码为124；'
+                             '行选项 timeout 优先',
+                        type=float,
+                        required=False,
+                        dest='timeout')
+
+    parser.add_argument('--kill-grace',
+                        help='超时或收到 SIGINT、SIGTERM 信号时，先发送 SIGTERM，'
+                             '等待指定秒数后强制结束命令，默认5',
+                        type=float,
+                        default=DEFAULT_KILL_GRACE,
+                        required=False,
+                        dest='kill_grace')
+
+    parser.add_argument('--serve',
+                        help='以守护进程方式运行，在指定的Unix套接字上接收 '
+                             'rain_shell_scripter_client 提交的任务',
+                        action='store',
+                        required=False,
+                        dest='serve_socket')
+
+    parser.add_argument('-v',
+                        '--version',
+                        help='显示版本信息',
+                        action='version',
+                        version='%(prog)s/v' + __version__)
+
+    args = parser.parse_args()
+
+    if args.resume and not args.state_file:
+        parser.error('--resume 需要同时指定 --state-file')
+
+    if not args.csv_files and not args.serve_socket:
+        parser.error('需要指定 -f 或 --serve')
+
+    log.set_level(args.log_level)
+
+    received_signals = []
 
     # noinspection PyUnusedLocal
-    def sigint_handler(sig, frame):
-        log.info('\n\n收到 Ctrl+C 信号，退出......')
+    def cancel_handler(sig, frame):
+        received_signals.append(sig)
+        log.info('\n\n收到%s信号，终止正在执行的命令，退出......' % signal.Signals(sig).name)
+        cancel_running_sessions(sig)
 
-    # 前台运行收到 CTRL+C 信号，直接退出。
-    signal.signal(signal.SIGINT, sigint_handler)
+    # 收到 CTRL+C 或 SIGTERM 信号，终止正在执行的命令，不再执行剩余的行
+    signal.signal(signal.SIGINT, cancel_handler)
+    signal.signal(signal.SIGTERM, cancel_handler)
 
     try:
-        raining(args.csv_file)
-        log.debug('变量暂存区：\n' + dict_to_pretty_json(_var_tmp_storage_area))
+        if args.serve_socket:
+            serve(args.serve_socket)
+            return
+
+        csv_files = expand_csv_files(args.csv_files)
+
+        if args.check:
+            if len(csv_files) > 1 and args.graph_file:
+                parser.error('检查多个CSV文件时，不支持 --graph')
+
+            ok = [check_csv_file(csv_file, not args.no_plan_cache, args.graph_file, args.durations_file,
+                                 args.history_file)
+                  for csv_file in csv_files]
+
+            if not all(ok):
+                exit(1)
+            return
+
+        if args.history_report:
+            if not args.history_file:
+                parser.error('--history-report 需要用 --history 指定耗时历史数据库')
+
+            ok = [report_row_history(csv_file, args.history_file, args.regression_threshold, not args.no_plan_cache)
+                  for csv_file in csv_files]
+
+            if not all(ok):
+                exit(1)
+            return
+
+        if args.compile_only:
+            for csv_file in csv_files:
+                cache_file = compile_only(csv_file)
+                log.info('编译完成：%s -> %s' % (csv_file, cache_file))
+                print(cache_file)
+            return
+
+        options = dict(use_plan_cache=not args.no_plan_cache,
+                       shell_backend=args.shell_backend,
+                       stream_output=args.stream_output,
+                       output_memory_limit=args.output_memory_limit,
+                       use_result_cache=not args.no_cache,
+                       result_cache_size=args.cache_size * 1024 * 1024,
+                       timeout=args.timeout,
+                       kill_grace=args.kill_grace,
+                       direct_exec=not args.no_direct_exec,
+                       history_file=os.path.abspath(args.history_file) if args.history_file else None)
+
+        if args.matrix_file:
+            if len(csv_files) > 1 or args.state_file or args.profile_file or args.trace_file:
+                parser.error('矩阵执行只支持一个CSV文件，不支持 --state-file、--profile、--trace')
+
+            if not run_matrix(csv_files[0], args.matrix_file, args.jobs, options, args.log_level,
+                              args.matrix_result_file):
+                exit(128 + received_signals[0] if received_signals else 1)
+            return
+
+        if len(csv_files) > 1:
+            if args.state_file or args.profile_file or args.trace_file:
+                parser.error('批量执行多个CSV文件时，不支持 --state-file、--profile、--trace')
+
+            if not run_batch(csv_files, args.jobs, options, args.log_level):
+                exit(128 + received_signals[0] if received_signals else 1)
+            return
+
+        session = raining(csv_files[0],
+                          jobs=args.jobs,
+                          profile_file=args.profile_file,
+                          profile_top_n=args.profile_top_n,
+                          state_file=args.state_file,
+                          resume=args.resume,
+                          trace_file=args.trace_file,
+                          **options)
+
+        if session.debugging:
+            log.debug('变量暂存区：\n' + session.vars.dump())
     except HappyPyException as e:
         log.error(e)
-        exit(1)
+        exit(getattr(e, 'exit_code', 1))
 
 
 if __name__ == '__main__':
@@ -30,7 +30,8 @@ setup(
     py_modules=['rain_shell_scripter'],
     entry_points={
         "console_scripts": [
-            "rain_shell_scripter=rain_shell_scripter:main"
+            "rain_shell_scripter=rain_shell_scripter:main",
+            "rain_shell_scripter_client=rain_shell_scripter:client_main"
         ],
     },
     zip_safe=False,
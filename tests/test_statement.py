@@ -0,0 +1,38 @@
+import unittest
+
+import rain_shell_scripter as rss
+
+
+class TestStatement(unittest.TestCase):
+    def setUp(self):
+        self.session = rss.Session()
+
+    def evaluate(self, expr_line: str, is_int: bool = False, **variables):
+        for name, value in variables.items():
+            self.session.vars.set(name, value)
+
+        # 与STATEMENT行的校验一致，编译时不能报错
+        rss._compile_statement(expr_line, is_int)
+        return self.session.evaluate_statement(expr_line, is_int)
+
+    def test_standalone_var(self):
+        self.assertEqual(self.evaluate('${n} + 1', True, n='4'), 5)
+        self.assertEqual(self.evaluate("'${s}'.upper()", s='ab'), 'AB')
+
+    def test_adjacent_vars(self):
+        self.assertEqual(self.evaluate('${a}${b}', True, a='1', b='2'), 12)
+
+    def test_var_followed_by_digit(self):
+        self.assertEqual(self.evaluate('${n}0 + 1', True, n='4'), 41)
+
+    def test_vars_joined_by_dot(self):
+        self.assertTrue(self.evaluate('${major}.${minor} >= 1.2', major='1', minor='3'))
+        self.assertFalse(self.evaluate('${major}.${minor} >= 1.2', major='1', minor='1'))
+
+    def test_spliced_statement_is_validated(self):
+        with self.assertRaises(rss.HappyPyException):
+            self.evaluate('${a}${b}', a='__import__', b='("os")')
+
+
+if __name__ == '__main__':
+    unittest.main()